@@ -1 +1,6 @@
 """Sales Scout Application"""
+from app.startup import import_timer_enabled, startup_report
+
+# Учет времени импорта для отчета о холодном старте (/debug/startup), только по STARTUP_IMPORT_TIMER
+if import_timer_enabled():
+    startup_report.install_import_timer()
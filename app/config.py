@@ -1,8 +1,11 @@
 """
 Конфигурация приложения Sales Scout
 """
+from pydantic import model_validator
 from pydantic_settings import BaseSettings
-from typing import Optional
+from typing import Dict, List, Optional
+
+from app.lazy import Lazy
 
 
 class Settings(BaseSettings):
@@ -12,24 +15,252 @@ class Settings(BaseSettings):
     BITRIX24_WEBHOOK_URL: str
     BITRIX24_BOT_ID: str = ""
     BITRIX24_CLIENT_ID: str = "9dqwph499ep9cpqdkyd1q2zxjvchddox"
+    # Пользовательское поле сделки с ИНН компании (если пусто - ИНН из реквизитов компании)
+    BITRIX_DEAL_INN_FIELD: str = "UF_CRM_INN"
+    # Токен приложения из событий Битрикс24 (auth[application_token]); события CRM с другим
+    # токеном и все события CRM, если токен не задан, отклоняются
+    BITRIX_APPLICATION_TOKEN: str = ""
 
     # DaData
     DADATA_API_KEY: str
+    DADATA_BASE_URL: str = "https://suggestions.dadata.ru/suggestions/api/4_1/rs"
 
     # OpenRouter (для Perplexity и LLM анализа)
     OPENROUTER_API_KEY: str
+    OPENROUTER_BASE_URL: str = "https://openrouter.ai/api/v1"
     DEFAULT_MODEL: str = "anthropic/claude-3.5-sonnet"
     PERPLEXITY_MODEL: str = "perplexity/sonar-pro"
 
+    # Клиент LLM для генерации досье: native (асинхронный httpx, SSE) или langchain
+    LLM_CLIENT: str = "native"
+    LLM_STREAM: bool = True
+    LLM_TIMEOUT: float = 120.0
+    LLM_CONNECT_TIMEOUT: float = 10.0
+    LLM_MAX_CONNECTIONS: int = 20
+
+    # Выбор модели досье по объему собранных данных и размеру компании:
+    # мало данных и нет признаков крупной компании - FAST_MODEL, иначе DEFAULT_MODEL.
+    # Крупная компания - хотя бы один порог ROUTING_LARGE_* достигнут
+    MODEL_ROUTING: bool = True
+    FAST_MODEL: str = "anthropic/claude-3.5-haiku"
+    FAST_MODEL_MAX_TOKENS: int = 2000
+    DEFAULT_MAX_TOKENS: int = 4000
+    ROUTING_SMALL_DATA_CHARS: int = 6000
+    ROUTING_LARGE_EMPLOYEES: int = 100
+    ROUTING_LARGE_CAPITAL: float = 10_000_000
+    ROUTING_LARGE_NEWS: int = 5
+
+    # Разметка статического префикса промптов (инструкции, шаблон досье) для кэширования
+    # у провайдера (cache_control для Anthropic и Gemini)
+    PROMPT_CACHE: bool = True
+
+    # JSON схема ответа (response_format) для поисковых запросов Perplexity, если модель ее поддерживает
+    STRUCTURED_OUTPUT: bool = True
+
     # Описание продукта
     OUR_PRODUCT_DESCRIPTION: str = "CRM система для автоматизации продаж"
 
     # Настройки приложения
     LOG_LEVEL: str = "INFO"
 
+    # Построение тяжелых сервисов (анализатор, LLM клиент) в фоне сразу после запуска,
+    # а не при первом досье. False - только по первому обращению
+    PREWARM_SERVICES: bool = True
+
+    # Журнал: JSON строки с ротацией по размеру; частота INFO/DEBUG записей
+    # одного места вызова ограничена LOG_SAMPLE_RATE в секунду (0 - без ограничения)
+    LOG_FILE: str = "sales_scout.log"
+    LOG_MAX_BYTES: int = 50 * 1024 * 1024
+    LOG_BACKUP_COUNT: int = 5
+    LOG_SAMPLE_RATE: float = 5.0
+    LOG_SAMPLE_BURST: int = 20
+    LOG_JSON_CONSOLE: bool = False
+
+    # Трейсинг запросов (доля сэмплируемых запросов 0.0-1.0, база SQLite трейсов и срок их хранения
+    # в днях, 0 - без удаления)
+    TRACE_SAMPLE_RATE: float = 1.0
+    TRACE_STORE_PATH: str = "traces.db"
+    TRACE_RETENTION_DAYS: float = 7
+
+    # Учет затрат: журнал и прайс моделей в USD за 1M токенов [prompt, completion]
+    # (используется, если OpenRouter не вернул usage.cost)
+    COST_LEDGER_PATH: str = "cost_ledger.csv"
+    MODEL_PRICES: Dict[str, List[float]] = {
+        "anthropic/claude-3.5-sonnet": [3.0, 15.0],
+        "anthropic/claude-3.5-haiku": [0.8, 4.0],
+        "perplexity/sonar-pro": [3.0, 15.0],
+    }
+
+    # Кассеты обменов с внешними API: off / record / replay
+    # CASSETTE_LATENCY_SCALE: 1.0 - исходные задержки, 0 - без задержек
+    CASSETTE_MODE: str = "off"
+    CASSETTE_DIR: str = "cassettes"
+    CASSETTE_LATENCY_SCALE: float = 1.0
+
+    # База SQLite (оценки досье)
+    DATABASE_PATH: str = "sales_scout.db"
+
+    # Общее состояние воркеров (сборки в работе, кэши, блокировки, ключи идемпотентности, лимиты):
+    # memory - один процесс, sqlite - процессы одного хоста (DATABASE_PATH), redis - несколько хостов
+    SHARED_STATE_BACKEND: str = "memory"
+    REDIS_URL: str = "redis://localhost:6379/0"
+    SHARED_STATE_PREFIX: str = "sales_scout:"
+
+    # Классы приоритета исследований по источнику запроса: interactive (чат) > robot (робот сделки)
+    # > batch (API, автоматизации) > prefetch (события CRM, ночной прогрев). Задания очереди выдаются
+    # воркерам по классу. Запросы к внешним API ограничены UPSTREAM_CONCURRENCY на процесс (нет в
+    # словаре - без ограничения), из них PRIORITY_RESERVED_SLOTS[класс] доступны только этому классу и старшим
+    PRIORITY_SOURCES: Dict[str, str] = {
+        "chat": "interactive",
+        "robot": "robot",
+        "api": "batch",
+        "prefetch": "prefetch",
+        "prewarm": "prefetch",
+    }
+    UPSTREAM_CONCURRENCY: Dict[str, int] = {
+        "openrouter": 16,
+        "dadata": 8,
+    }
+    PRIORITY_RESERVED_SLOTS: Dict[str, int] = {
+        "interactive": 4,
+        "robot": 2,
+    }
+    # Потоки для синхронных этапов досье по классу (отдельный пул на класс: пакет не занимает потоки чата)
+    PRIORITY_THREAD_POOLS: Dict[str, int] = {
+        "interactive": 16,
+        "robot": 8,
+        "batch": 8,
+        "prefetch": 4,
+    }
+    # Одновременные фоновые исследования процесса API в режиме inline по классу (нет в словаре или 0 -
+    # без ограничения); остальные ждут своей очереди в процессе
+    INLINE_JOB_CONCURRENCY: Dict[str, int] = {
+        "interactive": 16,
+        "robot": 8,
+        "batch": 4,
+        "prefetch": 2,
+    }
+
+    # Квоты пользователей (user_id) и порталов (домен Битрикс24): исследований в час и стоимость LLM
+    # за сутки в USD (0 - без ограничения). QUOTA_OVERRIDES - лимиты и вес (weight) отдельных
+    # арендаторов: {"user:10": {"requests_per_hour": 100, "weight": 2}, "portal:x.bitrix24.ru": {...}}.
+    # Сверх лимита запросов: defer - отложить до часа со свободным лимитом (не дальше
+    # QUOTA_MAX_DEFER_HOURS, только RESEARCH_EXECUTION=queue), reject - отклонить.
+    # В очереди задания пользователей чередуются: каждое следующее задание пользователя портала
+    # получает метку на QUOTA_FAIR_QUANTUM_SECONDS / (вес пользователя * вес портала) позже предыдущего
+    QUOTA_USER_REQUESTS_PER_HOUR: int = 30
+    QUOTA_PORTAL_REQUESTS_PER_HOUR: int = 300
+    QUOTA_USER_DAILY_COST_USD: float = 10.0
+    QUOTA_PORTAL_DAILY_COST_USD: float = 100.0
+    QUOTA_OVERRIDES: Dict[str, Dict[str, float]] = {}
+    QUOTA_OVER_RATE: str = "defer"
+    QUOTA_MAX_DEFER_HOURS: int = 12
+    QUOTA_FAIR_QUANTUM_SECONDS: float = 60
+
+    # Повторы запросов исследования (/webhook/research, /api/research) с тем же ключом идемпотентности
+    # (переданным вызывающим или из пользователя, сделки, ИНН и сайта) в пределах окна в секундах
+    # возвращают исходный запрос без нового исследования и второго комментария к сделке (0 - выключено)
+    IDEMPOTENCY_WINDOW_SECONDS: float = 900
+
+    # Выполнение исследований: inline - в процессе API (фоновые задачи FastAPI), queue - задания
+    # в очереди на бэкенде общего состояния (sqlite или redis) для воркеров `python -m app.worker`.
+    # Воркер берет задание в аренду на JOB_LEASE_SECONDS и продлевает ее, пока выполняет;
+    # задание упавшего воркера возвращается в очередь, всего не больше JOB_MAX_ATTEMPTS попыток.
+    # queue с SHARED_STATE_BACKEND=memory - ошибка конфигурации: приложение не запускается
+    RESEARCH_EXECUTION: str = "inline"
+    WORKER_CONCURRENCY: int = 4
+    # Слоты воркера, доступные только заданиям класса и старших (см. PRIORITY_RESERVED_SLOTS)
+    WORKER_RESERVED_SLOTS: Dict[str, int] = {
+        "interactive": 1,
+    }
+    JOB_LEASE_SECONDS: float = 60
+    JOB_POLL_SECONDS: float = 1.0
+    JOB_MAX_ATTEMPTS: int = 3
+    # Задание, завершившееся ошибкой, повторяется через столько секунд (удваивается на каждой попытке)
+    JOB_RETRY_SECONDS: float = 30
+    JOB_RETENTION_HOURS: float = 72
+    # Сколько ждать выполняемые задания при остановке воркера (остальные вернутся в очередь по аренде)
+    WORKER_SHUTDOWN_SECONDS: float = 60
+    # Порт /metrics воркера (0 - не открывать)
+    WORKER_METRICS_PORT: int = 0
+
+    # Досье по ИНН: источники хранятся со временем получения и перезапрашиваются после
+    # срока (дни), при обновлении перегенерируются только зависящие от них разделы
+    DOSSIER_CACHE: bool = True
+    DOSSIER_SOURCE_TTL_DAYS: Dict[str, float] = {
+        "egrul": 30,
+        "online_presence": 30,
+        "website": 30,
+        "executives": 30,
+        "business": 30,
+        "news": 7,
+    }
+    DOSSIER_SECTION_MAX_TOKENS: int = 700
+    # История досье: каждое построенное досье с метаданными (ИНН, название, сайт, дата, кто запросил,
+    # сделка) в полнотекстовом индексе с основами русских слов (/api/dossier/search, команда бота "/поиск")
+    DOSSIER_HISTORY: bool = True
+    DOSSIER_SEARCH_BOT_RESULTS: int = 5
+    # Кэш поиска компании и ИНН по названию/сайту в общем состоянии (часы, 0 - без кэша)
+    IDENTIFICATION_CACHE_HOURS: float = 24
+
+    # Срок досье по точке входа (источник запроса: chat, robot, prefetch, prewarm; default - остальные)
+    # и бюджеты этапов в секундах. Необязательные этапы (онлайн-присутствие, сайт, ЛПР, бизнес,
+    # новости) получают не больше остатка срока за вычетом DOSSIER_LLM_RESERVE_SECONDS и пропускаются,
+    # если это меньше DOSSIER_MIN_STAGE_SECONDS; досье строится из собранного с пометкой пробелов
+    DOSSIER_DEADLINE_SECONDS: Dict[str, float] = {
+        "chat": 180,
+        "robot": 300,
+        "prefetch": 600,
+        "prewarm": 600,
+        "default": 300,
+    }
+    DOSSIER_STAGE_BUDGETS: Dict[str, float] = {
+        "identification": 40,
+        "online_presence": 45,
+        "website": 20,
+        "executives": 45,
+        "business": 45,
+        "news": 45,
+        "llm": 120,
+    }
+    DOSSIER_LLM_RESERVE_SECONDS: float = 45
+    DOSSIER_MIN_STAGE_SECONDS: float = 5
+
+    # Предварительное исследование по событиям CRM ONCRMDEALADD и ONCRMCOMPANYADD:
+    # досье компании с ИНН строится в хранилище сразу при создании сделки или компании
+    CRM_PREFETCH: bool = True
+
+    # Ночной прогрев досье по открытым сделкам: в окне START_HOUR-END_HOUR (локальное время)
+    # строятся досье компаний без актуальной копии (актуальной хотя бы еще FRESH_MARGIN_HOURS),
+    # по одному с паузой, пока не исчерпан бюджет по количеству или стоимости
+    PREWARM_ENABLED: bool = False
+    PREWARM_START_HOUR: int = 1
+    PREWARM_END_HOUR: int = 6
+    PREWARM_MAX_DOSSIERS: int = 200
+    PREWARM_MAX_COST_USD: float = 20.0
+    PREWARM_FRESH_MARGIN_HOURS: float = 24.0
+    PREWARM_PAUSE_SECONDS: float = 5.0
+
+    # Оценки досье: запись пачками до BATCH штук или раз в INTERVAL секунд;
+    # FEEDBACK_LOG_PATH - журнал прежнего формата, переносится в базу при первом запуске
+    FEEDBACK_WRITE_BATCH: int = 100
+    FEEDBACK_WRITE_INTERVAL: float = 0.5
+    FEEDBACK_LOG_PATH: str = "feedback_log.jsonl"
+
+    @model_validator(mode="after")
+    def check_research_execution(self) -> "Settings":
+        """Очередь заданий видна воркерам только на общем бэкенде (sqlite или redis)"""
+        if self.RESEARCH_EXECUTION == "queue" and self.SHARED_STATE_BACKEND == "memory":
+            raise ValueError(
+                "RESEARCH_EXECUTION=queue требует SHARED_STATE_BACKEND=sqlite или redis: "
+                "с memory задания не видны воркерам в других процессах"
+            )
+        return self
+
     class Config:
         env_file = ".env"
         case_sensitive = True
 
 
-settings = Settings()
+# Проверка переменных окружения - при первом обращении к настройке
+settings = Lazy(Settings, "settings")
@@ -0,0 +1,52 @@
+"""
+Ленивое построение глобальных экземпляров сервисов
+
+Модули по-прежнему экспортируют singleton (settings, sales_analyzer, ...), но объект
+строится при первом обращении к атрибуту, а не при импорте. Процессы, которым сервис
+не нужен (/health, скрипты), не платят за его построение и тяжелые зависимости.
+"""
+import time
+import threading
+from typing import Callable, Generic, TypeVar
+
+from app.startup import startup_report
+
+T = TypeVar("T")
+
+
+class Lazy(Generic[T]):
+    """Прокси, строящий объект фабрикой при первом обращении (потокобезопасно)"""
+
+    __slots__ = ("_factory", "_name", "_instance", "_lock")
+
+    def __init__(self, factory: Callable[[], T], name: str):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _get(self) -> T:
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                instance = self._instance
+                if instance is None:
+                    started = time.perf_counter()
+                    instance = self._factory()
+                    startup_report.record_build(self._name, time.perf_counter() - started)
+                    object.__setattr__(self, "_instance", instance)
+        return instance
+
+    @property
+    def is_built(self) -> bool:
+        return self._instance is not None
+
+    def __getattr__(self, item):
+        return getattr(self._get(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self._get(), key, value)
+
+    def __repr__(self) -> str:
+        state = repr(self._instance) if self._instance is not None else "не построен"
+        return f"<Lazy {self._name}: {state}>"
@@ -0,0 +1,126 @@
+"""
+Настройка логирования: запись в фоновом потоке, ротация по размеру, JSON строки
+
+Обработчики пишут через QueueHandler -> QueueListener, поэтому вызов logger.info
+в event loop не ждет диска. Каждая запись несет request_id (и user_id / deal_id / ИНН)
+из app.request_context. Частые INFO/DEBUG строки ограничиваются по месту вызова.
+"""
+import sys
+import time
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Optional, Tuple
+
+from pythonjsonlogger import jsonlogger
+
+from app import request_context
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s"
+JSON_FORMAT = "%(asctime)s %(name)s %(levelname)s %(message)s %(request_id)s"
+
+_listener: Optional[QueueListener] = None
+
+
+class RequestContextFilter(logging.Filter):
+    """Добавление полей текущего запроса в запись (в потоке вызывающего кода)"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        ctx = request_context.current()
+        record.request_id = ctx.request_id if ctx else "-"
+        if ctx:
+            for field in ("user_id", "deal_id", "inn", "source"):
+                value = getattr(ctx, field)
+                if value:
+                    setattr(record, field, value)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Ограничение частоты INFO/DEBUG записей по месту вызова (token bucket)
+
+    WARNING и выше пропускаются всегда. Количество отброшенных записей попадает
+    в поле sampled_dropped следующей пропущенной записи того же места.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self._lock = threading.Lock()
+        # (файл, строка) -> [токены, время последнего пополнения, отброшено]
+        self._buckets: Dict[Tuple[str, int], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate <= 0:
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now, 0]
+            tokens, updated, dropped = bucket
+            tokens = min(float(self.burst), tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                bucket[:] = [tokens, now, dropped + 1]
+                return False
+            bucket[:] = [tokens - 1, now, 0]
+
+        if dropped:
+            record.sampled_dropped = dropped
+        return True
+
+
+def setup_logging(level: str, path: str, max_bytes: int, backup_count: int,
+                  sample_rate: float, sample_burst: int, json_console: bool = False):
+    """
+    Настройка корневого логгера
+
+    Args:
+        level: Уровень (INFO, DEBUG, ...)
+        path: Файл журнала (JSON строки)
+        max_bytes: Размер файла до ротации
+        backup_count: Сколько ротированных файлов хранить
+        sample_rate: Допустимая частота INFO/DEBUG записей одного места вызова в секунду (0 - без ограничения)
+        sample_burst: Допустимый всплеск записей одного места вызова
+        json_console: JSON вместо текста в stdout (для сборщиков логов в контейнерах)
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    file_handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    file_handler.setFormatter(jsonlogger.JsonFormatter(JSON_FORMAT, json_ensure_ascii=False))
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(
+        jsonlogger.JsonFormatter(JSON_FORMAT, json_ensure_ascii=False) if json_console else logging.Formatter(TEXT_FORMAT)
+    )
+
+    log_queue: "queue.Queue" = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate, sample_burst))
+    queue_handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    root.setLevel(getattr(logging, level))
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+
+    _listener = QueueListener(log_queue, console_handler, file_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Запись оставшейся очереди и остановка фонового потока"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -2,29 +2,45 @@
 Sales Scout - FastAPI приложение
 Автоматическое создание досье компаний для менеджеров по продажам
 """
+import re
+import time
+import asyncio
 import logging
 import json
-from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import JSONResponse
+from datetime import datetime
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+from fastapi import FastAPI, Header, Request, BackgroundTasks
+from fastapi.responses import JSONResponse, Response, PlainTextResponse
 from dotenv import load_dotenv
 
-from app.webhooks.bitrix_handler import handle_bitrix_message, handle_direct_research_request
+from app.webhooks.bitrix_handler import CRM_EVENTS, FEEDBACK_COMMANDS, crm_event_authorized, extract_search_query
 from app.models import CompanyResearchRequest, CompanyResearchResponse
 from app.config import settings
+from app.logging_config import setup_logging, shutdown_logging
+from app import request_context
+from app.request_context import new_request_id
+from app.startup import startup_report
+from app.services.bitrix import bitrix_service
+from app.services.cost_ledger import cost_ledger
+from app.services.dossier_history import dossier_history
+from app.services.dossier_store import dossier_store
+from app.services.feedback_stats import feedback_stats
+from app.services.feedback_store import feedback_store
+from app.services.idempotency import derive_key, idempotency
+from app.services.job_queue import Job, job_queue
+from app.services.metrics import metrics
+from app.services.openrouter_client import openrouter_client
+from app.services import priority
+from app.services.priority import inline_jobs, thread_pools
+from app.services.prewarm import prewarm_job
+from app.services.quotas import EXEMPT_SOURCES, QuotaDecision, quotas
+from app.services.tracing import tracer
+from app.worker import job_handler
 
 # Загружаем переменные окружения
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    level=getattr(logging, settings.LOG_LEVEL),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('sales_scout.log', encoding='utf-8')
-    ]
-)
-
 logger = logging.getLogger(__name__)
 
 # Создаем FastAPI приложение
@@ -38,11 +54,173 @@ app = FastAPI(
 @app.on_event("startup")
 async def startup_event():
     """Действия при запуске приложения"""
+    # Настройка логирования (запись в фоновом потоке, см. app/logging_config.py) - при запуске, а не
+    # при импорте: импорт модуля не читает настройки
+    setup_logging(
+        settings.LOG_LEVEL,
+        settings.LOG_FILE,
+        settings.LOG_MAX_BYTES,
+        settings.LOG_BACKUP_COUNT,
+        settings.LOG_SAMPLE_RATE,
+        settings.LOG_SAMPLE_BURST,
+        settings.LOG_JSON_CONSOLE,
+    )
     logger.info("=" * 50)
     logger.info("Sales Scout запущен!")
     logger.info(f"Модель LLM: {settings.DEFAULT_MODEL}")
     logger.info(f"Продукт: {settings.OUR_PRODUCT_DESCRIPTION}")
     logger.info("=" * 50)
+    await asyncio.to_thread(feedback_store.start)
+    startup_report.mark("startup_complete")
+    if settings.PREWARM_SERVICES and not _queued():
+        # Сервер уже принимает запросы, анализатор и LLM клиент строятся в фоне
+        asyncio.get_running_loop().run_in_executor(None, _prewarm_services)
+    if settings.PREWARM_ENABLED and not _queued():
+        # В режиме очереди расписание прогрева запускают воркеры
+        prewarm_job.start()
+    logger.info(f"Запуск занял {startup_report.marks['startup_complete']} с (отчет: /debug/startup)")
+
+
+def _prewarm_services():
+    """Построение тяжелых сервисов до первого досье"""
+    from app.services.sales_analyzer import sales_analyzer
+
+    try:
+        sales_analyzer.warm_up()
+        startup_report.mark("services_ready")
+    except Exception as e:
+        logger.warning(f"Не удалось заранее построить сервисы: {e}")
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Действия при остановке приложения"""
+    if prewarm_job.is_built:
+        prewarm_job.stop()
+    await asyncio.to_thread(feedback_store.close)
+    if tracer.is_built:
+        await asyncio.to_thread(tracer.close)
+    if thread_pools.is_built:
+        thread_pools.shutdown()
+    await openrouter_client.aclose()
+    shutdown_logging()
+
+
+_REQUEST_ID_RE = re.compile(r"^[\w-]{1,64}$")
+
+
+@app.middleware("http")
+async def bind_request_id(request: Request, call_next):
+    """ID запроса для логов и трейса: из заголовка X-Request-ID или новый"""
+    request_id = request.headers.get("x-request-id", "")
+    if not _REQUEST_ID_RE.match(request_id):
+        request_id = new_request_id()
+    started = time.perf_counter()
+    with request_context.bind(request_id):
+        response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    if startup_report.first_request is None and startup_report.record_first_request(
+        request.url.path, time.perf_counter() - started
+    ):
+        startup_report.uninstall_import_timer()
+        logger.info(f"Первый запрос обработан через {startup_report.first_request['at']} с после импорта")
+    return response
+
+
+def _queued() -> bool:
+    """Исследования выполняют воркеры очереди (RESEARCH_EXECUTION=queue)"""
+    return settings.RESEARCH_EXECUTION == "queue"
+
+
+async def _admit(origin: str, user_id: Optional[str], portal: Optional[str]) -> QuotaDecision:
+    """
+    Проверка квот пользователя и портала перед постановкой исследования
+
+    Args:
+        origin: Источник запроса (без квот - EXEMPT_SOURCES)
+        user_id: ID пользователя Битрикс24
+        portal: Домен портала (None - портал из BITRIX24_WEBHOOK_URL)
+    """
+    if origin in EXEMPT_SOURCES:
+        return QuotaDecision(True)
+    decision = await asyncio.to_thread(quotas.admit, user_id, portal, _queued())
+    if not decision.allowed or decision.deferred_until:
+        result = "deferred" if decision.allowed else "rejected"
+        metrics.quota_decisions.labels(result, decision.reason).inc()
+        logger.warning(f"Квота {decision.tenant} ({decision.reason}): исследование {origin} - {result}")
+    return decision
+
+
+async def _repeat_of(key: str, endpoint: str) -> Optional[Dict]:
+    """
+    Запись ключа идемпотентности нового исследования
+
+    Returns:
+        None - запрос новый, иначе исходный запрос: request_id, статус (задания очереди, если есть) и время
+    """
+    existing = await asyncio.to_thread(idempotency.begin, key, request_context.get_request_id())
+    if existing is None:
+        return None
+    metrics.idempotent_repeats.labels(endpoint).inc()
+    status = existing["status"]
+    if _queued():
+        job = await asyncio.to_thread(job_queue.get, existing["request_id"])
+        if job is not None and status != "done":
+            status = job.status
+    logger.info(f"Повтор запроса {existing['request_id']} ({endpoint}), статус {status}: исследование не запускается")
+    return {
+        "request_id": existing["request_id"],
+        "research_status": status,
+        "created_at": datetime.fromtimestamp(existing["created_at"]).isoformat(timespec="seconds"),
+    }
+
+
+async def _notify(dialog_id: Optional[str], message: str):
+    """Сообщение пользователю от бота (ошибка отправки только в журнал)"""
+    if not dialog_id:
+        return
+    try:
+        await asyncio.to_thread(bitrix_service.send_message, dialog_id, message)
+    except Exception as e:
+        logger.warning(f"Не удалось отправить сообщение в {dialog_id}: {e}")
+
+
+async def _schedule_job(background_tasks: BackgroundTasks, job: str, origin: str, inline: bool = False,
+                        tenant: Tuple[Optional[str], Optional[str]] = (None, None),
+                        available_at: Optional[float] = None, **kwargs) -> str:
+    """
+    Постановка задания: в очередь воркеров или в фон процесса API
+
+    Args:
+        background_tasks: Фоновые задачи FastAPI
+        job: Имя задания (см. app.worker.job_handler)
+        origin: Источник запроса (chat, robot, api, prefetch, prewarm) - определяет класс приоритета
+        inline: Выполнить в процессе API и в режиме очереди
+        tenant: Пользователь и портал для справедливой очереди
+        available_at: Отложить до момента (решение квоты; только в режиме очереди)
+        **kwargs: Аргументы обработчика (JSON-сериализуемые)
+
+    Returns:
+        ID задания (ID запроса)
+    """
+    job_id = kwargs.get("request_id") or new_request_id()
+    if _queued() and not inline:
+        fair_tag = None if origin in EXEMPT_SOURCES else await asyncio.to_thread(quotas.fair_tag, *tenant)
+        await asyncio.to_thread(job_queue.enqueue, Job(
+            id=job_id, name=job, kwargs=kwargs, priority=priority.class_for(origin),
+            available_at=available_at, fair_tag=fair_tag,
+        ))
+        return job_id
+    metrics.research_queued()
+    background_tasks.add_task(_run_job, job_handler(job), priority.class_for(origin), **kwargs)
+    return job_id
+
+
+async def _run_job(handler, job_class: str, **kwargs):
+    """Выполнение фонового обработчика (не больше INLINE_JOB_CONCURRENCY заданий класса одновременно)"""
+    async with inline_jobs.slot(job_class):
+        with metrics.research_job():
+            await handler(**kwargs)
 
 
 @app.get("/")
@@ -65,6 +243,18 @@ async def health_check():
     }
 
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Метрики в формате Prometheus"""
+    if _queued():
+        # Очередь и выполняемые задания - по данным очереди (выполняют воркеры)
+        counts = await asyncio.to_thread(job_queue.counts)
+        metrics.queue_depth.set(counts["queued"])
+        metrics.in_flight.set(counts["running"])
+    content, content_type = metrics.render()
+    return Response(content=content, headers={"Content-Type": content_type})
+
+
 @app.post("/webhook/bitrix")
 async def bitrix_webhook(request: Request, background_tasks: BackgroundTasks):
     """
@@ -101,7 +291,11 @@ async def bitrix_webhook(request: Request, background_tasks: BackgroundTasks):
                         "chat_id": form_data.get("data[PARAMS][DIALOG_ID]", ""),
                         "author_id": form_data.get("data[PARAMS][AUTHOR_ID]", ""),
                         "system": form_data.get("data[PARAMS][SYSTEM]", "N"),
-                    }
+                    },
+                    # События CRM (ONCRMDEALADD, ONCRMCOMPANYADD)
+                    "FIELDS": {
+                        "ID": form_data.get("data[FIELDS][ID]", ""),
+                    },
                 },
                 "auth": {
                     "domain": form_data.get("auth[domain]", ""),
@@ -118,12 +312,41 @@ async def bitrix_webhook(request: Request, background_tasks: BackgroundTasks):
             except:
                 # Если не JSON, пытаемся как query params
                 data = dict(request.query_params)
-                logger.info(f"Данные из query params: {data}")
+                logger.debug(f"Данные из query params: {data}")
 
         logger.info(f"Получен webhook от Битрикс24: event={data.get('event')}")
-
-        # Обрабатываем сообщение в фоне, чтобы быстро ответить Битрикс24
-        background_tasks.add_task(handle_bitrix_message, data)
+        if data.get("event") in CRM_EVENTS and (not settings.CRM_PREFETCH or not crm_event_authorized(data)):
+            # Неподписанное событие (или выключенный prefetch) не тратит квоту и не ставит исследование
+            return JSONResponse({"status": "ok"}, status_code=200)
+
+        # Обрабатываем сообщение (или событие CRM) в фоне, чтобы быстро ответить Битрикс24.
+        # Оценки с кнопок и поиск по истории досье отвечают за миллисекунды - их не отдаем воркерам
+        crm_event = data.get("event") in CRM_EVENTS
+        message = data.get("data", {}).get("MESSAGE", {})
+        text = str(message.get("text", ""))
+        command = text in FEEDBACK_COMMANDS or extract_search_query(text) is not None
+        origin = "prefetch" if crm_event else "chat"
+        user_id = None if crm_event else (message.get("author_id") or None)
+        portal = data.get("auth", {}).get("domain") or None
+
+        # Квоты - только для исследований: сообщений боту и событий CRM
+        research = crm_event or (
+            data.get("event") == "ONIMBOTMESSAGEADD" and message.get("system") != "Y" and not command
+        )
+        decision = await _admit(origin, user_id, portal) if research else QuotaDecision(True)
+        if not crm_event and decision.message:
+            await _notify(message.get("chat_id"), decision.message)
+        if decision.allowed:
+            await _schedule_job(
+                background_tasks,
+                "crm_event" if crm_event else "bitrix_message",
+                origin,
+                inline=command,
+                tenant=(user_id, portal),
+                available_at=decision.deferred_until,
+                webhook_data=data,
+                request_id=request_context.get_request_id(),
+            )
 
         # Быстро возвращаем OK для Битрикс24
         return JSONResponse({"status": "ok"}, status_code=200)
@@ -143,7 +366,8 @@ async def webhook_research_company(
     userId: str = None,
     dealTitle: str = None,
     companyWebsite: str = None,
-    dealId: str = None
+    dealId: str = None,
+    idempotencyKey: str = None
 ):
     """
     Webhook endpoint для исследования компании (GET и POST запросы)
@@ -159,6 +383,8 @@ async def webhook_research_company(
         dealTitle: Название сделки (может быть None)
         companyWebsite: Сайт компании (может быть None)
         dealId: ID сделки для добавления комментария (может быть None)
+        idempotencyKey: Ключ идемпотентности (или заголовок Idempotency-Key; по умолчанию -
+            из пользователя, сделки, ИНН и сайта)
 
     Returns:
         Статус обработки
@@ -174,8 +400,10 @@ async def webhook_research_company(
             dealTitle = dealTitle or form_data.get("dealTitle")
             companyWebsite = companyWebsite or form_data.get("companyWebsite")
             dealId = dealId or form_data.get("dealId")
+            idempotencyKey = idempotencyKey or form_data.get("idempotencyKey")
         except:
             pass
+    key = None
     try:
         logger.info(f"Webhook research: companyName={companyName}, inn={inn}, userId={userId}, dealTitle={dealTitle}, website={companyWebsite}, dealId={dealId}")
 
@@ -224,23 +452,66 @@ async def webhook_research_company(
 
         logger.info(f"Webhook research (очищено): search_query={search_query}, inn={inn}, user_id={user_id_clean}, deal_id={deal_id_clean}, website={companyWebsite}")
 
+        # Повтор робота (та же сделка и компания в пределах окна) - статус исходного запроса
+        request_id = request_context.get_request_id()
+        derived = derive_key(
+            user_id_clean, deal_id_clean, inn, companyName or dealTitle, companyWebsite,
+            supplied=idempotencyKey or request.headers.get("Idempotency-Key"),
+        )
+        repeat = await _repeat_of(derived, "webhook_research")
+        if repeat is not None:
+            return JSONResponse({
+                "status": "duplicate",
+                "message": f"Исследование компании '{search_query}' уже запущено по этому запросу",
+                **repeat
+            })
+        key = derived
+
+        # Квоты пользователя и портала: сверх лимита - отложить или отклонить с сообщением
+        decision = await _admit("robot", user_id_clean, None)
+        if decision.message:
+            await _notify(user_id_clean, decision.message)
+        if not decision.allowed:
+            await asyncio.to_thread(idempotency.release, key)
+            return JSONResponse({
+                "status": "rejected",
+                "message": decision.message,
+                "request_id": request_id
+            }, status_code=429)
+
         # Запускаем обработку в фоне
-        background_tasks.add_task(
-            handle_direct_research_request,
+        await _schedule_job(
+            background_tasks,
+            "direct_research",
+            "robot",
+            tenant=(user_id_clean, None),
+            available_at=decision.deferred_until,
             company_name=search_query if not inn else companyName,
             inn=inn,
             user_id=user_id_clean,
             deal_id=deal_id_clean,
-            company_website=companyWebsite
+            company_website=companyWebsite,
+            request_id=request_id,
+            idempotency_key=key
         )
 
+        if decision.deferred_until:
+            return JSONResponse({
+                "status": "deferred",
+                "message": decision.message,
+                "request_id": request_id,
+                "available_at": datetime.fromtimestamp(decision.deferred_until).isoformat(timespec="seconds")
+            })
+
         return JSONResponse({
             "status": "ok",
-            "message": f"Исследование компании '{search_query}' запущено"
+            "message": f"Исследование компании '{search_query}' запущено",
+            "request_id": request_id
         })
 
     except Exception as e:
         logger.error(f"Ошибка webhook research: {e}", exc_info=True)
+        await asyncio.to_thread(idempotency.release, key)
         return JSONResponse({
             "status": "error",
             "message": str(e)
@@ -248,7 +519,11 @@ async def webhook_research_company(
 
 
 @app.post("/api/research", response_model=CompanyResearchResponse)
-async def api_research_company(request: CompanyResearchRequest, background_tasks: BackgroundTasks):
+async def api_research_company(
+    request: CompanyResearchRequest,
+    background_tasks: BackgroundTasks,
+    idempotency_header: Optional[str] = Header(None, alias="Idempotency-Key"),
+):
     """
     API endpoint для прямого запроса исследования компании
 
@@ -263,12 +538,14 @@ async def api_research_company(request: CompanyResearchRequest, background_tasks
     }
 
     Args:
-        request: Данные запроса (company_name, inn, user_id)
+        request: Данные запроса (company_name, inn, user_id, idempotency_key)
         background_tasks: Фоновые задачи
+        idempotency_header: Ключ идемпотентности из заголовка Idempotency-Key
 
     Returns:
         Статус обработки запроса
     """
+    key = None
     try:
         logger.info(f"API research request: company_name={request.company_name}, inn={request.inn}, user_id={request.user_id}")
 
@@ -279,67 +556,389 @@ async def api_research_company(request: CompanyResearchRequest, background_tasks
                 message="Укажите название компании (company_name) или ИНН (inn)"
             )
 
+        # Повтор в пределах окна идемпотентности - исходная задача
+        request_id = request_context.get_request_id()
+        derived = derive_key(
+            request.user_id, None, request.inn, request.company_name,
+            supplied=request.idempotency_key or idempotency_header,
+        )
+        repeat = await _repeat_of(derived, "api_research")
+        if repeat is not None:
+            return CompanyResearchResponse(
+                status="duplicate",
+                message=f"Исследование уже запущено {repeat['created_at']}, статус: {repeat['research_status']}",
+                task_id=repeat["request_id"],
+            )
+        key = derived
+
+        # Квоты пользователя и портала
+        decision = await _admit("api", request.user_id, None)
+        if decision.message:
+            await _notify(request.user_id, decision.message)
+        if not decision.allowed:
+            await asyncio.to_thread(idempotency.release, key)
+            return CompanyResearchResponse(status="rejected", message=decision.message, task_id=request_id)
+
         # Обрабатываем запрос в фоне
-        background_tasks.add_task(
-            handle_direct_research_request,
+        await _schedule_job(
+            background_tasks,
+            "direct_research",
+            "api",
+            tenant=(request.user_id, None),
+            available_at=decision.deferred_until,
             company_name=request.company_name,
             inn=request.inn,
-            user_id=request.user_id
+            user_id=request.user_id,
+            source="api",
+            request_id=request_id,
+            idempotency_key=key
         )
 
         query_desc = request.company_name or request.inn
 
+        if decision.deferred_until:
+            return CompanyResearchResponse(status="deferred", message=decision.message, task_id=request_id)
+
         return CompanyResearchResponse(
             status="processing",
-            message=f"Исследование компании '{query_desc}' запущено. Результат будет отправлен пользователю {request.user_id}"
+            message=f"Исследование компании '{query_desc}' запущено. Результат будет отправлен пользователю {request.user_id}",
+            task_id=request_id
         )
 
     except Exception as e:
         logger.error(f"Ошибка API research: {e}", exc_info=True)
+        await asyncio.to_thread(idempotency.release, key)
         return CompanyResearchResponse(
             status="error",
             message=f"Ошибка обработки запроса: {str(e)}"
         )
 
 
+def _dossier_headers(inn: str, updated_at: float, format: str) -> Dict[str, str]:
+    """Заголовки кэширования досье: ETag по ИНН, времени обновления и формату, Last-Modified"""
+    return {
+        "ETag": f'"{inn}-{int(updated_at * 1000)}-{format}"',
+        "Last-Modified": formatdate(updated_at, usegmt=True),
+        "Cache-Control": "private, no-cache",
+    }
+
+
+def _not_modified(request: Request, etag: str, updated_at: float) -> bool:
+    """Условный запрос: If-None-Match (если есть, If-Modified-Since не проверяется) или If-Modified-Since"""
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match is not None:
+        tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("If-Modified-Since")
+    if if_modified_since:
+        try:
+            return int(updated_at) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+@app.get("/api/dossier/search")
+async def search_dossiers(q: str, limit: int = 10, inn: str = None, date_from: str = None, date_to: str = None,
+                          full: bool = False):
+    """
+    Полнотекстовый поиск по истории досье (с учетом форм русских слов)
+
+    Args:
+        q: Слова запроса: название, ИНН, сайт, отрасль, люди, технологии
+        limit: Сколько досье вернуть (до 100)
+        inn: Только досье компании с этим ИНН
+        date_from: Не раньше даты (YYYY-MM-DD)
+        date_to: Не позже даты (YYYY-MM-DD)
+        full: Вернуть полный текст досье
+
+    Returns:
+        Найденные досье от наиболее релевантных с датой, кто запросил и строкой со словами запроса
+    """
+    started = time.perf_counter()
+    try:
+        results = await asyncio.to_thread(
+            dossier_history.search, q, max(1, min(limit, 100)), inn, date_from, date_to, full
+        )
+    except ValueError as e:
+        return JSONResponse({"status": "error", "message": f"Неверная дата: {e}"}, status_code=400)
+    return {
+        "query": q,
+        "took_ms": round((time.perf_counter() - started) * 1000, 1),
+        "count": len(results),
+        "results": results,
+    }
+
+
+@app.get("/api/dossier/{inn}")
+async def get_dossier(request: Request, background_tasks: BackgroundTasks, inn: str, format: str = "json",
+                      refresh: bool = False, user_id: str = None):
+    """
+    Сохраненное досье компании (BI, расширение браузера) с условными запросами
+
+    Чтение только из хранилища досье: внешние API не вызываются. Ответ содержит ETag и
+    Last-Modified; с If-None-Match / If-Modified-Since неизмененное досье отдается как 304
+    без загрузки текста.
+
+    Args:
+        inn: ИНН компании
+        format: json (текст, разделы и время получения источников) или text
+        refresh: Обновить досье в фоне (квоты и идемпотентность как у /api/research); ответ 202
+            с request_id, результат - следующим GET
+        user_id: ID пользователя Битрикс24, запросившего обновление (для квот и затрат)
+    """
+    inn = "".join(filter(str.isdigit, inn))
+    if len(inn) not in (10, 12):
+        return JSONResponse({"status": "error", "message": "ИНН должен содержать 10 или 12 цифр"}, status_code=400)
+    if format not in ("json", "text"):
+        return JSONResponse({"status": "error", "message": "format: json или text"}, status_code=400)
+    if refresh:
+        return await _refresh_dossier(request, background_tasks, inn, user_id)
+
+    # Для условного запроса достаточно времени обновления - текст и источники не загружаются.
+    # Досье без текста времени обновления не имеет: 404, а не 304 на любой If-Modified-Since
+    updated_at = await asyncio.to_thread(dossier_store.updated_at, inn)
+    if updated_at is not None:
+        headers = _dossier_headers(inn, updated_at, format)
+        if _not_modified(request, headers["ETag"], updated_at):
+            metrics.dossier_reads.labels("not_modified").inc()
+            return Response(status_code=304, headers=headers)
+
+    record = await asyncio.to_thread(dossier_store.load, inn) if updated_at is not None else None
+    if record is None or not record.text:
+        metrics.dossier_reads.labels("not_found").inc()
+        return JSONResponse(
+            {"status": "error", "message": f"Досье {inn} нет в хранилище (построить - refresh=true)"},
+            status_code=404,
+        )
+
+    metrics.dossier_reads.labels("ok").inc()
+    # Досье могло обновиться между запросами - заголовки по загруженной версии
+    headers = _dossier_headers(inn, record.updated_at, format)
+    if format == "text":
+        return PlainTextResponse(record.text, headers=headers)
+
+    def iso(timestamp: float) -> str:
+        return datetime.fromtimestamp(timestamp).isoformat(timespec="seconds")
+
+    return JSONResponse({
+        "inn": record.inn,
+        "name": record.name,
+        "website": record.website,
+        "updated_at": iso(record.updated_at),
+        "fresh": record.is_fresh(),
+        "text": record.text,
+        "sections": {
+            key: {"text": section["text"], "generated_at": iso(section["generated_at"])}
+            for key, section in record.sections.items()
+        },
+        "sources": {source: iso(entry["fetched_at"]) for source, entry in record.sources.items()},
+    }, headers=headers)
+
+
+async def _refresh_dossier(request: Request, background_tasks: BackgroundTasks, inn: str,
+                           user_id: Optional[str]) -> JSONResponse:
+    """Постановка обновления досье (GET /api/dossier/{inn}?refresh=true)"""
+    key = None
+    try:
+        request_id = request_context.get_request_id()
+        derived = derive_key(user_id, None, inn, supplied=request.headers.get("Idempotency-Key"))
+        repeat = await _repeat_of(derived, "dossier_refresh")
+        if repeat is not None:
+            return JSONResponse({"status": "duplicate", "message": f"Обновление досье {inn} уже запущено", **repeat})
+        key = derived
+
+        decision = await _admit("api", user_id, None)
+        if decision.message:
+            await _notify(user_id, decision.message)
+        if not decision.allowed:
+            await asyncio.to_thread(idempotency.release, key)
+            return JSONResponse({"status": "rejected", "message": decision.message, "request_id": request_id},
+                                status_code=429)
+
+        await _schedule_job(
+            background_tasks,
+            "dossier_refresh",
+            "api",
+            tenant=(user_id, None),
+            available_at=decision.deferred_until,
+            inn=inn,
+            user_id=user_id,
+            request_id=request_id,
+            idempotency_key=key
+        )
+        return JSONResponse({
+            "status": "deferred" if decision.deferred_until else "processing",
+            "message": decision.message or f"Обновление досье {inn} запущено",
+            "request_id": request_id,
+        }, status_code=202)
+
+    except Exception as e:
+        logger.error(f"Ошибка обновления досье {inn}: {e}", exc_info=True)
+        await asyncio.to_thread(idempotency.release, key)
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+
+
+@app.get("/debug/startup")
+async def debug_startup(top: int = 30):
+    """
+    Отчет о холодном старте: вехи запуска, первый запрос, построение сервисов, медленные импорты
+
+    Args:
+        top: Сколько самых медленных импортов показать
+    """
+    return startup_report.report(top)
+
+
+@app.get("/debug/trace/{request_id}")
+async def debug_trace(request_id: str, format: str = "json"):
+    """
+    Waterfall трейса запроса на исследование
+
+    Args:
+        request_id: ID запроса (возвращается webhook/API при постановке задачи)
+        format: json или text
+
+    Returns:
+        Спаны с смещением от начала, длительностью и статусом
+    """
+    spans = await asyncio.to_thread(tracer.load, request_id)
+    if not spans:
+        return JSONResponse({"status": "error", "message": f"Трейс {request_id} не найден"}, status_code=404)
+
+    waterfall = tracer.waterfall(spans)
+    if format == "text":
+        return PlainTextResponse(tracer.render_text(request_id, waterfall))
+
+    return {"request_id": request_id, **waterfall}
+
+
+@app.get("/api/prewarm")
+async def get_prewarm():
+    """Расписание и отчет последнего прогрева досье"""
+    start, end = prewarm_job.next_window(datetime.now())
+    return {
+        "enabled": settings.PREWARM_ENABLED,
+        "running": prewarm_job.running,
+        "next_window": {"start": start.isoformat(), "end": end.isoformat()},
+        "last_report": prewarm_job.last_report,
+    }
+
+
+@app.post("/api/prewarm/run")
+async def run_prewarm(background_tasks: BackgroundTasks):
+    """Внеплановый прогрев досье (без ограничения окном, с бюджетом из настроек)"""
+    # Блокировка захватывается здесь, а не в воркере: ответ 409 надежен и в режиме очереди
+    run_id = await asyncio.to_thread(prewarm_job.acquire)
+    if run_id is None:
+        report = await asyncio.to_thread(lambda: prewarm_job.last_report)
+        return JSONResponse({"status": "already_running", "report": report}, status_code=409)
+    try:
+        await _schedule_job(background_tasks, "prewarm", "prewarm", run_id=run_id)
+    except Exception:
+        await asyncio.to_thread(prewarm_job.release, run_id)
+        raise
+    return {"status": "ok", "run_id": run_id, "message": "Прогрев досье запущен"}
+
+
+@app.get("/api/jobs")
+async def get_jobs():
+    """Режим выполнения исследований и число заданий очереди по статусам"""
+    if not _queued():
+        return {"execution": settings.RESEARCH_EXECUTION}
+    return {"execution": settings.RESEARCH_EXECUTION, "jobs": await asyncio.to_thread(job_queue.counts)}
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """
+    Статус задания очереди: queued, running, done или failed, воркер, попытки, ошибка
+
+    Args:
+        job_id: ID задания (request_id, возвращается webhook/API при постановке)
+    """
+    if not _queued():
+        return JSONResponse(
+            {"status": "error", "message": "Очередь заданий не используется (RESEARCH_EXECUTION=inline)"},
+            status_code=404,
+        )
+    job = await asyncio.to_thread(job_queue.get, job_id)
+    if job is None:
+        return JSONResponse({"status": "error", "message": f"Задание {job_id} не найдено"}, status_code=404)
+    return job.to_dict()
+
+
+@app.get("/api/quotas")
+async def get_quotas(user_id: str = None, portal: str = None):
+    """
+    Расход квот: запросы текущего часа и стоимость за сутки пользователя и портала
+
+    Args:
+        user_id: ID пользователя Битрикс24 (опционально)
+        portal: Домен портала (по умолчанию - портал из BITRIX24_WEBHOOK_URL)
+    """
+    return await asyncio.to_thread(quotas.usage, user_id, portal)
+
+
+@app.get("/api/costs")
+async def get_costs(date_from: str = None, date_to: str = None):
+    """
+    Затраты на токены: итоги по дням, пользователям, этапам и моделям
+
+    Args:
+        date_from: Начальная дата YYYY-MM-DD (опционально)
+        date_to: Конечная дата YYYY-MM-DD (опционально)
+
+    Returns:
+        Итоги из журнала затрат
+    """
+    return await asyncio.to_thread(cost_ledger.aggregate, date_from, date_to)
+
+
 @app.get("/stats")
 async def get_stats():
     """Статистика работы бота"""
-    try:
-        import os
-        import json
-
-        # Читаем feedback_log.jsonl если существует
-        if not os.path.exists("feedback_log.jsonl"):
-            return {
-                "total_feedbacks": 0,
-                "positive": 0,
-                "negative": 0,
-                "feedback_requests": 0
-            }
+    return await asyncio.to_thread(feedback_stats.summary)
 
-        feedbacks = {"positive": 0, "negative": 0, "feedback": 0}
-
-        with open("feedback_log.jsonl", "r", encoding="utf-8") as f:
-            for line in f:
-                try:
-                    entry = json.loads(line)
-                    feedback_type = entry.get("feedback", "")
-                    if feedback_type in feedbacks:
-                        feedbacks[feedback_type] += 1
-                except:
-                    continue
-
-        return {
-            "total_feedbacks": sum(feedbacks.values()),
-            "positive": feedbacks["positive"],
-            "negative": feedbacks["negative"],
-            "feedback_requests": feedbacks["feedback"]
-        }
 
-    except Exception as e:
-        logger.error(f"Ошибка получения статистики: {e}")
-        return {"error": str(e)}
+@app.get("/stats/company/{company}")
+async def get_company_stats(company: str):
+    """Оценки досье одной компании (ИНН или название)"""
+    stats = await asyncio.to_thread(feedback_stats.company, company)
+    if stats is None:
+        return JSONResponse(status_code=404, content={"error": "Оценок для компании нет"})
+    return stats
+
+
+@app.get("/api/feedback")
+async def get_feedback(company: str = None, date_from: str = None, date_to: str = None, limit: int = 100):
+    """
+    Оценки досье с request_id - для сопоставления качества с трейсами и затратами
+
+    Args:
+        company: ИНН или название компании (без него - все компании за период)
+        date_from: Начало периода YYYY-MM-DD (включительно)
+        date_to: Конец периода YYYY-MM-DD (включительно)
+        limit: Максимум записей
+    """
+    if company:
+        return await asyncio.to_thread(feedback_store.for_company, company, date_from, date_to, limit)
+    return await asyncio.to_thread(feedback_store.for_period, date_from, date_to, limit)
+
+
+@app.get("/stats/days")
+async def get_daily_stats(date_from: str = None, date_to: str = None):
+    """
+    Оценки досье по дням
+
+    Args:
+        date_from: Начало периода YYYY-MM-DD (включительно)
+        date_to: Конец периода YYYY-MM-DD (включительно)
+    """
+    return await asyncio.to_thread(feedback_stats.days, date_from, date_to)
+
+
+startup_report.mark("app_imported")
 
 
 if __name__ == "__main__":
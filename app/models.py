@@ -14,6 +14,9 @@ class CompanyResearchRequest(BaseModel):
     company_name: Optional[str] = Field(None, description="Название компании")
     inn: Optional[str] = Field(None, description="ИНН компании (10 или 12 цифр)")
     user_id: str = Field(..., description="ID пользователя Битрикс24 для отправки результата")
+    idempotency_key: Optional[str] = Field(
+        None, description="Ключ идемпотентности (по умолчанию - из пользователя, ИНН и названия)"
+    )
 
     class Config:
         json_schema_extra = {
@@ -27,6 +30,6 @@ class CompanyResearchRequest(BaseModel):
 
 class CompanyResearchResponse(BaseModel):
     """Ответ на запрос исследования компании"""
-    status: str = Field(..., description="Статус: success, processing, error")
+    status: str = Field(..., description="Статус: success, processing, duplicate, deferred, rejected, error")
     message: str = Field(..., description="Сообщение о статусе")
-    task_id: Optional[str] = Field(None, description="ID задачи (если асинхронная обработка)")
+    task_id: Optional[str] = Field(None, description="ID задачи (если асинхронная обработка; для duplicate - исходной)")
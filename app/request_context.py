@@ -0,0 +1,81 @@
+"""
+Контекст текущего запроса на исследование (request_id, пользователь, сделка, ИНН)
+
+Хранится в contextvars: доступен во всех вызовах внутри фоновой задачи,
+включая код, выполняемый в потоках через asyncio.to_thread.
+"""
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
+from typing import Optional
+
+
+@dataclass(frozen=True)
+class RequestContext:
+    """Данные запроса, которыми помечаются трейсы, логи и учет затрат"""
+    request_id: str
+    user_id: Optional[str] = None
+    deal_id: Optional[str] = None
+    inn: Optional[str] = None
+    source: Optional[str] = None  # chat, robot, api, prewarm, prefetch
+    portal: Optional[str] = None  # домен портала Битрикс24 (auth[domain])
+
+
+_current: ContextVar[Optional[RequestContext]] = ContextVar("request_context", default=None)
+
+
+def new_request_id() -> str:
+    """Генерация нового ID запроса"""
+    return uuid.uuid4().hex[:16]
+
+
+def current() -> Optional[RequestContext]:
+    """Текущий контекст запроса (None вне обработки запроса)"""
+    return _current.get()
+
+
+def get_request_id() -> Optional[str]:
+    """ID текущего запроса"""
+    ctx = _current.get()
+    return ctx.request_id if ctx else None
+
+
+@contextmanager
+def bind(request_id: Optional[str] = None, **fields):
+    """
+    Установка контекста запроса на время блока
+
+    Если контекст уже есть - дополняет его переданными полями.
+
+    Args:
+        request_id: ID запроса (если не задан - берется текущий или генерируется новый)
+        **fields: user_id, deal_id, inn, source, portal
+    """
+    parent = _current.get()
+    fields = {k: v for k, v in fields.items() if v is not None}
+    if parent:
+        ctx = replace(parent, **fields)
+        if request_id:
+            ctx = replace(ctx, request_id=request_id)
+    else:
+        ctx = RequestContext(request_id=request_id or new_request_id(), **fields)
+
+    token = _current.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _current.reset(token)
+
+
+def update(**fields):
+    """
+    Дополнение текущего контекста (например, когда ИНН стал известен по ходу пайплайна)
+
+    Args:
+        **fields: user_id, deal_id, inn, source
+    """
+    ctx = _current.get()
+    fields = {k: v for k, v in fields.items() if v is not None}
+    if ctx and fields:
+        _current.set(replace(ctx, **fields))
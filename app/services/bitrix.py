@@ -3,9 +3,11 @@ Bitrix24 API сервис для отправки сообщений в чат
 """
 import requests
 import logging
-from typing import List, Dict, Optional
+from typing import Iterator, List, Dict, Optional
 
 from app.config import settings
+from app.services import upstream
+from app.lazy import Lazy
 
 logger = logging.getLogger(__name__)
 
@@ -101,10 +103,10 @@ class BitrixService:
 
                 if use_post:
                     logger.debug(f"Отправка части {i+1}/{len(message_parts)} через POST")
-                    response = requests.post(url, data=params_part, timeout=30)
+                    response = upstream.request("bitrix", "imbot.message.add", "POST", url, data=params_part, timeout=30)
                 else:
                     logger.debug(f"Отправка части {i+1}/{len(message_parts)} через GET")
-                    response = requests.get(url, params=params_part, timeout=30)
+                    response = upstream.request("bitrix", "imbot.message.add", "GET", url, params=params_part, timeout=30)
 
                 response.raise_for_status()
 
@@ -131,16 +133,18 @@ class BitrixService:
             logger.error(f"URL: {url}")
             raise
 
-    def create_feedback_keyboard(self, company_id: str) -> List[List[Dict]]:
+    def create_feedback_keyboard(self, company_id: str, request_id: Optional[str] = None) -> List[List[Dict]]:
         """
         Создание клавиатуры с кнопками оценки для Битрикс24
 
         Args:
             company_id: ИНН или название компании (для передачи в callback)
+            request_id: ID запроса, по которому построено досье (оценка связывается с трейсом)
 
         Returns:
             Клавиатура в формате Битрикс24
         """
+        command_params = f"company={company_id}&request_id={request_id}" if request_id else company_id
         # Формат клавиатуры Битрикс24: массив рядов, каждый ряд - массив кнопок
         return [
             [
@@ -148,7 +152,7 @@ class BitrixService:
                     "TEXT": "👍 Полезно",
                     "BOT_ID": self.bot_id,
                     "COMMAND": "positive",
-                    "COMMAND_PARAMS": company_id,
+                    "COMMAND_PARAMS": command_params,
                     "DISPLAY": "LINE",
                     "BG_COLOR": "#29c75f",
                     "TEXT_COLOR": "#fff"
@@ -159,7 +163,7 @@ class BitrixService:
                     "TEXT": "👎 Не полезно",
                     "BOT_ID": self.bot_id,
                     "COMMAND": "negative",
-                    "COMMAND_PARAMS": company_id,
+                    "COMMAND_PARAMS": command_params,
                     "DISPLAY": "LINE",
                     "BG_COLOR": "#ff4d4d",
                     "TEXT_COLOR": "#fff"
@@ -170,7 +174,7 @@ class BitrixService:
                     "TEXT": "💬 Оставить отзыв",
                     "BOT_ID": self.bot_id,
                     "COMMAND": "feedback",
-                    "COMMAND_PARAMS": company_id,
+                    "COMMAND_PARAMS": command_params,
                     "DISPLAY": "LINE",
                     "BG_COLOR": "#2196F3",
                     "TEXT_COLOR": "#fff"
@@ -212,7 +216,7 @@ class BitrixService:
         try:
             logger.info(f"Добавление комментария к сделке {deal_id}")
 
-            response = requests.post(url, json=params, timeout=30)
+            response = upstream.request("bitrix", "crm.timeline.comment.add", "POST", url, json=params, timeout=30)
             response.raise_for_status()
 
             result = response.json()
@@ -228,6 +232,95 @@ class BitrixService:
             logger.error(f"Ошибка добавления комментария к сделке {deal_id}: {e}")
             raise
 
+    def _list(self, method: str, params: Dict) -> Iterator[Dict]:
+        """
+        Постраничная выборка списочного метода CRM (по 50 записей, параметр start)
+
+        Args:
+            method: Метод REST (crm.deal.list, crm.company.list, ...)
+            params: filter, select, order
+
+        Yields:
+            Записи всех страниц
+        """
+        url = f"{self.webhook_url}/{method}.json"
+        start = 0
+        while True:
+            response = upstream.request("bitrix", method, "POST", url, json={**params, "start": start}, timeout=30)
+            response.raise_for_status()
+            result = response.json()
+            if result.get("error"):
+                raise Exception(f"Bitrix24 API error: {result.get('error_description', result.get('error'))}")
+            yield from result.get("result") or []
+            if result.get("next") is None:
+                return
+            start = result["next"]
+
+    def list_open_deals(self, inn_field: str) -> Iterator[Dict]:
+        """
+        Открытые сделки (недавно измененные первыми)
+
+        Args:
+            inn_field: Пользовательское поле сделки с ИНН (UF_CRM_...)
+
+        Yields:
+            Сделки с ID, TITLE, COMPANY_ID и полем ИНН
+        """
+        yield from self._list("crm.deal.list", {
+            "filter": {"CLOSED": "N"},
+            "select": ["ID", "TITLE", "COMPANY_ID", inn_field],
+            "order": {"DATE_MODIFY": "DESC"},
+        })
+
+    def get_deal(self, deal_id: str) -> Dict:
+        """
+        Сделка CRM по ID (crm.deal.get, все поля включая пользовательские)
+
+        Args:
+            deal_id: ID сделки
+
+        Returns:
+            Поля сделки
+        """
+        url = f"{self.webhook_url}/crm.deal.get.json"
+        response = upstream.request("bitrix", "crm.deal.get", "POST", url, json={"id": deal_id}, timeout=30)
+        response.raise_for_status()
+        result = response.json()
+        if result.get("error"):
+            raise Exception(f"Bitrix24 API error: {result.get('error_description', result.get('error'))}")
+        return result.get("result") or {}
+
+    def get_companies(self, company_ids: List[str]) -> Dict[str, Dict]:
+        """
+        Компании CRM с ИНН из реквизитов
+
+        Args:
+            company_ids: ID компаний
+
+        Returns:
+            ID компании -> {"title", "website", "inn"}
+        """
+        companies: Dict[str, Dict] = {}
+        for i in range(0, len(company_ids), 50):
+            chunk = company_ids[i:i + 50]
+            for company in self._list("crm.company.list", {"filter": {"ID": chunk}, "select": ["ID", "TITLE", "WEB"]}):
+                websites = company.get("WEB") or []
+                companies[str(company["ID"])] = {
+                    "title": company.get("TITLE"),
+                    "website": websites[0].get("VALUE") if websites else None,
+                    "inn": None,
+                }
+            # ИНН компании хранится в реквизитах (ENTITY_TYPE_ID 4 - компания)
+            requisites = self._list("crm.requisite.list", {
+                "filter": {"ENTITY_TYPE_ID": 4, "ENTITY_ID": chunk},
+                "select": ["ENTITY_ID", "RQ_INN"],
+            })
+            for requisite in requisites:
+                company = companies.get(str(requisite.get("ENTITY_ID")))
+                if company is not None and requisite.get("RQ_INN") and not company["inn"]:
+                    company["inn"] = requisite["RQ_INN"]
+        return companies
+
 
 # Глобальный экземпляр сервиса
-bitrix_service = BitrixService()
+bitrix_service = Lazy(BitrixService, "bitrix_service")
@@ -0,0 +1,230 @@
+"""
+Запись и воспроизведение обменов с внешними API (кассеты) для детерминированных бенчмарков
+
+Режимы (CASSETTE_MODE):
+- off    - обычная работа
+- record - все обмены внутри create_company_dossier пишутся в кассету компании
+- replay - ответы отдаются из кассеты с исходной задержкой * CASSETTE_LATENCY_SCALE
+
+Кассета - gzip JSON в CASSETTE_DIR, одна на компанию. Секреты (URL вебхука Битрикс24,
+заголовки авторизации) не сохраняются: запрос идентифицируется хэшем.
+"""
+import os
+import re
+import gzip
+import json
+import time
+import base64
+import hashlib
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlencode
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from app.config import settings
+from app.lazy import Lazy
+
+logger = logging.getLogger(__name__)
+
+
+class CassetteMiss(requests.exceptions.RequestException):
+    """В кассете нет записанного ответа для запроса"""
+
+
+def request_key(method: str, url: str, kwargs: Dict) -> str:
+    """
+    Хэш запроса: метод, URL, query и тело
+
+    Args:
+        method: HTTP метод
+        url: URL
+        kwargs: Аргументы requests (params, json, data)
+
+    Returns:
+        Короткий хэш
+    """
+    parts = [method.upper(), url]
+    if kwargs.get("params"):
+        parts.append(urlencode(sorted(dict(kwargs["params"]).items())))
+    if kwargs.get("json") is not None:
+        parts.append(json.dumps(kwargs["json"], sort_keys=True, ensure_ascii=False))
+    if kwargs.get("data") is not None:
+        data = kwargs["data"]
+        parts.append(urlencode(sorted(data.items())) if isinstance(data, dict) else str(data))
+    return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()[:20]
+
+
+def cassette_name(*identifiers: Optional[str]) -> str:
+    """Имя файла кассеты из ИНН / названия / сайта"""
+    raw = next((i for i in identifiers if i), "unknown")
+    return re.sub(r"[^\w.-]+", "_", raw.strip().lower())[:80] or "unknown"
+
+
+class Cassette:
+    """Набор обменов одной компании"""
+
+    def __init__(self, name: str, path: str, replaying: bool):
+        self.name = name
+        self.path = path
+        self.replaying = replaying
+        self.exchanges = []
+        self._lock = threading.Lock()
+        self._by_key: Dict[str, deque] = {}
+        self._by_operation: Dict[Tuple[str, str], deque] = {}
+
+        if replaying:
+            self._load()
+
+    def _load(self):
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                self.exchanges = json.load(f)["exchanges"]
+        except FileNotFoundError:
+            logger.warning(f"Кассета {self.path} не найдена - все запросы будут промахами")
+            return
+        for exchange in self.exchanges:
+            self._by_key.setdefault(exchange["key"], deque()).append(exchange)
+            self._by_operation.setdefault((exchange["upstream"], exchange["operation"]), deque()).append(exchange)
+
+    def save(self):
+        """Сохранение записанных обменов"""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with gzip.open(self.path, "wt", encoding="utf-8") as f:
+            json.dump({"name": self.name, "recorded_at": int(time.time()), "exchanges": self.exchanges}, f, ensure_ascii=False)
+        logger.info(f"Кассета {self.name}: записано {len(self.exchanges)} обменов")
+
+    def record(self, upstream: str, operation: str, key: str, elapsed: float, payload: Dict):
+        """Добавление обмена в кассету"""
+        with self._lock:
+            self.exchanges.append({
+                "upstream": upstream,
+                "operation": operation,
+                "key": key,
+                "elapsed": round(elapsed, 4),
+                **payload,
+            })
+
+    def take(self, upstream: str, operation: str, key: str) -> Dict:
+        """
+        Следующий записанный обмен: сначала точное совпадение запроса, затем по операции
+
+        Запасной вариант по операции нужен для запросов, тело которых меняется между
+        прогонами (например, даты в промпте поиска новостей).
+        """
+        with self._lock:
+            exact = self._by_key.get(key)
+            by_operation = self._by_operation.get((upstream, operation))
+            exchange = None
+            if exact:
+                exchange = exact.popleft()
+                if by_operation and exchange in by_operation:
+                    by_operation.remove(exchange)
+            elif by_operation:
+                exchange = by_operation.popleft()
+                same_key = self._by_key.get(exchange["key"])
+                if same_key and exchange in same_key:
+                    same_key.remove(exchange)
+        if exchange is None:
+            raise CassetteMiss(f"Кассета {self.name}: нет ответа для {upstream}.{operation}")
+
+        delay = exchange["elapsed"] * settings.CASSETTE_LATENCY_SCALE
+        if delay > 0:
+            time.sleep(delay)
+        return exchange
+
+
+_active: ContextVar[Optional[Cassette]] = ContextVar("active_cassette", default=None)
+
+
+class CassetteRecorder:
+    """Выбор активной кассеты и преобразование обменов"""
+
+    def __init__(self, mode: str, directory: str):
+        self.mode = mode
+        self.directory = directory
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode in ("record", "replay")
+
+    def active(self) -> Optional[Cassette]:
+        return _active.get()
+
+    @contextmanager
+    def use(self, name: str):
+        """
+        Активная кассета на время блока. Вложенные вызовы используют внешнюю кассету.
+
+        Args:
+            name: Имя кассеты (см. cassette_name)
+        """
+        if not self.enabled or _active.get() is not None:
+            yield _active.get()
+            return
+
+        cassette = Cassette(name, os.path.join(self.directory, f"{name}.json.gz"), self.mode == "replay")
+        token = _active.set(cassette)
+        try:
+            yield cassette
+        finally:
+            _active.reset(token)
+            if self.mode == "record":
+                try:
+                    cassette.save()
+                except OSError as e:
+                    logger.error(f"Ошибка сохранения кассеты {name}: {e}")
+
+    def record_response(self, cassette: Cassette, upstream: str, operation: str, key: str,
+                        response: requests.Response, elapsed: float):
+        """Запись HTTP ответа"""
+        try:
+            body = {"text": response.content.decode("utf-8")}
+        except UnicodeDecodeError:
+            body = {"base64": base64.b64encode(response.content).decode("ascii")}
+        cassette.record(upstream, operation, key, elapsed, {
+            "status": response.status_code,
+            "content_type": response.headers.get("content-type", ""),
+            **body,
+        })
+
+    def record_error(self, cassette: Cassette, upstream: str, operation: str, key: str,
+                     error: requests.exceptions.RequestException, elapsed: float):
+        """Запись сетевой ошибки (timeout, обрыв соединения)"""
+        kind = "timeout" if isinstance(error, requests.exceptions.Timeout) else "connection_error"
+        cassette.record(upstream, operation, key, elapsed, {"error": kind})
+
+    def replay_response(self, cassette: Cassette, upstream: str, operation: str, key: str, url: str) -> requests.Response:
+        """Сборка requests.Response из записанного обмена (или повтор записанной ошибки)"""
+        exchange = cassette.take(upstream, operation, key)
+        if exchange.get("error") == "timeout":
+            raise requests.exceptions.Timeout(f"Кассета {cassette.name}: записанный timeout {upstream}.{operation}")
+        if exchange.get("error"):
+            raise requests.exceptions.ConnectionError(f"Кассета {cassette.name}: записанная ошибка {upstream}.{operation}")
+        response = requests.Response()
+        response.status_code = exchange["status"]
+        response.url = url
+        response.headers = CaseInsensitiveDict({"content-type": exchange.get("content_type", "")})
+        if "base64" in exchange:
+            response._content = base64.b64decode(exchange["base64"])
+        else:
+            response._content = exchange["text"].encode("utf-8")
+        response.encoding = "utf-8"
+        return response
+
+    def record_value(self, cassette: Cassette, upstream: str, operation: str, key: str, value: Any, elapsed: float):
+        """Запись результата вызова не через requests (LLM через LangChain)"""
+        cassette.record(upstream, operation, key, elapsed, {"value": value})
+
+    def replay_value(self, cassette: Cassette, upstream: str, operation: str, key: str) -> Any:
+        """Записанный результат вызова не через requests"""
+        return cassette.take(upstream, operation, key)["value"]
+
+
+# Глобальный экземпляр
+cassettes = Lazy(lambda: CassetteRecorder(settings.CASSETTE_MODE, settings.CASSETTE_DIR), "cassettes")
@@ -6,6 +6,7 @@ from typing import Dict, List, Optional, Tuple
 
 from app.services.perplexity import perplexity_service
 from app.services.dadata import dadata_service
+from app.lazy import Lazy
 
 logger = logging.getLogger(__name__)
 
@@ -94,4 +95,4 @@ class CompanySearchService:
 
 
 # Глобальный экземпляр сервиса
-company_search_service = CompanySearchService()
+company_search_service = Lazy(CompanySearchService, "company_search_service")
@@ -0,0 +1,194 @@
+"""
+Учет токенов и стоимости вызовов LLM (Perplexity и генерация досье)
+
+Журнал - append-only CSV без заголовка, одна строка на вызов.
+"""
+import csv
+import io
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from app.config import settings
+from app import request_context
+from app.lazy import Lazy
+from app.services.quotas import quotas
+
+logger = logging.getLogger(__name__)
+
+LEDGER_FIELDS = (
+    "ts",
+    "request_id",
+    "user_id",
+    "deal_id",
+    "inn",
+    "stage",
+    "model",
+    "prompt_tokens",
+    "completion_tokens",
+    "cost_usd",
+)
+
+# Накопители затрат текущей задачи (см. CostLedger.spend)
+_spend: ContextVar[Optional[List[float]]] = ContextVar("cost_spend", default=None)
+
+
+class CostLedger:
+    """Журнал затрат на токены"""
+
+    def __init__(self, path: str, prices: Dict[str, list]):
+        self.path = path
+        self.prices = prices
+        self._lock = threading.Lock()
+
+    def compute_cost(self, model: str, usage: Dict) -> float:
+        """
+        Стоимость вызова в USD
+
+        OpenRouter возвращает точную стоимость в usage.cost (включая плату за поиск
+        у Perplexity); если ее нет - считаем по прайсу MODEL_PRICES.
+
+        Args:
+            model: Модель
+            usage: Словарь usage из ответа
+
+        Returns:
+            Стоимость в USD
+        """
+        if usage.get("cost") is not None:
+            return float(usage["cost"])
+
+        price = self.prices.get(model)
+        if not price:
+            return 0.0
+        prompt_price, completion_price = price
+        return (
+            (usage.get("prompt_tokens") or 0) * prompt_price
+            + (usage.get("completion_tokens") or 0) * completion_price
+        ) / 1_000_000
+
+    @contextmanager
+    def spend(self):
+        """
+        Сумма затрат вызовов внутри блока (в том числе в потоках asyncio.to_thread)
+
+        Yields:
+            Список из одного элемента - накопленная стоимость в USD
+        """
+        total = [0.0]
+        token = _spend.set(total)
+        try:
+            yield total
+        finally:
+            _spend.reset(token)
+
+    def record(self, stage: str, model: str, usage: Optional[Dict]) -> Optional[float]:
+        """
+        Запись вызова в журнал с тегами текущего запроса (user_id, deal_id, ИНН)
+
+        Args:
+            stage: Тип поиска / этап (identification, executives, llm, ...)
+            model: Модель
+            usage: Словарь usage из ответа OpenRouter
+
+        Returns:
+            Стоимость вызова в USD (None если usage пустой)
+        """
+        if not usage:
+            return None
+
+        cost = self.compute_cost(model, usage)
+        total = _spend.get()
+        if total is not None:
+            total[0] += cost
+        quotas.charge(cost)
+        ctx = request_context.current()
+        row = (
+            int(time.time()),
+            ctx.request_id if ctx else "",
+            (ctx.user_id or "") if ctx else "",
+            (ctx.deal_id or "") if ctx else "",
+            (ctx.inn or "") if ctx else "",
+            stage,
+            model,
+            usage.get("prompt_tokens") or 0,
+            usage.get("completion_tokens") or 0,
+            f"{cost:.6f}",
+        )
+
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow(row)
+        try:
+            with self._lock, open(self.path, "a", encoding="utf-8", newline="") as f:
+                f.write(buffer.getvalue())
+        except OSError as e:
+            logger.error(f"Ошибка записи в журнал затрат: {e}")
+
+        return cost
+
+    def aggregate(self, date_from: Optional[str] = None, date_to: Optional[str] = None) -> Dict:
+        """
+        Итоги по дням, пользователям, этапам и моделям
+
+        Args:
+            date_from: Начальная дата YYYY-MM-DD (включительно)
+            date_to: Конечная дата YYYY-MM-DD (включительно)
+
+        Returns:
+            Словарь с итогами (calls, prompt_tokens, completion_tokens, cost_usd)
+        """
+        groups = {"by_day": {}, "by_user": {}, "by_stage": {}, "by_model": {}}
+        total = _empty_totals()
+
+        try:
+            with open(self.path, "r", encoding="utf-8", newline="") as f:
+                for values in csv.reader(f):
+                    if len(values) != len(LEDGER_FIELDS):
+                        continue
+                    entry = dict(zip(LEDGER_FIELDS, values))
+                    try:
+                        day = datetime.fromtimestamp(int(entry["ts"])).strftime("%Y-%m-%d")
+                        prompt_tokens = int(entry["prompt_tokens"])
+                        completion_tokens = int(entry["completion_tokens"])
+                        cost = float(entry["cost_usd"])
+                    except ValueError:
+                        continue
+
+                    if (date_from and day < date_from) or (date_to and day > date_to):
+                        continue
+
+                    keys = {
+                        "by_day": day,
+                        "by_user": entry["user_id"] or "unknown",
+                        "by_stage": entry["stage"],
+                        "by_model": entry["model"],
+                    }
+                    for group, key in keys.items():
+                        _add(groups[group].setdefault(key, _empty_totals()), prompt_tokens, completion_tokens, cost)
+                    _add(total, prompt_tokens, completion_tokens, cost)
+        except FileNotFoundError:
+            pass
+
+        for totals in [total] + [t for group in groups.values() for t in group.values()]:
+            totals["cost_usd"] = round(totals["cost_usd"], 4)
+
+        return {"total": total, **groups}
+
+
+def _empty_totals() -> Dict:
+    return {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0}
+
+
+def _add(totals: Dict, prompt_tokens: int, completion_tokens: int, cost: float):
+    totals["calls"] += 1
+    totals["prompt_tokens"] += prompt_tokens
+    totals["completion_tokens"] += completion_tokens
+    totals["cost_usd"] += cost
+
+
+# Глобальный экземпляр журнала
+cost_ledger = Lazy(lambda: CostLedger(settings.COST_LEDGER_PATH, settings.MODEL_PRICES), "cost_ledger")
@@ -6,6 +6,8 @@ import logging
 from typing import Optional, Dict
 
 from app.config import settings
+from app.services import upstream
+from app.lazy import Lazy
 
 logger = logging.getLogger(__name__)
 
@@ -15,7 +17,7 @@ class DaDataService:
 
     def __init__(self):
         self.api_key = settings.DADATA_API_KEY
-        self.base_url = "https://suggestions.dadata.ru/suggestions/api/4_1/rs"
+        self.base_url = settings.DADATA_BASE_URL
 
     def find_company_by_inn(self, inn: str) -> Optional[Dict]:
         """
@@ -34,7 +36,8 @@ class DaDataService:
         }
 
         try:
-            response = requests.post(
+            response = upstream.request(
+                "dadata", "findById", "POST",
                 url,
                 json={"query": inn},
                 headers=headers,
@@ -73,7 +76,8 @@ class DaDataService:
         try:
             logger.info(f"Поиск компании по названию: {company_name}")
 
-            response = requests.post(
+            response = upstream.request(
+                "dadata", "suggest", "POST",
                 url,
                 json={"query": company_name, "count": 5},
                 headers=headers,
@@ -137,4 +141,4 @@ class DaDataService:
 
 
 # Глобальный экземпляр сервиса
-dadata_service = DaDataService()
+dadata_service = Lazy(DaDataService, "dadata_service")
@@ -0,0 +1,64 @@
+"""
+Срок выполнения запроса на досье (deadline) в контексте выполнения
+
+Срок задается на входе в create_company_dossier (по точке входа: чат, робот сделки, ...)
+и сужается бюджетом этапа. upstream.request ограничивает им таймаут каждого HTTP запроса,
+поэтому запрос, начатый в потоке этапа, не переживает бюджет этапа надолго.
+Контекст копируется в asyncio.to_thread, срок виден и в потоках этапов.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional, Tuple, Union
+
+# Момент (time.monotonic()), к которому запрос должен завершиться
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+# Минимальный таймаут HTTP запроса при почти истекшем сроке
+MIN_TIMEOUT = 1.0
+
+
+@contextmanager
+def within(seconds: Optional[float]):
+    """
+    Срок выполнения блока: не позже seconds от текущего момента и не позже внешнего срока
+
+    Args:
+        seconds: Бюджет в секундах (None - без ограничения, действует внешний срок)
+    """
+    current = _deadline.get()
+    if seconds is not None:
+        at = time.monotonic() + seconds
+        current = at if current is None else min(current, at)
+    token = _deadline.set(current)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """Секунды до срока (может быть отрицательным; None - срок не задан)"""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+def cap(timeout: Union[None, float, Tuple[float, float]]) -> Union[None, float, Tuple[float, float]]:
+    """
+    Таймаут HTTP запроса с учетом срока
+
+    Args:
+        timeout: Таймаут requests, заданный вызывающим кодом (число или (connect, read))
+
+    Returns:
+        Меньшее из timeout и остатка срока (не меньше MIN_TIMEOUT)
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    left = max(left, MIN_TIMEOUT)
+    if timeout is None:
+        return left
+    if isinstance(timeout, tuple):
+        return tuple(min(part, left) for part in timeout)
+    return min(timeout, left)
@@ -0,0 +1,236 @@
+"""
+История досье с полнотекстовым поиском (SQLite FTS5)
+
+Каждое построенное досье сохраняется с метаданными: ИНН, название, сайт, дата, кто запросил
+(пользователь, сделка, источник, request_id). В отличие от хранилища досье (последняя версия
+по ИНН) здесь остаются все версии, в том числе досье компаний без ИНН. Поиск - по основам слов
+(app/services/russian_stemmer.py) в индексе FTS5 без копии текста, ранжирование bm25 с
+повышенным весом названия и сайта. Основа слова запроса совпадает как префикс ("логистик" -
+"логистика", "логистики"); у прилагательных на -ическ-/-ск- основы стеммера с существительным
+различаются ("логистическ" и "логистик", "казанск" и "казан"), поэтому слово запроса ищется
+в обоих видах (_variants): "что мы знаем о логистических компаниях" находит досье со словами
+"логистика", "логистической" без нового исследования.
+"""
+import re
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from app import request_context
+from app.config import settings
+from app.lazy import Lazy
+from app.services.feedback_store import connect
+from app.services.russian_stemmer import stem, tokens
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dossier_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    inn TEXT,
+    name TEXT,
+    website TEXT,
+    text TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    user_id TEXT,
+    deal_id TEXT,
+    source TEXT,
+    request_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_dossier_history_inn ON dossier_history(inn, id);
+CREATE INDEX IF NOT EXISTS idx_dossier_history_created ON dossier_history(created_at);
+CREATE VIRTUAL TABLE IF NOT EXISTS dossier_history_fts USING fts5(
+    name, website, body, content='', tokenize='unicode61 remove_diacritics 2'
+);
+"""
+
+# Вес совпадений bm25 по столбцам индекса: название, сайт, текст
+WEIGHTS = (10.0, 5.0, 1.0)
+SNIPPET_CHARS = 200
+# Служебные слова запроса (предлоги, союзы, "что мы знаем о"): с префиксным поиском совпадают со всем
+STOPWORDS = {
+    stem(word) for word in
+    "в во на о об обо и или а но с со по для к ко у из от до за про при над под что как мы знаем знаете есть".split()
+}
+
+_LINE = re.compile(r"[^\n]+")
+
+
+def _indexed(inn: Optional[str], name: Optional[str], website: Optional[str], text: str) -> tuple:
+    """Столбцы индекса: основы слов названия (с ИНН), сайта и текста"""
+    return " ".join(tokens(f"{inn or ''} {name or ''}")), " ".join(tokens(website)), " ".join(tokens(text))
+
+
+def _terms(query: str) -> List[str]:
+    """Основы значимых слов запроса (без служебных и однобуквенных)"""
+    return [term for term in dict.fromkeys(tokens(query)) if len(term) > 1 and term not in STOPWORDS]
+
+
+def _variants(term: str) -> tuple:
+    """
+    Основы, по которым ищется слово запроса: сама основа и парная основа прилагательного
+    или существительного ("логистическ" <-> "логистик", "казанск" -> "казан")
+    """
+    if term.endswith("ическ"):
+        return term, term[:-5] + "ик"
+    if term.endswith("ик") and len(term) > 4:
+        return term, term[:-2] + "ическ"
+    if term.endswith("ск") and len(term) > 5:
+        return term, term[:-2]
+    return (term,)
+
+
+def _match(terms: List[str]) -> Optional[str]:
+    """Запрос FTS5: все слова, префиксное совпадение любой из основ слова"""
+    if not terms:
+        return None
+    return " AND ".join(
+        "(" + " OR ".join(f'"{variant}"*' for variant in _variants(term)) + ")" for term in terms
+    )
+
+
+def _snippet(text: str, terms: List[str]) -> str:
+    """Первая строка текста со словом запроса (обрезанная до SNIPPET_CHARS)"""
+    for line in _LINE.findall(text):
+        if any(word.startswith(variant) for word in tokens(line) for term in terms for variant in _variants(term)):
+            line = line.strip()
+            return line if len(line) <= SNIPPET_CHARS else line[:SNIPPET_CHARS].rstrip() + "…"
+    return text.strip()[:SNIPPET_CHARS]
+
+
+class DossierHistory:
+    """Все версии досье и полнотекстовый поиск по ним"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path)
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(SCHEMA)
+                    self._backfill(conn)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _backfill(self, conn: sqlite3.Connection):
+        """Перенос сохраненных досье (хранилище по ИНН) в пустую историю при первом запуске"""
+        if conn.execute("SELECT 1 FROM dossier_history LIMIT 1").fetchone():
+            return
+        exists = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dossiers'").fetchone()
+        if not exists:
+            return
+        rows = conn.execute("SELECT inn, name, website, text, updated_at FROM dossiers").fetchall()
+        with conn:
+            for row in rows:
+                self._insert(conn, row["inn"], row["name"], row["website"], row["text"], row["updated_at"], {})
+        if rows:
+            logger.info(f"В историю досье перенесено {len(rows)} сохраненных досье")
+
+    @staticmethod
+    def _insert(conn: sqlite3.Connection, inn: Optional[str], name: Optional[str], website: Optional[str],
+                text: str, created_at: float, meta: Dict) -> int:
+        cursor = conn.execute(
+            "INSERT INTO dossier_history (inn, name, website, text, created_at, user_id, deal_id, source, request_id)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (inn, name, website, text, created_at,
+             meta.get("user_id"), meta.get("deal_id"), meta.get("source"), meta.get("request_id")),
+        )
+        conn.execute(
+            "INSERT INTO dossier_history_fts (rowid, name, website, body) VALUES (?, ?, ?, ?)",
+            (cursor.lastrowid, *_indexed(inn, name, website, text)),
+        )
+        return cursor.lastrowid
+
+    def add(self, inn: Optional[str], name: Optional[str], website: Optional[str], text: str) -> Optional[int]:
+        """
+        Запись досье в историю с метаданными текущего запроса (пользователь, сделка, источник)
+
+        Досье, совпадающее с последней версией по тому же ИНН (ответ из хранилища), не дублируется.
+
+        Returns:
+            ID записи или None (не записано)
+        """
+        ctx = request_context.current()
+        meta = {
+            "user_id": ctx.user_id if ctx else None,
+            "deal_id": ctx.deal_id if ctx else None,
+            "source": ctx.source if ctx else None,
+            "request_id": ctx.request_id if ctx else None,
+        }
+        try:
+            conn = self._conn()
+            with conn:
+                if inn:
+                    last = conn.execute(
+                        "SELECT text FROM dossier_history WHERE inn = ? ORDER BY id DESC LIMIT 1", (inn,)
+                    ).fetchone()
+                    if last is not None and last["text"] == text:
+                        return None
+                return self._insert(conn, inn, name, website, text, time.time(), meta)
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи досье {inn or name} в историю {self.path}: {e}")
+            return None
+
+    def search(self, query: str, limit: int = 10, inn: Optional[str] = None,
+               date_from: Optional[str] = None, date_to: Optional[str] = None, full: bool = False) -> List[Dict]:
+        """
+        Поиск по истории досье
+
+        Args:
+            query: Слова запроса (название, ИНН, сайт, отрасль, технологии - любые слова досье)
+            limit: Сколько досье вернуть
+            inn: Только досье компании с этим ИНН
+            date_from: Не раньше даты (YYYY-MM-DD)
+            date_to: Не позже даты (YYYY-MM-DD, включительно)
+            full: Вернуть полный текст досье
+
+        Returns:
+            Досье от наиболее релевантных: id, inn, name, website, created_at, user_id, deal_id,
+            source, request_id, snippet (строка со словом запроса), score (bm25, меньше - лучше)
+        """
+        terms = _terms(query)
+        match = _match(terms)
+        if match is None:
+            return []
+        sql = (
+            "SELECT h.*, bm25(dossier_history_fts, ?, ?, ?) AS score FROM dossier_history_fts"
+            " JOIN dossier_history h ON h.id = dossier_history_fts.rowid WHERE dossier_history_fts MATCH ?"
+        )
+        params: list = [*WEIGHTS, match]
+        if inn:
+            sql += " AND h.inn = ?"
+            params.append(inn)
+        if date_from:
+            sql += " AND h.created_at >= ?"
+            params.append(datetime.fromisoformat(date_from).timestamp())
+        if date_to:
+            sql += " AND h.created_at < ?"
+            params.append(datetime.fromisoformat(date_to).timestamp() + 86400)
+        sql += " ORDER BY score, h.created_at DESC LIMIT ?"
+        params.append(limit)
+
+        results = []
+        for row in self._conn().execute(sql, params):
+            entry = {key: row[key] for key in
+                     ("id", "inn", "name", "website", "user_id", "deal_id", "source", "request_id")}
+            entry["created_at"] = datetime.fromtimestamp(row["created_at"]).isoformat(timespec="seconds")
+            entry["snippet"] = _snippet(row["text"], terms)
+            entry["score"] = round(row["score"], 3)
+            if full:
+                entry["text"] = row["text"]
+            results.append(entry)
+        return results
+
+
+# Глобальный экземпляр
+dossier_history = Lazy(lambda: DossierHistory(settings.DATABASE_PATH), "dossier_history")
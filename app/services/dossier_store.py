@@ -0,0 +1,318 @@
+"""
+Хранилище досье в SQLite (WAL): исходные данные и текст по разделам
+
+Каждый источник (ЕГРЮЛ, сайт, ЛПР, бизнес-информация, новости) хранится со своим
+временем получения, каждый раздел текста - со временем генерации. Обновление досье
+перезапрашивает только устаревшие источники (DOSSIER_SOURCE_TTL_DAYS) и перегенерирует
+только разделы, которые от них зависят.
+
+С SHARED_STATE_BACKEND=redis (несколько хостов) последняя версия досье по ИНН дублируется
+в общее состояние: хост, у которого локальная копия старее или ее нет, берет досье оттуда
+и сохраняет у себя.
+"""
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from dataclasses import asdict, dataclass, field
+from typing import Dict, Iterable, List, Optional
+
+from app.config import settings
+from app.lazy import Lazy
+from app.services.feedback_store import connect
+from app.services.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dossiers (
+    inn TEXT PRIMARY KEY,
+    name TEXT,
+    website TEXT,
+    text TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dossier_sources (
+    inn TEXT NOT NULL,
+    source TEXT NOT NULL,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (inn, source)
+);
+CREATE TABLE IF NOT EXISTS dossier_sections (
+    inn TEXT NOT NULL,
+    section TEXT NOT NULL,
+    text TEXT NOT NULL,
+    generated_at REAL NOT NULL,
+    PRIMARY KEY (inn, section)
+);
+"""
+
+SEPARATOR = "═══════════════════════════════════"
+_SEPARATOR_LINE = re.compile(r"^\s*═{5,}\s*$", re.MULTILINE)
+
+
+@dataclass(frozen=True)
+class Section:
+    """Раздел шаблона досье (DOSSIER_TEMPLATE) и источники, из которых он строится"""
+    key: str
+    title: str
+    sources: tuple
+
+
+# Разделы в порядке шаблона
+SECTIONS = (
+    Section("header", "📋 ДОСЬЕ КОМПАНИИ", ("egrul",)),
+    Section("scale", "📊 МАСШТАБ БИЗНЕСА", ("egrul", "business")),
+    Section("online", "🌐 ОНЛАЙН-ПРИСУТСТВИЕ", ("online_presence", "website")),
+    Section("people", "👥 КЛЮЧЕВЫЕ ЛИЦА", ("egrul", "executives")),
+    Section("activity", "💼 ЧЕМ ЗАНИМАЮТСЯ", ("egrul", "business")),
+    Section("technologies", "💻 ТЕХНОЛОГИИ", ("business",)),
+    Section("news", "📰 ПОСЛЕДНИЕ НОВОСТИ", ("news",)),
+    Section("events", "🎪 ВЫСТАВКИ И МЕРОПРИЯТИЯ", ("news",)),
+    Section("sales", "🎯 ВАЖНО ДЛЯ ПРОДАЖИ", ("egrul", "business", "executives")),
+)
+SECTION_KEYS = tuple(section.key for section in SECTIONS)
+
+
+def split_sections(text: str) -> Dict[str, str]:
+    """
+    Разбор текста досье на разделы по линиям-разделителям
+
+    Args:
+        text: Текст досье или его части
+
+    Returns:
+        Ключ раздела -> текст раздела. Фрагменты, не начинающиеся с заголовка раздела, пропускаются
+    """
+    sections = {}
+    for chunk in _SEPARATOR_LINE.split(text):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        # Заголовок - в первых строках фрагмента (эмодзи модель может опустить)
+        head = "\n".join(chunk.splitlines()[:3])
+        for section in SECTIONS:
+            if section.key not in sections and section.title.split(" ", 1)[1] in head:
+                sections[section.key] = chunk
+                break
+    return sections
+
+
+def join_sections(sections: Dict[str, str]) -> str:
+    """Сборка текста досье из разделов в порядке шаблона"""
+    parts = [sections[key] for key in SECTION_KEYS if sections.get(key)]
+    return f"{SEPARATOR}\n" + f"\n\n{SEPARATOR}\n\n".join(parts) + f"\n\n{SEPARATOR}"
+
+
+def stale_sections(sources: Iterable[str]) -> List[str]:
+    """Разделы, зависящие от обновленных источников (в порядке шаблона)"""
+    sources = set(sources)
+    return [section.key for section in SECTIONS if sources.intersection(section.sources)]
+
+
+@dataclass
+class DossierRecord:
+    """Сохраненное досье компании"""
+    inn: str
+    name: Optional[str] = None
+    website: Optional[str] = None
+    text: Optional[str] = None
+    updated_at: Optional[float] = None
+    # источник -> {"data", "fetched_at"}
+    sources: Dict[str, Dict] = field(default_factory=dict)
+    # раздел -> {"text", "generated_at"}
+    sections: Dict[str, Dict] = field(default_factory=dict)
+
+    def fresh_source(self, source: str) -> Optional[Dict]:
+        """
+        Данные источника, если они не старше DOSSIER_SOURCE_TTL_DAYS
+
+        Args:
+            source: egrul, online_presence, website, executives, business, news
+        """
+        entry = self.sources.get(source)
+        if entry is None or _expired(source, entry, time.time()):
+            return None
+        return entry["data"]
+
+    def is_fresh(self, margin: float = 0) -> bool:
+        """
+        Текст досье есть и ни один сохраненный источник не устареет в ближайшие margin секунд
+
+        Args:
+            margin: Запас в секундах (например, до конца рабочего дня)
+        """
+        if not self.text:
+            return False
+        moment = time.time() + margin
+        return not any(_expired(source, entry, moment) for source, entry in self.sources.items())
+
+    @property
+    def complete(self) -> bool:
+        """Текст разобран на все разделы шаблона (можно обновлять по разделам)"""
+        return bool(self.text) and all(key in self.sections for key in SECTION_KEYS)
+
+
+def _expired(source: str, entry: Dict, moment: float) -> bool:
+    ttl_days = settings.DOSSIER_SOURCE_TTL_DAYS.get(source)
+    return ttl_days is None or moment - entry["fetched_at"] > ttl_days * 86400
+
+
+def _version(record: DossierRecord) -> float:
+    """Время последнего изменения досье: текста или любого источника"""
+    return max([record.updated_at or 0.0, *(entry["fetched_at"] for entry in record.sources.values())])
+
+
+class DossierStore:
+    """Досье по ИНН: источники и разделы с отметками свежести"""
+
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        # Последняя версия досье дублируется в общее состояние (несколько хостов)
+        self.shared = shared
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path)
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(SCHEMA)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def load(self, inn: str) -> Optional[DossierRecord]:
+        """
+        Сохраненное досье компании (с общим состоянием - более новое из локального и общего)
+
+        Args:
+            inn: ИНН
+
+        Returns:
+            DossierRecord или None, если по ИНН ничего не сохранено
+        """
+        record = self._load_local(inn)
+        if not self.shared:
+            return record
+        try:
+            data = shared_state.get(f"dossier:{inn}")
+        except Exception as e:
+            logger.warning(f"Общее состояние недоступно, досье {inn} из локального хранилища: {e}")
+            return record
+        if data is None:
+            return record
+        remote = DossierRecord(**data)
+        if record is not None and _version(record) >= _version(remote):
+            return record
+        # Досье построено на другом хосте - сохраняем у себя
+        self._hydrate(remote)
+        return remote
+
+    def _load_local(self, inn: str) -> Optional[DossierRecord]:
+        conn = self._conn()
+        record = DossierRecord(inn=inn)
+        header = conn.execute("SELECT name, website, text, updated_at FROM dossiers WHERE inn = ?", (inn,)).fetchone()
+        if header:
+            record.name, record.website, record.text, record.updated_at = header
+        for row in conn.execute("SELECT source, data, fetched_at FROM dossier_sources WHERE inn = ?", (inn,)):
+            record.sources[row["source"]] = {"data": json.loads(row["data"]), "fetched_at": row["fetched_at"]}
+        for row in conn.execute("SELECT section, text, generated_at FROM dossier_sections WHERE inn = ?", (inn,)):
+            record.sections[row["section"]] = {"text": row["text"], "generated_at": row["generated_at"]}
+        if not header and not record.sources:
+            return None
+        return record
+
+    def updated_at(self, inn: str) -> Optional[float]:
+        """Время последнего обновления текста досье (None - досье нет или оно без текста); для условных запросов"""
+        if self.shared:
+            record = self.load(inn)
+            return record.updated_at if record is not None and record.text else None
+        row = self._conn().execute(
+            "SELECT updated_at FROM dossiers WHERE inn = ? AND text != ''", (inn,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _hydrate(self, record: DossierRecord):
+        """Сохранение досье из общего состояния с исходными отметками времени"""
+        try:
+            with self._conn() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO dossier_sources (inn, source, data, fetched_at) VALUES (?, ?, ?, ?)",
+                    [(record.inn, source, json.dumps(entry["data"], ensure_ascii=False), entry["fetched_at"])
+                     for source, entry in record.sources.items()],
+                )
+                if not record.text:
+                    return
+                conn.execute("DELETE FROM dossier_sections WHERE inn = ?", (record.inn,))
+                conn.executemany(
+                    "INSERT INTO dossier_sections (inn, section, text, generated_at) VALUES (?, ?, ?, ?)",
+                    [(record.inn, key, entry["text"], entry["generated_at"]) for key, entry in record.sections.items()],
+                )
+                conn.execute(
+                    "INSERT OR REPLACE INTO dossiers (inn, name, website, text, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    (record.inn, record.name, record.website, record.text, record.updated_at),
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка сохранения досье {record.inn} из общего состояния в {self.path}: {e}")
+
+    def _publish(self, inn: str):
+        """Последняя версия досье в общее состояние (на срок самого долгоживущего источника)"""
+        record = self._load_local(inn)
+        if record is None:
+            return
+        ttl = max(settings.DOSSIER_SOURCE_TTL_DAYS.values(), default=30) * 86400
+        try:
+            shared_state.set(f"dossier:{inn}", asdict(record), ttl)
+        except Exception as e:
+            logger.warning(f"Не удалось записать досье {inn} в общее состояние, другие хосты построят его сами: {e}")
+
+    def save(self, inn: str, name: Optional[str], website: Optional[str],
+             sources: Dict[str, Dict], sections: Dict[str, str], text: Optional[str], full: bool = False):
+        """
+        Сохранение обновленных частей досье (одна транзакция)
+
+        Args:
+            inn: ИНН
+            name: Название компании
+            website: Сайт
+            sources: Заново полученные источники (остальные сохраняют прежнее время получения)
+            sections: Заново сгенерированные разделы
+            text: Итоговый текст досье (None - текст не обновлялся)
+            full: Текст сгенерирован целиком - прежние разделы удаляются
+        """
+        now = time.time()
+        try:
+            with self._conn() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO dossier_sources (inn, source, data, fetched_at) VALUES (?, ?, ?, ?)",
+                    [(inn, source, json.dumps(data, ensure_ascii=False), now) for source, data in sources.items()],
+                )
+                if text is not None:
+                    if full:
+                        conn.execute("DELETE FROM dossier_sections WHERE inn = ?", (inn,))
+                    conn.executemany(
+                        "INSERT OR REPLACE INTO dossier_sections (inn, section, text, generated_at) VALUES (?, ?, ?, ?)",
+                        [(inn, key, section_text, now) for key, section_text in sections.items()],
+                    )
+                    conn.execute(
+                        "INSERT OR REPLACE INTO dossiers (inn, name, website, text, updated_at) VALUES (?, ?, ?, ?, ?)",
+                        (inn, name, website, text, now),
+                    )
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка сохранения досье {inn} в {self.path}: {e}")
+            return
+        if self.shared:
+            self._publish(inn)
+
+
+# Глобальный экземпляр
+dossier_store = Lazy(
+    lambda: DossierStore(settings.DATABASE_PATH, shared=settings.SHARED_STATE_BACKEND == "redis"), "dossier_store"
+)
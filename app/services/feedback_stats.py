@@ -0,0 +1,58 @@
+"""
+Статистика оценок досье (для /stats)
+
+Итоги, оценки компании и оценки по дням считаются запросами GROUP BY по индексированным
+столбцам хранилища оценок (feedback_store) - одинаково во всех процессах одной базы,
+без счетчиков в памяти и их checkpoint.
+"""
+from typing import Dict, Optional
+
+from app.lazy import Lazy
+from app.services.feedback_store import FeedbackStore, feedback_store
+
+FEEDBACK_TYPES = ("positive", "negative", "feedback")
+
+
+def _with_total(counts: Dict[str, int]) -> Dict[str, int]:
+    counts = {feedback_type: counts.get(feedback_type, 0) for feedback_type in FEEDBACK_TYPES}
+    return {"total": sum(counts.values()), **counts}
+
+
+class FeedbackStats:
+    """Счетчики оценок: всего, по компаниям и по дням"""
+
+    def __init__(self, store: FeedbackStore):
+        self.store = store
+
+    def summary(self) -> Dict:
+        """Итоги по всем оценкам (формат /stats)"""
+        counts = self.store.count_by_type(FEEDBACK_TYPES)
+        return {
+            "total_feedbacks": sum(counts.values()),
+            "positive": counts.get("positive", 0),
+            "negative": counts.get("negative", 0),
+            "feedback_requests": counts.get("feedback", 0),
+            "companies": self.store.count_companies(FEEDBACK_TYPES),
+        }
+
+    def company(self, company: str) -> Optional[Dict[str, int]]:
+        """Оценки одной компании (ИНН или название)"""
+        counts = self.store.count_by_type(FEEDBACK_TYPES, company=company)
+        return _with_total(counts) if counts else None
+
+    def days(self, date_from: Optional[str] = None, date_to: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+        """
+        Оценки по дням
+
+        Args:
+            date_from: Начало периода YYYY-MM-DD (включительно)
+            date_to: Конец периода YYYY-MM-DD (включительно)
+        """
+        return {
+            day: _with_total(counts)
+            for day, counts in self.store.count_by_day(FEEDBACK_TYPES, date_from, date_to).items()
+        }
+
+
+# Глобальный экземпляр
+feedback_stats = Lazy(lambda: FeedbackStats(feedback_store), "feedback_stats")
@@ -0,0 +1,276 @@
+"""
+Хранилище оценок досье в SQLite (WAL)
+
+Запись - пачками в отдельном потоке: нажатие кнопки только кладет оценку в очередь.
+Чтение - отдельными соединениями, WAL не блокирует их записью.
+request_id связывает оценку с трейсом (/debug/trace) и журналом затрат запроса.
+"""
+import os
+import json
+import queue
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional, Sequence
+
+from app.config import settings
+from app.lazy import Lazy
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts TEXT NOT NULL,
+    company TEXT NOT NULL,
+    feedback TEXT NOT NULL,
+    dialog_id TEXT,
+    user_id TEXT,
+    request_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_feedback_company ON feedback (company, ts);
+CREATE INDEX IF NOT EXISTS idx_feedback_dialog ON feedback (dialog_id);
+CREATE INDEX IF NOT EXISTS idx_feedback_ts ON feedback (ts);
+CREATE INDEX IF NOT EXISTS idx_feedback_request ON feedback (request_id);
+CREATE INDEX IF NOT EXISTS idx_feedback_company_type ON feedback (company, feedback);
+CREATE INDEX IF NOT EXISTS idx_feedback_ts_type ON feedback (ts, feedback);
+CREATE TABLE IF NOT EXISTS feedback_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+FEEDBACK_COLUMNS = ("ts", "company", "feedback", "dialog_id", "user_id", "request_id")
+_INSERT = f"INSERT INTO feedback ({', '.join(FEEDBACK_COLUMNS)}) VALUES ({', '.join('?' * len(FEEDBACK_COLUMNS))})"
+_SELECT = f"SELECT id, {', '.join(FEEDBACK_COLUMNS)} FROM feedback"
+
+_STOP = object()
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """
+    Соединение с базой в режиме WAL
+
+    Args:
+        path: Путь к файлу базы
+
+    Returns:
+        Соединение (строки как sqlite3.Row)
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class FeedbackStore:
+    """Оценки досье: пакетная запись и индексированные выборки"""
+
+    def __init__(self, path: str, batch_size: int, flush_interval: float, legacy_jsonl: Optional[str] = None):
+        self.path = path
+        self.legacy_jsonl = legacy_jsonl
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._queue: "queue.Queue" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path)
+            self._local.conn = conn
+        return conn
+
+    def start(self):
+        """Создание схемы, однократная миграция журнала прежнего формата и запуск потока записи"""
+        with self._start_lock:
+            if self._writer is not None:
+                return
+            conn = connect(self.path)
+            conn.executescript(SCHEMA)
+            if self.legacy_jsonl:
+                self._migrate_jsonl(conn, self.legacy_jsonl)
+            self._writer = threading.Thread(target=self._write_loop, args=(conn,), name="feedback-store", daemon=True)
+            self._writer.start()
+
+    def _migrate_jsonl(self, conn: sqlite3.Connection, path: str):
+        """Импорт feedback_log.jsonl (один раз, файл переименовывается в *.migrated)"""
+        if not os.path.exists(path):
+            return
+        if conn.execute("SELECT 1 FROM feedback_meta WHERE key = 'jsonl_migrated'").fetchone():
+            return
+
+        rows = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if not entry.get("feedback"):
+                    continue
+                rows.append((
+                    entry.get("timestamp", ""),
+                    str(entry.get("company") or "неизвестна"),
+                    entry["feedback"],
+                    entry.get("dialog_id"),
+                    entry.get("user_id"),
+                    entry.get("request_id"),
+                ))
+
+        with conn:
+            conn.executemany(_INSERT, rows)
+            conn.execute("INSERT INTO feedback_meta (key, value) VALUES ('jsonl_migrated', ?)", (path,))
+        os.replace(path, path + ".migrated")
+        logger.info(f"Перенесено {len(rows)} оценок из {path} в {self.path}")
+
+    def add(self, entry: Dict):
+        """
+        Постановка оценки в очередь записи (не блокирует)
+
+        Args:
+            entry: ts, company, feedback, dialog_id, user_id, request_id
+        """
+        if self._writer is None:
+            self.start()
+        self._queue.put(entry)
+
+    def _write_loop(self, conn: sqlite3.Connection):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+            batch = [item]
+            stop = False
+            # Добираем пачку: все, что накопилось, но не дольше flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get(timeout=self.flush_interval)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                batch.append(item)
+
+            self._write_batch(conn, batch)
+            if stop:
+                return
+
+    def _write_batch(self, conn: sqlite3.Connection, batch: List[Dict]):
+        try:
+            with conn:
+                conn.executemany(_INSERT, [tuple(entry.get(column) for column in FEEDBACK_COLUMNS) for entry in batch])
+        except sqlite3.Error as e:
+            logger.error(f"Ошибка записи {len(batch)} оценок в {self.path}: {e}")
+
+    def close(self):
+        """Запись оставшейся очереди и остановка потока"""
+        if self._writer is None:
+            return
+        self._queue.put(_STOP)
+        self._writer.join(timeout=10)
+        self._writer = None
+
+    def for_company(self, company: str, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                    limit: int = 100) -> List[Dict]:
+        """
+        Оценки компании за период (новые первыми)
+
+        Args:
+            company: ИНН или название компании
+            date_from: Начало периода YYYY-MM-DD (включительно)
+            date_to: Конец периода YYYY-MM-DD (включительно)
+            limit: Максимум записей
+        """
+        sql = f"{_SELECT} WHERE company = ?"
+        args: list = [company]
+        sql, args = self._period(sql, args, date_from, date_to)
+        sql += " ORDER BY ts DESC LIMIT ?"
+        return [dict(row) for row in self._reader().execute(sql, (*args, limit))]
+
+    def for_period(self, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                   limit: int = 1000) -> List[Dict]:
+        """
+        Оценки за период с request_id (для сопоставления с трейсами и затратами)
+
+        Args:
+            date_from: Начало периода YYYY-MM-DD (включительно)
+            date_to: Конец периода YYYY-MM-DD (включительно)
+            limit: Максимум записей
+        """
+        sql = f"{_SELECT} WHERE 1 = 1"
+        sql, args = self._period(sql, [], date_from, date_to)
+        sql += " ORDER BY ts DESC LIMIT ?"
+        return [dict(row) for row in self._reader().execute(sql, (*args, limit))]
+
+    def count_by_type(self, types: Sequence[str], company: Optional[str] = None) -> Dict[str, int]:
+        """
+        Число оценок по типу (GROUP BY по индексу компании и типа)
+
+        Args:
+            types: Учитываемые типы оценок
+            company: Только оценки этой компании
+        """
+        sql = f"SELECT feedback, COUNT(*) AS n FROM feedback WHERE feedback IN ({', '.join('?' * len(types))})"
+        args: list = list(types)
+        if company is not None:
+            sql += " AND company = ?"
+            args.append(company)
+        sql += " GROUP BY feedback"
+        return {row["feedback"]: row["n"] for row in self._reader().execute(sql, args)}
+
+    def count_companies(self, types: Sequence[str]) -> int:
+        """Число компаний с оценками заданных типов"""
+        row = self._reader().execute(
+            f"SELECT COUNT(DISTINCT company) FROM feedback WHERE feedback IN ({', '.join('?' * len(types))})",
+            list(types),
+        ).fetchone()
+        return row[0]
+
+    def count_by_day(self, types: Sequence[str], date_from: Optional[str] = None,
+                     date_to: Optional[str] = None) -> Dict[str, Dict[str, int]]:
+        """
+        Число оценок по дням и типу (GROUP BY по индексу даты и типа)
+
+        Args:
+            types: Учитываемые типы оценок
+            date_from: Начало периода YYYY-MM-DD (включительно)
+            date_to: Конец периода YYYY-MM-DD (включительно)
+
+        Returns:
+            {день YYYY-MM-DD: {тип: число}} по возрастанию дня
+        """
+        sql = f"SELECT substr(ts, 1, 10) AS day, feedback, COUNT(*) AS n FROM feedback" \
+              f" WHERE feedback IN ({', '.join('?' * len(types))})"
+        sql, args = self._period(sql, list(types), date_from, date_to)
+        sql += " GROUP BY day, feedback ORDER BY day"
+        days: Dict[str, Dict[str, int]] = {}
+        for row in self._reader().execute(sql, args):
+            days.setdefault(row["day"] or "unknown", {})[row["feedback"]] = row["n"]
+        return days
+
+    @staticmethod
+    def _period(sql: str, args: list, date_from: Optional[str], date_to: Optional[str]):
+        # ts в ISO формате, поэтому границы периода сравниваются как строки
+        if date_from:
+            sql += " AND ts >= ?"
+            args.append(date_from)
+        if date_to:
+            sql += " AND ts < date(?, '+1 day')"
+            args.append(date_to)
+        return sql, args
+
+
+# Глобальный экземпляр
+feedback_store = Lazy(lambda: FeedbackStore(
+    settings.DATABASE_PATH,
+    settings.FEEDBACK_WRITE_BATCH,
+    settings.FEEDBACK_WRITE_INTERVAL,
+    settings.FEEDBACK_LOG_PATH,
+), "feedback_store")
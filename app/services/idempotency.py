@@ -0,0 +1,150 @@
+"""
+Идемпотентность запросов исследования (роботы сделок, автоматизации)
+
+Роботы бизнес-процессов Битрикс24 повторяют и перезапускают вызовы, и /webhook/research получает
+одну и ту же сделку и ИНН несколько раз за минуты. Ключ запроса - переданный вызывающим
+(idempotencyKey, заголовок Idempotency-Key) или производный от пользователя, сделки, ИНН (названия)
+и сайта. Первый запрос с ключом записывает его в общее состояние на IDEMPOTENCY_WINDOW_SECONDS,
+повтор в пределах окна получает ID и статус исходного запроса без нового исследования.
+Комментарий к сделке по ключу публикуется один раз, в том числе при повторе задания воркером.
+Ключ запроса, завершившегося ошибкой, освобождается - повтор запустит исследование заново.
+"""
+import re
+import time
+import hashlib
+import logging
+from typing import Dict, Optional
+
+from app.config import settings
+from app.lazy import Lazy
+from app.services.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# Статусы запроса по ключу
+PROCESSING = "processing"
+DONE = "done"
+FAILED = "failed"
+
+
+def _website(url: Optional[str]) -> str:
+    """Сайт без схемы, www и завершающего слэша"""
+    return re.sub(r"^(https?://)?(www\.)?", "", (url or "").strip().lower()).rstrip("/")
+
+
+def derive_key(user_id: Optional[str], deal_id: Optional[str], inn: Optional[str],
+               company_name: Optional[str] = None, website: Optional[str] = None,
+               supplied: Optional[str] = None) -> str:
+    """
+    Ключ идемпотентности запроса
+
+    Args:
+        user_id: ID пользователя Битрикс24 (получатель досье)
+        deal_id: ID сделки
+        inn: ИНН компании
+        company_name: Название компании (если ИНН нет)
+        website: Сайт компании
+        supplied: Ключ вызывающего (если передан - остальные поля не используются)
+
+    Returns:
+        Короткий хэш
+    """
+    if supplied:
+        raw = f"caller\n{supplied.strip()}"
+    else:
+        company = inn or " ".join((company_name or "").lower().split())
+        raw = "\n".join(("derived", user_id or "", deal_id or "", company, _website(website)))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:20]
+
+
+class Idempotency:
+    """Ключи запросов исследования в общем состоянии с окном IDEMPOTENCY_WINDOW_SECONDS"""
+
+    def __init__(self, window: float):
+        self.window = window
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def _ttl(self, record: Dict) -> float:
+        return max(record["created_at"] + self.window - time.time(), 1.0)
+
+    def begin(self, key: str, request_id: str) -> Optional[Dict]:
+        """
+        Запись ключа нового запроса
+
+        Args:
+            key: Ключ идемпотентности
+            request_id: ID нового запроса
+
+        Returns:
+            None - ключ записан (или идемпотентность выключена, или общее состояние недоступно),
+            иначе запись исходного запроса: {request_id, status, created_at, finished_at}
+        """
+        if not self.enabled:
+            return None
+        record = {"request_id": request_id, "status": PROCESSING, "created_at": time.time(), "finished_at": None}
+        try:
+            for _ in range(2):
+                if shared_state.add(f"idem:{key}", record, self.window):
+                    return None
+                existing = shared_state.get(f"idem:{key}")
+                if existing is None:
+                    continue
+                if existing.get("status") != FAILED:
+                    return existing
+                # Исходный запрос завершился ошибкой - повтор выполняется заново
+                shared_state.delete(f"idem:{key}")
+        except Exception as e:
+            logger.warning(f"Общее состояние недоступно, запрос {request_id} без ключа идемпотентности: {e}")
+        return None
+
+    def finish(self, key: Optional[str], status: str):
+        """Статус запроса по ключу (done или failed) до конца окна"""
+        if not key or not self.enabled:
+            return
+        try:
+            record = shared_state.get(f"idem:{key}")
+            if record is not None:
+                record = {**record, "status": status, "finished_at": time.time()}
+                shared_state.set(f"idem:{key}", record, self._ttl(record))
+        except Exception as e:
+            logger.warning(f"Не удалось записать статус ключа идемпотентности {key}: {e}")
+
+    def release(self, key: Optional[str]):
+        """Освобождение ключа (запрос не принят, например сверх квоты)"""
+        if not key or not self.enabled:
+            return
+        try:
+            shared_state.delete(f"idem:{key}")
+        except Exception as e:
+            logger.warning(f"Не удалось освободить ключ идемпотентности {key}: {e}")
+
+    def once(self, key: Optional[str], action: str) -> bool:
+        """
+        Отметка однократного действия по ключу (комментарий к сделке)
+
+        Returns:
+            True - действие еще не выполнялось (отметка наша), False - уже выполнено
+        """
+        if not key or not self.enabled:
+            return True
+        try:
+            return shared_state.add(f"idem:{key}:{action}", time.time(), self.window)
+        except Exception as e:
+            logger.warning(f"Общее состояние недоступно, {action} по ключу {key} без проверки повтора: {e}")
+            return True
+
+    def undo(self, key: Optional[str], action: str):
+        """Снятие отметки действия, которое не удалось выполнить"""
+        if not key or not self.enabled:
+            return
+        try:
+            shared_state.delete(f"idem:{key}:{action}")
+        except Exception as e:
+            logger.warning(f"Не удалось снять отметку {action} по ключу {key}: {e}")
+
+
+# Глобальный экземпляр
+idempotency = Lazy(lambda: Idempotency(settings.IDEMPOTENCY_WINDOW_SECONDS), "idempotency")
@@ -0,0 +1,502 @@
+"""
+Очередь заданий исследования для воркеров (RESEARCH_EXECUTION=queue)
+
+API ставит задание (обработчик и его аргументы), воркер (python -m app.worker) забирает его
+с арендой на JOB_LEASE_SECONDS и продлевает аренду, пока выполняет. Задание упавшего воркера
+возвращается в очередь, когда аренда истекает, но не больше JOB_MAX_ATTEMPTS раз. Задание, обработчик
+которого вернул ошибку (retry_pending() в обработчике), откладывается на JOB_RETRY_SECONDS с удвоением
+на каждую попытку и повторяется в тех же пределах.
+Задания выдаются по классу приоритета (app/services/priority.py), внутри класса - по метке
+справедливой очереди (app/services/quotas.py) или времени постановки. Отложенное задание
+(сверх квоты) не выдается до available_at.
+Хранилище - тот же бэкенд, что у общего состояния: sqlite (один хост) или redis (несколько хостов).
+"""
+import json
+import time
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, Optional, Tuple
+
+from app.config import settings
+from app.lazy import Lazy
+from app.services.feedback_store import connect
+from app.services.priority import CLASSES, DEFAULT_CLASS, rank
+from app.services.shared_state import redis_client
+
+logger = logging.getLogger(__name__)
+
+# Статусы задания
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# В counts(): поставлено, но отложено до available_at
+DEFERRED = "deferred"
+
+# Удаление завершенных заданий старше JOB_RETENTION_HOURS раз в столько захватов (sqlite)
+PURGE_EVERY = 500
+
+# Попытка задания, которое выполняет воркер: (номер попытки, всего попыток); None - вне очереди
+_attempt: ContextVar[Optional[Tuple[int, int]]] = ContextVar("job_attempt", default=None)
+
+
+@contextmanager
+def attempt(number: int, limit: int):
+    """Выполнение попытки задания воркером (для retry_pending и first_attempt в обработчиках)"""
+    token = _attempt.set((number, limit))
+    try:
+        yield
+    finally:
+        _attempt.reset(token)
+
+
+def retry_pending() -> bool:
+    """
+    Ошибку стоит вернуть воркеру, а не пользователю: выполняется задание очереди
+    и попытки не исчерпаны (воркер повторит задание)
+    """
+    current = _attempt.get()
+    return current is not None and current[0] < current[1]
+
+
+def first_attempt() -> bool:
+    """Первая попытка (или исследование вне очереди): отбивки пользователю отправляются один раз"""
+    current = _attempt.get()
+    return current is None or current[0] <= 1
+
+
+@dataclass
+class Job:
+    """Задание исследования"""
+    id: str
+    name: str
+    kwargs: Dict[str, Any]
+    priority: str = DEFAULT_CLASS
+    # Не выдавать до этого момента (time.time(); None - сразу)
+    available_at: Optional[float] = None
+    # Метка справедливой очереди (None - время постановки)
+    fair_tag: Optional[float] = None
+    status: str = QUEUED
+    attempts: int = 0
+    worker: Optional[str] = None
+    lease_until: Optional[float] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    error: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class JobQueue(ABC):
+    """Интерфейс очереди заданий"""
+
+    @abstractmethod
+    def enqueue(self, job: Job) -> bool:
+        """Постановка задания (False - задание с таким ID уже есть)"""
+
+    @abstractmethod
+    def claim(self, worker: str, lease: float, max_rank: int = len(CLASSES) - 1) -> Optional[Job]:
+        """
+        Захват самого старого задания старшего класса (в том числе с истекшей арендой)
+
+        Args:
+            worker: ID воркера
+            lease: Аренда в секундах
+            max_rank: Самый младший класс, который воркер готов взять (номер в CLASSES)
+
+        Returns:
+            Задание или None, если очередь пуста
+        """
+
+    @abstractmethod
+    def heartbeat(self, job_id: str, worker: str, lease: float) -> bool:
+        """Продление аренды (False - задание больше не принадлежит воркеру)"""
+
+    @abstractmethod
+    def complete(self, job_id: str, worker: str, status: str, error: Optional[str] = None):
+        """Завершение задания (done или failed)"""
+
+    @abstractmethod
+    def retry(self, job_id: str, worker: str, delay: float, error: Optional[str] = None):
+        """Возврат выполняемого задания в очередь через delay секунд (попытка завершилась ошибкой)"""
+
+    @abstractmethod
+    def get(self, job_id: str) -> Optional[Job]:
+        """Задание по ID"""
+
+    @abstractmethod
+    def counts(self) -> Dict[str, int]:
+        """Число заданий по статусам"""
+
+
+class SqliteJobQueue(JobQueue):
+    """Очередь в таблице SQLite (WAL): воркеры одного хоста"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        kwargs TEXT NOT NULL,
+        priority TEXT NOT NULL DEFAULT 'batch',
+        rank INTEGER NOT NULL DEFAULT 2,
+        available_at REAL,
+        fair_tag REAL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        lease_until REAL,
+        created_at REAL NOT NULL,
+        started_at REAL,
+        finished_at REAL,
+        error TEXT
+    );
+    """
+    # Колонки, добавленные после первой версии таблицы
+    COLUMNS = (
+        ("priority", "TEXT NOT NULL DEFAULT 'batch'"),
+        ("rank", "INTEGER NOT NULL DEFAULT 2"),
+        ("available_at", "REAL"),
+        ("fair_tag", "REAL"),
+    )
+    # Индекс - после добавления колонок в таблицу прежней версии
+    INDEX = "CREATE INDEX IF NOT EXISTS idx_jobs_order ON jobs(status, rank, fair_tag)"
+
+    def __init__(self, path: str, max_attempts: int, retention_hours: float):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retention = retention_hours * 3600
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._claims = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path)
+            # Захват - чтение и запись в одной транзакции BEGIN IMMEDIATE
+            conn.isolation_level = None
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(self.SCHEMA)
+                    columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+                    for column, definition in self.COLUMNS:
+                        if column not in columns:
+                            conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+                    conn.execute("DROP INDEX IF EXISTS idx_jobs_claim")
+                    conn.execute(self.INDEX)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Job:
+        values = dict(row)
+        values.pop("rank")
+        values["kwargs"] = json.loads(values["kwargs"])
+        return Job(**values)
+
+    def enqueue(self, job: Job) -> bool:
+        cursor = self._conn().execute(
+            "INSERT OR IGNORE INTO jobs (id, name, kwargs, priority, rank, available_at, fair_tag, status, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job.id, job.name, json.dumps(job.kwargs, ensure_ascii=False), job.priority, rank(job.priority),
+             job.available_at, job.fair_tag if job.fair_tag is not None else job.created_at, QUEUED, job.created_at),
+        )
+        return cursor.rowcount == 1
+
+    def claim(self, worker: str, lease: float, max_rank: int = len(CLASSES) - 1) -> Optional[Job]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            now = time.time()
+            # Аренда истекла: воркер упал или завис
+            conn.execute(
+                "UPDATE jobs SET status = ?, error = 'lease expired', finished_at = ?, lease_until = NULL "
+                "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                (FAILED, now, RUNNING, now, self.max_attempts),
+            )
+            requeued = conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, lease_until = NULL WHERE status = ? AND lease_until < ?",
+                (QUEUED, RUNNING, now),
+            ).rowcount
+            if requeued:
+                logger.warning(f"В очередь возвращено заданий с истекшей арендой: {requeued}")
+
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = ? AND rank <= ? AND (available_at IS NULL OR available_at <= ?) "
+                "ORDER BY rank, fair_tag, created_at LIMIT 1",
+                (QUEUED, max_rank, now),
+            ).fetchone()
+            job = None
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, worker = ?, lease_until = ?, started_at = ? "
+                    "WHERE id = ?",
+                    (RUNNING, worker, now + lease, now, row["id"]),
+                )
+                job = self._job(conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+            self._claims += 1
+            if self._claims % PURGE_EVERY == 0:
+                conn.execute(
+                    "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?", (DONE, FAILED, now - self.retention)
+                )
+            conn.execute("COMMIT")
+            return job
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def heartbeat(self, job_id: str, worker: str, lease: float) -> bool:
+        cursor = self._conn().execute(
+            "UPDATE jobs SET lease_until = ? WHERE id = ? AND worker = ? AND status = ?",
+            (time.time() + lease, job_id, worker, RUNNING),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, job_id: str, worker: str, status: str, error: Optional[str] = None):
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ?, lease_until = NULL "
+            "WHERE id = ? AND worker = ? AND status = ?",
+            (status, error, time.time(), job_id, worker, RUNNING),
+        )
+
+    def retry(self, job_id: str, worker: str, delay: float, error: Optional[str] = None):
+        self._conn().execute(
+            "UPDATE jobs SET status = ?, error = ?, available_at = ?, worker = NULL, lease_until = NULL "
+            "WHERE id = ? AND worker = ? AND status = ?",
+            (QUEUED, error, time.time() + delay, job_id, worker, RUNNING),
+        )
+
+    def get(self, job_id: str) -> Optional[Job]:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row else None
+
+    def counts(self) -> Dict[str, int]:
+        counts = {QUEUED: 0, DEFERRED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        rows = self._conn().execute(
+            "SELECT CASE WHEN status = ? AND available_at > ? THEN ? ELSE status END AS state, COUNT(*) AS n "
+            "FROM jobs GROUP BY state",
+            (QUEUED, time.time(), DEFERRED),
+        )
+        for row in rows:
+            counts[row["state"]] = row["n"]
+        return counts
+
+
+class RedisJobQueue(JobQueue):
+    """
+    Очередь на сервере с протоколом Redis: воркеры на нескольких хостах
+
+    Задание - JSON строка job:<id>. Sorted sets: очереди классов jobs:ready:<номер класса>
+    (ID -> метка справедливой очереди), отложенные jobs:deferred (ID -> available_at),
+    аренды jobs:leases (ID -> окончание аренды). Постановка, захват, продление, повтор
+    и завершение - Lua скрипты.
+    """
+
+    # KEYS: аренды, отложенные, очереди классов; ARGV: now, окончание аренды, воркер, префикс заданий,
+    # максимум попыток, хранение завершенных, самый младший класс для захвата, номер класса
+    # по умолчанию, имена классов
+    CLAIM_SCRIPT = """
+    local now = tonumber(ARGV[1])
+
+    local function enqueue(id, job)
+        local position = tonumber(ARGV[8])
+        for i = 9, #ARGV do
+            if ARGV[i] == job.priority then position = i - 9 end
+        end
+        local tag = job.fair_tag
+        if tag == nil or tag == cjson.null then tag = job.created_at end
+        redis.call('ZADD', KEYS[3 + position], tag, id)
+    end
+
+    -- Отложенные задания, срок которых наступил
+    for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)) do
+        redis.call('ZREM', KEYS[2], id)
+        local raw = redis.call('GET', ARGV[4] .. id)
+        if raw then enqueue(id, cjson.decode(raw)) end
+    end
+
+    -- Истекшие аренды: обратно в очередь своего класса или failed после последней попытки
+    for _, id in ipairs(redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', now)) do
+        redis.call('ZREM', KEYS[1], id)
+        local key = ARGV[4] .. id
+        local raw = redis.call('GET', key)
+        if raw then
+            local job = cjson.decode(raw)
+            job.worker = cjson.null
+            job.lease_until = cjson.null
+            if job.attempts >= tonumber(ARGV[5]) then
+                job.status = 'failed'
+                job.error = 'lease expired'
+                job.finished_at = now
+                redis.call('SET', key, cjson.encode(job), 'EX', ARGV[6])
+            else
+                job.status = 'queued'
+                redis.call('SET', key, cjson.encode(job))
+                enqueue(id, job)
+            end
+        end
+    end
+
+    for i = 3, 3 + tonumber(ARGV[7]) do
+        while true do
+            local head = redis.call('ZRANGE', KEYS[i], 0, 0)
+            if #head == 0 then break end
+            local id = head[1]
+            redis.call('ZREM', KEYS[i], id)
+            local key = ARGV[4] .. id
+            local raw = redis.call('GET', key)
+            if raw then
+                local job = cjson.decode(raw)
+                job.status = 'running'
+                job.attempts = job.attempts + 1
+                job.worker = ARGV[3]
+                job.lease_until = tonumber(ARGV[2])
+                job.started_at = now
+                raw = cjson.encode(job)
+                redis.call('SET', key, raw)
+                redis.call('ZADD', KEYS[1], ARGV[2], id)
+                return raw
+            end
+        end
+    end
+    return nil
+    """
+
+    # KEYS: задание, очередь (класса или отложенных); ARGV: JSON задания, ID, счет в очереди
+    ENQUEUE_SCRIPT = """
+    if not redis.call('SET', KEYS[1], ARGV[1], 'NX') then return 0 end
+    redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+    return 1
+    """
+
+    HEARTBEAT_SCRIPT = """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then return 0 end
+    local job = cjson.decode(raw)
+    if job.status ~= 'running' or job.worker ~= ARGV[1] then return 0 end
+    job.lease_until = tonumber(ARGV[2])
+    redis.call('SET', KEYS[1], cjson.encode(job))
+    redis.call('ZADD', KEYS[2], ARGV[2], ARGV[3])
+    return 1
+    """
+
+    COMPLETE_SCRIPT = """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then return 0 end
+    local job = cjson.decode(raw)
+    if job.status ~= 'running' or job.worker ~= ARGV[1] then return 0 end
+    job.status = ARGV[2]
+    if ARGV[3] ~= '' then job.error = ARGV[3] end
+    job.finished_at = tonumber(ARGV[4])
+    job.lease_until = cjson.null
+    redis.call('SET', KEYS[1], cjson.encode(job), 'EX', ARGV[5])
+    redis.call('ZREM', KEYS[2], ARGV[6])
+    return 1
+    """
+
+    # KEYS: задание, аренды, отложенные; ARGV: воркер, ошибка, available_at, ID
+    RETRY_SCRIPT = """
+    local raw = redis.call('GET', KEYS[1])
+    if not raw then return 0 end
+    local job = cjson.decode(raw)
+    if job.status ~= 'running' or job.worker ~= ARGV[1] then return 0 end
+    job.status = 'queued'
+    if ARGV[2] ~= '' then job.error = ARGV[2] end
+    job.available_at = tonumber(ARGV[3])
+    job.worker = cjson.null
+    job.lease_until = cjson.null
+    redis.call('SET', KEYS[1], cjson.encode(job))
+    redis.call('ZREM', KEYS[2], ARGV[4])
+    redis.call('ZADD', KEYS[3], ARGV[3], ARGV[4])
+    return 1
+    """
+
+    def __init__(self, url: str, prefix: str, max_attempts: int, retention_hours: float):
+        self.max_attempts = max_attempts
+        self.retention = max(1, int(retention_hours * 3600))
+        self._client = redis_client(url)
+        # Очереди по классам от старшего к младшему
+        self._queues = [f"{prefix}jobs:ready:{position}" for position in range(len(CLASSES))]
+        self._deferred = f"{prefix}jobs:deferred"
+        self._leases = f"{prefix}jobs:leases"
+        self._job_prefix = f"{prefix}job:"
+        self._enqueue = self._client.register_script(self.ENQUEUE_SCRIPT)
+        self._claim = self._client.register_script(self.CLAIM_SCRIPT)
+        self._heartbeat = self._client.register_script(self.HEARTBEAT_SCRIPT)
+        self._complete = self._client.register_script(self.COMPLETE_SCRIPT)
+        self._retry = self._client.register_script(self.RETRY_SCRIPT)
+
+    def enqueue(self, job: Job) -> bool:
+        raw = json.dumps(job.to_dict(), ensure_ascii=False)
+        if job.available_at is not None and job.available_at > time.time():
+            queue, score = self._deferred, job.available_at
+        else:
+            queue = self._queues[rank(job.priority)]
+            score = job.fair_tag if job.fair_tag is not None else job.created_at
+        # Задание и его место в очереди - одним скриптом: без задания-сироты при обрыве соединения
+        return bool(self._enqueue(keys=[f"{self._job_prefix}{job.id}", queue], args=[raw, job.id, score]))
+
+    def claim(self, worker: str, lease: float, max_rank: int = len(CLASSES) - 1) -> Optional[Job]:
+        now = time.time()
+        raw = self._claim(
+            keys=[self._leases, self._deferred, *self._queues],
+            args=[now, now + lease, worker, self._job_prefix, self.max_attempts, self.retention,
+                  max_rank, rank(DEFAULT_CLASS), *CLASSES],
+        )
+        return Job(**json.loads(raw)) if raw else None
+
+    def heartbeat(self, job_id: str, worker: str, lease: float) -> bool:
+        return bool(self._heartbeat(
+            keys=[f"{self._job_prefix}{job_id}", self._leases], args=[worker, time.time() + lease, job_id],
+        ))
+
+    def complete(self, job_id: str, worker: str, status: str, error: Optional[str] = None):
+        self._complete(
+            keys=[f"{self._job_prefix}{job_id}", self._leases],
+            args=[worker, status, error or "", time.time(), self.retention, job_id],
+        )
+
+    def retry(self, job_id: str, worker: str, delay: float, error: Optional[str] = None):
+        self._retry(
+            keys=[f"{self._job_prefix}{job_id}", self._leases, self._deferred],
+            args=[worker, error or "", time.time() + delay, job_id],
+        )
+
+    def get(self, job_id: str) -> Optional[Job]:
+        raw = self._client.get(f"{self._job_prefix}{job_id}")
+        return Job(**json.loads(raw)) if raw else None
+
+    def counts(self) -> Dict[str, int]:
+        # Завершенные задания хранятся отдельными ключами со сроком жизни и не считаются
+        queued = sum(self._client.zcard(queue) for queue in self._queues)
+        return {QUEUED: queued, DEFERRED: self._client.zcard(self._deferred), RUNNING: self._client.zcard(self._leases)}
+
+
+def create_job_queue(backend: str) -> JobQueue:
+    """
+    Очередь заданий на бэкенде общего состояния
+
+    Args:
+        backend: sqlite или redis (memory не подходит - воркеры в других процессах)
+    """
+    if backend == "sqlite":
+        return SqliteJobQueue(settings.DATABASE_PATH, settings.JOB_MAX_ATTEMPTS, settings.JOB_RETENTION_HOURS)
+    if backend == "redis":
+        return RedisJobQueue(
+            settings.REDIS_URL, settings.SHARED_STATE_PREFIX, settings.JOB_MAX_ATTEMPTS, settings.JOB_RETENTION_HOURS
+        )
+    raise ValueError(f"Очередь заданий требует SHARED_STATE_BACKEND=sqlite или redis, задан {backend}")
+
+
+# Глобальный экземпляр
+job_queue = Lazy(lambda: create_job_queue(settings.SHARED_STATE_BACKEND), "job_queue")
@@ -0,0 +1,142 @@
+"""
+Разбор JSON объекта из ответа модели с восстановлением типичных поломок
+
+Модель может обернуть JSON в markdown, добавить текст до и после объекта, оставить
+висячие запятые или оборвать ответ на max_tokens посреди массива. salvage_json находит
+самый большой объект, который удается разобрать, и закрывает оборванный объект
+по последней целой записи.
+"""
+import re
+import json
+from typing import List, Optional, Tuple
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)(?:```|$)", re.DOTALL | re.IGNORECASE)
+
+# Сколько последних точек обрезки пробовать для оборванного объекта
+MAX_REPAIR_ATTEMPTS = 50
+
+
+def salvage_json(text: str) -> Tuple[Optional[dict], str]:
+    """
+    JSON объект из ответа модели
+
+    Args:
+        text: Текст ответа
+
+    Returns:
+        (объект или None, результат): ok - ответ разобран как есть, repaired - объект извлечен
+        или восстановлен, failed - объект не найден
+    """
+    text = (text or "").strip()
+    try:
+        value = json.loads(text)
+        if isinstance(value, dict):
+            return value, "ok"
+    except ValueError:
+        pass
+
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1).strip()
+
+    best: Optional[dict] = None
+    best_size = 0
+    start = text.find("{")
+    while start != -1:
+        end, cuts = _scan(text, start)
+        if end is not None:
+            value = _loads(text[start:end])
+            if value is not None:
+                if end - start > best_size:
+                    best, best_size = value, end - start
+                start = text.find("{", end)
+                continue
+        else:
+            # Объект оборван: закрываем скобки после последней целой записи
+            for position, closers in reversed(cuts[-MAX_REPAIR_ATTEMPTS:]):
+                value = _loads(text[start:position] + closers)
+                if value is not None:
+                    if position - start > best_size:
+                        best, best_size = value, position - start
+                    break
+            if best is not None:
+                break
+        start = text.find("{", start + 1)
+
+    return (best, "repaired") if best is not None else (None, "failed")
+
+
+def _scan(text: str, start: int) -> Tuple[Optional[int], List[Tuple[int, str]]]:
+    """
+    Поиск конца объекта, начинающегося в start (с учетом строк и экранирования)
+
+    Returns:
+        (позиция после закрывающей скобки или None, если объект не закрыт;
+        точки обрезки - позиция и закрывающие скобки для открытых на ней уровней)
+    """
+    stack: List[str] = []
+    cuts: List[Tuple[int, str]] = []
+    in_string = False
+    escape = False
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+        elif char in "}]":
+            if not stack or stack[-1] != char:
+                return None, cuts
+            stack.pop()
+            if not stack:
+                return i + 1, cuts
+            cuts.append((i + 1, "".join(reversed(stack))))
+        elif char == ",":
+            cuts.append((i, "".join(reversed(stack))))
+    if not in_string:
+        # Ответ оборван после целого значения
+        cuts.append((len(text), "".join(reversed(stack))))
+    return None, cuts
+
+
+def _loads(candidate: str) -> Optional[dict]:
+    """Разбор кандидата без висячих запятых (None - не объект или не разбирается)"""
+    try:
+        value = json.loads(_strip_trailing_commas(candidate))
+    except ValueError:
+        return None
+    return value if isinstance(value, dict) else None
+
+
+def _strip_trailing_commas(text: str) -> str:
+    """Удаление запятых перед } и ] вне строк"""
+    result = []
+    in_string = False
+    escape = False
+    length = len(text)
+    for i, char in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == ",":
+            j = i + 1
+            while j < length and text[j].isspace():
+                j += 1
+            if j < length and text[j] in "}]":
+                continue
+        result.append(char)
+    return "".join(result)
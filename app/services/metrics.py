@@ -0,0 +1,236 @@
+"""
+Prometheus метрики Sales Scout (этапы досье, внешние API, очередь, токены)
+"""
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    CONTENT_TYPE_LATEST,
+)
+
+from app.lazy import Lazy
+
+logger = logging.getLogger(__name__)
+
+# Этапы create_company_dossier
+DOSSIER_STAGES = (
+    "identification",
+    "online_presence",
+    "website",
+    "executives",
+    "business",
+    "news",
+    "llm",
+)
+
+# Этапы длятся от долей секунды (DaData) до минут (Perplexity, LLM)
+STAGE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300)
+UPSTREAM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+
+
+class PipelineMetrics:
+    """Набор метрик пайплайна досье"""
+
+    def __init__(self, registry: Optional[CollectorRegistry] = None):
+        self.registry = registry or CollectorRegistry()
+
+        self.stage_duration = Histogram(
+            "sales_scout_dossier_stage_seconds",
+            "Длительность этапов create_company_dossier",
+            ["stage"],
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.dossier_duration = Histogram(
+            "sales_scout_dossier_seconds",
+            "Полное время создания досье",
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+        self.upstream_requests = Counter(
+            "sales_scout_upstream_requests_total",
+            "Запросы к внешним API по результату (HTTP код, timeout, connection_error)",
+            ["upstream", "operation", "status"],
+            registry=self.registry,
+        )
+        self.upstream_duration = Histogram(
+            "sales_scout_upstream_request_seconds",
+            "Латентность запросов к внешним API",
+            ["upstream", "operation"],
+            buckets=UPSTREAM_BUCKETS,
+            registry=self.registry,
+        )
+        self.upstream_wait = Histogram(
+            "sales_scout_upstream_wait_seconds",
+            "Ожидание слота запроса к внешнему API по классу приоритета (UPSTREAM_CONCURRENCY)",
+            ["upstream", "priority"],
+            buckets=UPSTREAM_BUCKETS,
+            registry=self.registry,
+        )
+        self.queue_depth = Gauge(
+            "sales_scout_research_queue_depth",
+            "Задачи, принятые webhook, но еще не начатые",
+            registry=self.registry,
+        )
+        self.in_flight = Gauge(
+            "sales_scout_research_in_flight",
+            "Задачи, выполняемые в данный момент",
+            registry=self.registry,
+        )
+        self.tokens = Counter(
+            "sales_scout_llm_tokens_total",
+            "Использованные токены по этапу, модели и типу (prompt/completion; cached - часть prompt из кэша провайдера)",
+            ["stage", "model", "kind"],
+            registry=self.registry,
+        )
+
+        self.dossier_cache = Counter(
+            "sales_scout_dossier_cache_total",
+            "Досье по результату обращения к хранилищу: hit (все источники актуальны), "
+            "sections (обновлены разделы), full (генерация целиком), joined (ожидание уже идущей сборки)",
+            ["result"],
+            registry=self.registry,
+        )
+        self.quota_decisions = Counter(
+            "sales_scout_quota_total",
+            "Исследования сверх квоты: deferred (отложены до часа со свободным лимитом), rejected (отклонены); "
+            "reason - превышен лимит запросов (rate) или дневной бюджет (cost)",
+            ["result", "reason"],
+            registry=self.registry,
+        )
+        self.dossier_reads = Counter(
+            "sales_scout_dossier_reads_total",
+            "Чтения досье через GET /api/dossier/{inn}: ok (отдан текст), not_modified (304), not_found",
+            ["result"],
+            registry=self.registry,
+        )
+        self.idempotent_repeats = Counter(
+            "sales_scout_idempotent_repeats_total",
+            "Повторы запросов исследования с ключом идемпотентности в пределах окна (без нового исследования)",
+            ["endpoint"],
+            registry=self.registry,
+        )
+        self.search_parse = Counter(
+            "sales_scout_perplexity_parse_total",
+            "Разбор ответов Perplexity по типу поиска: ok (валидный JSON), repaired (объект извлечен "
+            "или восстановлен), failed (JSON не найден)",
+            ["search_type", "result"],
+            registry=self.registry,
+        )
+        self.stage_skipped = Counter(
+            "sales_scout_dossier_stage_skipped_total",
+            "Необязательные этапы досье без результата: deadline (не начат - мало времени до срока), "
+            "timeout (прерван по бюджету этапа), error (ошибка источника)",
+            ["stage", "reason"],
+            registry=self.registry,
+        )
+        self.llm_route_duration = Histogram(
+            "sales_scout_llm_route_seconds",
+            "Длительность генерации досье по маршруту (fast/full) и модели",
+            ["route", "model"],
+            buckets=STAGE_BUCKETS,
+            registry=self.registry,
+        )
+
+        # Дочерние серии этапов создаем заранее - на горячем пути только observe()
+        self._stage_children = {
+            stage: self.stage_duration.labels(stage=stage) for stage in DOSSIER_STAGES
+        }
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Замер длительности этапа досье
+
+        Args:
+            name: Название этапа (см. DOSSIER_STAGES)
+        """
+        child = self._stage_children.get(name) or self.stage_duration.labels(stage=name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            child.observe(time.perf_counter() - start)
+
+    def observe_upstream(self, upstream: str, operation: str, status: str, duration: float):
+        """
+        Учет одного запроса к внешнему API
+
+        Args:
+            upstream: Внешний сервис (dadata, openrouter, bitrix, website)
+            operation: Операция (findById, imbot.message.add, ...)
+            status: HTTP код или тип ошибки
+            duration: Длительность в секундах
+        """
+        self.upstream_requests.labels(upstream, operation, status).inc()
+        self.upstream_duration.labels(upstream, operation).observe(duration)
+
+    def observe_upstream_wait(self, upstream: str, priority: str, duration: float):
+        """
+        Учет ожидания слота запроса к внешнему API
+
+        Args:
+            upstream: Внешний сервис
+            priority: Класс приоритета (interactive, robot, batch, prefetch)
+            duration: Длительность ожидания в секундах
+        """
+        self.upstream_wait.labels(upstream, priority).observe(duration)
+
+    def record_usage(self, stage: str, model: str, usage: Optional[Dict]):
+        """
+        Учет токенов из поля usage ответа OpenRouter
+
+        Args:
+            stage: Этап досье
+            model: Модель
+            usage: Словарь usage (prompt_tokens, completion_tokens, prompt_tokens_details)
+        """
+        if not usage:
+            return
+        for kind in ("prompt", "completion"):
+            value = usage.get(f"{kind}_tokens")
+            if value:
+                self.tokens.labels(stage, model, kind).inc(value)
+        cached = (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+        if cached:
+            self.tokens.labels(stage, model, "cached").inc(cached)
+
+    def observe_llm_route(self, route: str, model: str, duration: float):
+        """
+        Учет генерации досье выбранным маршрутом
+
+        Args:
+            route: Маршрут (fast, full)
+            model: Модель маршрута
+            duration: Длительность в секундах
+        """
+        self.llm_route_duration.labels(route, model).observe(duration)
+
+    def research_queued(self):
+        """Задача поставлена в фон"""
+        self.queue_depth.inc()
+
+    @contextmanager
+    def research_job(self):
+        """Выполнение фоновой задачи: из очереди - в работу"""
+        self.queue_depth.dec()
+        self.in_flight.inc()
+        try:
+            yield
+        finally:
+            self.in_flight.dec()
+
+    def render(self) -> Tuple[bytes, str]:
+        """Текстовое представление метрик для Prometheus"""
+        return generate_latest(self.registry), CONTENT_TYPE_LATEST
+
+
+# Глобальный экземпляр метрик
+metrics = Lazy(PipelineMetrics, "metrics")
@@ -0,0 +1,268 @@
+"""
+Асинхронный клиент OpenRouter chat completions (без LangChain)
+
+Один httpx.AsyncClient с пулом соединений на процесс, потоковый ответ (SSE),
+usage из ответа (включая usage.cost) и таймауты на каждый вызов.
+"""
+import json
+import time
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+from app.config import settings
+from app.services.metrics import metrics
+from app.services.priority import upstream_gates
+from app.services.tracing import tracer
+from app.lazy import Lazy
+
+logger = logging.getLogger(__name__)
+
+# Модели, у которых кэширование префикса промпта включается разметкой cache_control
+# (у OpenAI, DeepSeek и др. кэширование автоматическое и разметка не нужна)
+CACHE_CONTROL_MODELS = ("anthropic/", "google/gemini")
+
+
+def system_message(text: str, model: str) -> Dict:
+    """
+    System сообщение со статическими инструкциями (префикс промпта)
+
+    Для моделей с явным кэшированием текст помечается cache_control, и повторные
+    запросы с тем же префиксом не оплачивают его prefill полностью.
+
+    Args:
+        text: Неизменный между запросами текст
+        model: Модель запроса
+    """
+    if settings.PROMPT_CACHE and model.startswith(CACHE_CONTROL_MODELS):
+        return {
+            "role": "system",
+            "content": [{"type": "text", "text": text, "cache_control": {"type": "ephemeral"}}],
+        }
+    return {"role": "system", "content": text}
+
+
+# Модели, принимающие response_format с JSON схемой (structured outputs)
+STRUCTURED_OUTPUT_MODELS = ("perplexity/", "openai/", "google/gemini")
+
+
+def response_format(name: str, schema: Dict, model: str) -> Optional[Dict]:
+    """
+    response_format с JSON схемой ответа
+
+    Args:
+        name: Имя схемы (латиница, цифры, _)
+        schema: JSON Schema объекта ответа
+        model: Модель запроса
+
+    Returns:
+        Поле response_format или None, если модель схему не поддерживает или STRUCTURED_OUTPUT выключен
+    """
+    if not settings.STRUCTURED_OUTPUT or not model.startswith(STRUCTURED_OUTPUT_MODELS):
+        return None
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": False, "schema": schema}}
+
+
+def message_text(message: Dict) -> str:
+    """Текст сообщения (content строкой или списком частей)"""
+    content = message.get("content") or ""
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return content
+
+
+def cached_tokens(usage: Optional[Dict]) -> int:
+    """Токены промпта, прочитанные из кэша провайдера (usage.prompt_tokens_details)"""
+    details = (usage or {}).get("prompt_tokens_details") or {}
+    return details.get("cached_tokens") or 0
+
+
+class OpenRouterError(Exception):
+    """Ошибка ответа OpenRouter (HTTP статус не 2xx или ошибка в потоке)"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class ChatResult:
+    """Результат вызова chat completions"""
+    content: str
+    usage: Optional[Dict]
+    model: str
+    finish_reason: Optional[str] = None
+    time_to_first_token: Optional[float] = None
+
+
+class OpenRouterClient:
+    """Клиент OpenRouter с пулом соединений"""
+
+    def __init__(self, base_url: str, api_key: str, max_connections: int, connect_timeout: float, default_timeout: float):
+        self.url = f"{base_url}/chat/completions"
+        self.api_key = api_key
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+        self.default_timeout = default_timeout
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _http(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                headers={"Authorization": f"Bearer {self.api_key}", "Content-Type": "application/json"},
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+                timeout=httpx.Timeout(self.default_timeout, connect=self.connect_timeout),
+            )
+        return self._client
+
+    async def aclose(self):
+        """Закрытие пула соединений (при остановке)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def chat(
+        self,
+        messages: List[Dict],
+        model: str,
+        max_tokens: int,
+        temperature: float = 0.3,
+        timeout: Optional[float] = None,
+        stream: bool = True,
+        on_delta: Optional[Callable[[str], Awaitable[None]]] = None,
+        operation: str = "llm",
+        **extra,
+    ) -> ChatResult:
+        """
+        Вызов chat completions
+
+        Args:
+            messages: Сообщения в формате OpenAI ({"role", "content"})
+            model: Модель OpenRouter
+            max_tokens: Ограничение длины ответа
+            temperature: Температура
+            timeout: Общий таймаут вызова в секундах (None - default_timeout)
+            stream: Потоковый ответ (SSE)
+            on_delta: Корутина, получающая фрагменты текста по мере генерации
+            operation: Операция для метрик (llm, perplexity, ...)
+            **extra: Дополнительные поля запроса (response_format, provider, ...)
+
+        Returns:
+            ChatResult с текстом и usage
+        """
+        payload = {
+            "model": model,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            # Просим OpenRouter вернуть стоимость вызова в usage.cost
+            "usage": {"include": True},
+            "stream": stream,
+            **extra,
+        }
+        timeout = timeout or self.default_timeout
+
+        status = "error"
+        start = time.perf_counter()
+        with tracer.span(f"openrouter.{operation}", model=model, stream=stream) as span:
+            try:
+                # Слот по классу приоритета запроса (общий с запросами Perplexity из потоков)
+                async with upstream_gates.aslot("openrouter"):
+                    call = self._stream(payload, on_delta, start) if stream else self._complete(payload)
+                    result = await asyncio.wait_for(call, timeout=timeout)
+                status = "200"
+                span.set(
+                    size=len(result.content),
+                    usage=result.usage,
+                    finish_reason=result.finish_reason,
+                    ttft=round(result.time_to_first_token, 4) if result.time_to_first_token is not None else None,
+                )
+                return result
+            except (asyncio.TimeoutError, httpx.TimeoutException):
+                status = "timeout"
+                raise
+            except httpx.TransportError:
+                status = "connection_error"
+                raise
+            except OpenRouterError as e:
+                status = str(e.status or "error")
+                raise
+            finally:
+                metrics.observe_upstream("openrouter", operation, status, time.perf_counter() - start)
+
+    async def _complete(self, payload: Dict) -> ChatResult:
+        response = await self._http().post(self.url, json=payload)
+        if response.status_code >= 400:
+            raise OpenRouterError(f"OpenRouter {response.status_code}: {response.text[:300]}", response.status_code)
+        data = response.json()
+        choice = data["choices"][0]
+        return ChatResult(
+            content=choice["message"]["content"] or "",
+            usage=data.get("usage"),
+            model=data.get("model", payload["model"]),
+            finish_reason=choice.get("finish_reason"),
+        )
+
+    async def _stream(self, payload: Dict, on_delta, start: float) -> ChatResult:
+        parts: List[str] = []
+        usage = None
+        model = payload["model"]
+        finish_reason = None
+        first_token = None
+
+        async with self._http().stream("POST", self.url, json=payload) as response:
+            if response.status_code >= 400:
+                body = (await response.aread()).decode("utf-8", "replace")
+                raise OpenRouterError(f"OpenRouter {response.status_code}: {body[:300]}", response.status_code)
+
+            async for line in response.aiter_lines():
+                # Строки-комментарии (": OPENROUTER PROCESSING") и пустые разделители событий
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    logger.debug(f"Пропущен нераспознанный фрагмент SSE: {data[:100]}")
+                    continue
+                if "error" in chunk:
+                    error = chunk["error"]
+                    # Обычно объект {message, code}, но бывает и строка
+                    if isinstance(error, dict):
+                        raise OpenRouterError(f"OpenRouter: {error.get('message', error)}", error.get("code"))
+                    raise OpenRouterError(f"OpenRouter: {error}")
+
+                model = chunk.get("model", model)
+                usage = chunk.get("usage") or usage
+                for choice in chunk.get("choices") or []:
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        if first_token is None:
+                            first_token = time.perf_counter() - start
+                        parts.append(delta)
+                        if on_delta is not None:
+                            await on_delta(delta)
+                    finish_reason = choice.get("finish_reason") or finish_reason
+
+        return ChatResult(
+            content="".join(parts),
+            usage=usage,
+            model=model,
+            finish_reason=finish_reason,
+            time_to_first_token=first_token,
+        )
+
+
+# Глобальный экземпляр
+openrouter_client = Lazy(lambda: OpenRouterClient(
+    settings.OPENROUTER_BASE_URL,
+    settings.OPENROUTER_API_KEY,
+    settings.LLM_MAX_CONNECTIONS,
+    settings.LLM_CONNECT_TIMEOUT,
+    settings.LLM_TIMEOUT,
+), "openrouter_client")
@@ -2,22 +2,492 @@
 Perplexity сервис для поиска информации о компаниях через OpenRouter
 """
 import requests
-import json
 import logging
 from typing import Dict, Optional
 
 from app.config import settings
+from app.services import upstream
+from app.services.cost_ledger import cost_ledger
+from app.services.metrics import metrics
+from app.services.json_salvage import salvage_json
+from app.services.openrouter_client import cached_tokens, response_format, system_message
+from app.services.tracing import tracer
+from app.lazy import Lazy
 
 logger = logging.getLogger(__name__)
 
+# Статические части поисковых запросов. Они идут в system сообщение и одинаковы для всех
+# компаний (стабильный префикс промпта для кэширования у провайдера); название, ИНН и даты
+# передаются отдельным user сообщением после них
+SEARCH_SYSTEM_PROMPT = "Ты - эксперт по поиску информации о российских компаниях. Возвращай ТОЛЬКО валидный JSON, без markdown форматирования, без дополнительного текста. Используй актуальные данные из интернета. Фокусируйся на российских источниках."
+
+IDENTIFICATION_INSTRUCTIONS = """\
+Найди РОССИЙСКУЮ компанию или ИП по запросу пользователя.
+
+ВАЖНО: Ищи ТОЛЬКО в российских источниках (сайты .ru, российские соцсети, российские базы данных)
+
+Если это ИНН (10 или 12 цифр) - найди компанию по этому ИНН в российских реестрах.
+Если это название - найди компанию работающую в России. Используй:
+- Официальные сайты компаний
+- ВКонтакте, Telegram
+- Российские базы данных компаний
+- Яндекс поиск
+
+Верни ТОЛЬКО JSON без дополнительного текста:
+{
+    "found": true,
+    "variants": [
+        {
+            "name": "Полное название компании или ИП",
+            "short_name": "Краткое коммерческое название",
+            "inn": "ИНН (10 или 12 цифр, обязательно!)",
+            "confidence": 0.95,
+            "description": "Краткое описание деятельности"
+        }
+    ]
+}
+
+Если найдено несколько компаний - верни топ-5 самых релевантных.
+Если точное совпадение - верни только его.
+ОБЯЗАТЕЛЬНО укажи ИНН для каждого варианта!
+"""
+
+ONLINE_PRESENCE_INSTRUCTIONS = """\
+Найди онлайн-присутствие российской компании из запроса:
+
+1. Официальный сайт (полный URL)
+2. Страница ВКонтакте (полный URL)
+3. Telegram канал или бот (полный URL, формат t.me/...)
+4. YouTube канал (полный URL)
+5. Другие социальные сети (если есть)
+
+Верни ТОЛЬКО JSON без дополнительного текста в формате:
+{
+    "website": "https://...",
+    "vk": "https://vk.com/...",
+    "telegram": "https://t.me/...",
+    "youtube": "https://youtube.com/...",
+    "other": ["https://..."]
+}
+
+Если что-то не найдено, используй null.
+"""
+
+EXECUTIVES_INSTRUCTIONS = """\
+Ключевых лиц компании из запроса ищи в следующих источниках:
+
+ГДЕ ИСКАТЬ (в порядке приоритета):
+
+1. TENCHAT (tenchat.ru) - ОБЯЗАТЕЛЬНО ПРОВЕРЬ:
+   - Поиск по названию компании в TenChat
+   - Поиск сотрудников компании в профилях
+   - Авторы постов от лица компании
+   - URL формат: https://tenchat.ru/имя_пользователя
+
+2. LINKEDIN (linkedin.com) - ОБЯЗАТЕЛЬНО ПРОВЕРЬ:
+   - Страница компании на LinkedIn: linkedin.com/company/...
+   - Раздел "Сотрудники" на странице компании
+   - Поиск людей с указанием этой компании в профиле
+   - URL формат: https://linkedin.com/in/имя_пользователя
+
+3. TELEGRAM - ОБЯЗАТЕЛЬНО ПРОВЕРЬ:
+   - Личные каналы сотрудников компании
+   - Упоминания в тематических чатах
+   - Авторские каналы руководителей
+   - URL формат: https://t.me/username или @username
+
+4. ДОПОЛНИТЕЛЬНЫЕ ИСТОЧНИКИ:
+   - VC.ru - авторы статей от компании
+   - Habr - авторы от компании
+   - YouTube - спикеры от компании
+   - Конференции и вебинары - спикеры
+   - Пресс-релизы и новости - упоминаемые лица
+   - Сайт компании - раздел "Команда" или "О нас"
+
+КОГО ИСКАТЬ:
+- Генеральный директор, CEO, Основатель
+- Коммерческий директор, Директор по продажам
+- Директор по маркетингу, PR-директор
+- Технический директор, CTO
+- Публичные спикеры и эксперты компании
+
+Верни ТОЛЬКО JSON:
+{
+    "executives": [
+        {
+            "name": "ФИО полностью",
+            "position": "Должность",
+            "tenchat": "https://tenchat.ru/...",
+            "linkedin": "https://linkedin.com/in/...",
+            "telegram": "@username или https://t.me/...",
+            "vk": "https://vk.com/...",
+            "email": "email@company.ru",
+            "phone": "+7...",
+            "source": "где найден (TenChat/LinkedIn/Telegram/сайт компании)"
+        }
+    ]
+}
+
+ВАЖНО: Приоритет - найти профили в TenChat, LinkedIn и Telegram!
+Найди 3-7 ключевых лиц. Если данных нет - используй null.
+"""
+
+PERSON_INSTRUCTIONS = """\
+Найди МАКСИМАЛЬНО ДЕТАЛЬНУЮ информацию о человеке из запроса:
+
+ЛИЧНЫЕ КОНТАКТЫ И ПРОФИЛИ:
+1. Рабочий email
+2. Личный email (если публичный)
+3. Рабочий телефон
+4. Личный телефон (если публичен)
+5. LinkedIn профиль (полный URL)
+6. TenChat профиль
+7. VK профиль (личная страница)
+8. Facebook профиль
+9. Instagram (если связан с бизнесом)
+10. Telegram username
+
+ПУБЛИЧНАЯ АКТИВНОСТЬ:
+11. Личный блог или сайт
+12. Статьи на VC.ru
+13. Публикации на Habr
+14. Статьи на Medium
+15. Канал на YouTube
+16. Подкасты (если есть)
+17. Профиль на Forbes/РБК
+18. Другие публичные площадки
+
+ПРОФЕССИОНАЛЬНАЯ ИНФОРМАЦИЯ:
+19. Образование (университет, специальность)
+20. Предыдущий опыт работы
+21. Достижения и награды
+22. Выступления на конференциях
+23. Интервью в СМИ (ссылки)
+24. Цитаты и высказывания
+25. Области экспертизы
+
+Верни ТОЛЬКО JSON без дополнительного текста:
+{
+    "person": {
+        "name": "ФИО",
+        "position": "должность",
+        "company": "компания"
+    },
+    "contacts": {
+        "work_email": "...",
+        "personal_email": "...",
+        "work_phone": "...",
+        "personal_phone": "..."
+    },
+    "social_profiles": {
+        "linkedin": "https://...",
+        "tenchat": "https://...",
+        "vk": "https://...",
+        "facebook": "https://...",
+        "instagram": "https://...",
+        "telegram": "@..."
+    },
+    "content_platforms": {
+        "personal_blog": "https://...",
+        "vc_ru": "https://vc.ru/u/...",
+        "habr": "https://habr.com/ru/users/...",
+        "medium": "https://medium.com/@...",
+        "youtube": "https://youtube.com/...",
+        "podcasts": ["ссылки на подкасты"]
+    },
+    "publications": [
+        {
+            "title": "Название статьи/интервью",
+            "url": "https://...",
+            "platform": "VC.ru/Forbes/РБК/...",
+            "date": "YYYY-MM"
+        }
+    ],
+    "professional": {
+        "education": "университет, специальность",
+        "previous_experience": ["предыдущие компании"],
+        "achievements": ["награды, достижения"],
+        "expertise": ["области экспертизы"],
+        "speaking": ["конференции где выступал"]
+    },
+    "bio_summary": "Краткая биография (2-3 предложения)"
+}
+
+Если информация не найдена - используй null.
+ОЧЕНЬ ВАЖНО найти хотя бы один способ связи (email/телефон/соцсеть)!
+"""
+
+BUSINESS_INSTRUCTIONS = """\
+Найди МАКСИМАЛЬНО ДЕТАЛЬНУЮ бизнес-информацию о компании из запроса:
+
+1. ФИНАНСЫ И МАСШТАБ (ОЧЕНЬ ВАЖНО):
+   - Годовой оборот/выручка в рублях (поищи в:)
+     * Финансовых отчетах
+     * Интервью руководителей
+     * Новостях о компании
+     * Рейтингах и топах
+     * Данных о закупках/контрактах
+   - Месячный оборот (если найдешь)
+   - Динамика за последние годы (2023, 2024, 2025)
+   - Прибыль (если есть публичные данные)
+   - Количество сотрудников (точное или примерное)
+   - Размер компании (малый/средний/крупный бизнес)
+
+2. ДЕЯТЕЛЬНОСТЬ:
+   - Основные продукты или услуги (детальный список)
+   - Целевая аудитория (B2B, B2C, B2G)
+   - Основные/крупнейшие клиенты
+   - Отрасль и сегмент рынка
+   - География работы (регионы, страны)
+   - Доля рынка (если известна)
+
+3. ТЕХНОЛОГИИ:
+   - Какую CRM систему используют
+   - Какую ERP систему используют
+   - Системы автоматизации
+   - Технологический стек (для IT-компаний)
+   - Упоминания о цифровой трансформации
+
+4. КОНКУРЕНТЫ И РЫНОК:
+   - Основные конкуренты (3-5 компаний)
+   - Позиционирование на рынке
+   - Конкурентные преимущества
+   - Инвестиции (если были)
+   - Партнерства и интеграции
+
+Верни ТОЛЬКО JSON без дополнительного текста:
+{
+    "finances": {
+        "revenue_yearly_rub": "число или диапазон",
+        "revenue_monthly_rub": "...",
+        "revenue_source": "откуда данные",
+        "revenue_year": "2024",
+        "profit": "...",
+        "employees_count": "число или диапазон",
+        "company_size": "малый/средний/крупный",
+        "growth_trend": "растет/стабильно/падает",
+        "growth_percentage": "..."
+    },
+    "business": {
+        "products": ["список продуктов/услуг"],
+        "target_audience": "B2B/B2C/B2G",
+        "major_clients": ["список клиентов"],
+        "industry": "отрасль",
+        "geography": ["регионы работы"],
+        "market_share": "..."
+    },
+    "technologies": {
+        "crm": "название CRM",
+        "erp": "название ERP",
+        "automation": ["другие системы"],
+        "tech_stack": ["технологии"]
+    },
+    "market": {
+        "competitors": ["список конкурентов"],
+        "positioning": "позиционирование",
+        "competitive_advantages": ["преимущества"],
+        "investments": "информация об инвестициях",
+        "partnerships": ["партнеры"]
+    }
+}
+
+ОСОБЕННО ВАЖНО найти оборот - проверь ВСЕ возможные источники!
+"""
+
+NEWS_INSTRUCTIONS = """\
+Найди ВСЕ новости и мероприятия компании из запроса во временных рамках, указанных в запросе.
+
+ГДЕ ИСКАТЬ НОВОСТИ (проверь ВСЕ источники):
+
+1. ДЕЛОВЫЕ СМИ:
+   - РБК (rbc.ru) - поиск по названию компании
+   - Коммерсантъ (kommersant.ru)
+   - Ведомости (vedomosti.ru)
+   - Forbes Russia (forbes.ru)
+   - Inc Russia (incrussia.ru)
+   - Деловой Петербург (dp.ru)
+   - The Bell (thebell.io)
+
+2. ТЕХНОЛОГИЧЕСКИЕ И БИЗНЕС-ИЗДАНИЯ:
+   - VC.ru - статьи и новости
+   - Habr - если IT-компания
+   - CNews, TAdviser - если IT/технологии
+   - Retail.ru - если ритейл
+   - Другие отраслевые издания
+
+3. ИНФОРМАГЕНТСТВА:
+   - ТАСС (tass.ru)
+   - Интерфакс (interfax.ru)
+   - РИА Новости (ria.ru)
+   - Прайм (1prime.ru)
+
+4. ПРЕСС-РЕЛИЗЫ:
+   - Сайт компании (раздел "Новости" или "Пресс-центр")
+   - PR-службы и агрегаторы пресс-релизов
+
+ГДЕ ИСКАТЬ МЕРОПРИЯТИЯ:
+
+1. ВЫСТАВКИ И ЭКСПОЗИЦИИ:
+   - Expocentr.ru (Экспоцентр Москва)
+   - Expoforum.ru (Экспофорум СПб)
+   - Crocus-expo.ru (Крокус Экспо)
+   - Отраслевые выставки (поиск по отрасли компании)
+   - Региональные выставочные центры
+
+2. КОНФЕРЕНЦИИ И ФОРУМЫ:
+   - ПМЭФ, ВЭФ и другие крупные форумы
+   - Отраслевые конференции
+   - Бизнес-форумы
+   - Профессиональные саммиты
+
+3. НАГРАДЫ И РЕЙТИНГИ:
+   - Рейтинги РБК, Forbes, Коммерсантъ
+   - Отраслевые премии
+   - Бизнес-награды
+
+Верни ТОЛЬКО JSON:
+{
+    "news": [
+        {
+            "date": "YYYY-MM-DD",
+            "title": "Заголовок новости",
+            "summary": "Краткое содержание (2-3 предложения)",
+            "source": "Название издания",
+            "url": "https://полная_ссылка",
+            "type": "новость/интервью/пресс-релиз/аналитика",
+            "sentiment": "позитивная/нейтральная/негативная"
+        }
+    ],
+    "exhibitions": [
+        {
+            "date": "YYYY-MM",
+            "name": "Название выставки",
+            "location": "Место проведения",
+            "role": "экспонент/посетитель/спонсор",
+            "booth_info": "информация о стенде если есть",
+            "url": "ссылка на информацию"
+        }
+    ],
+    "conferences": [
+        {
+            "date": "YYYY-MM",
+            "name": "Название конференции/форума",
+            "location": "Место",
+            "role": "спикер/участник/спонсор/организатор",
+            "speakers": ["ФИО спикеров от компании"],
+            "topic": "тема выступления если известна",
+            "url": "ссылка"
+        }
+    ],
+    "awards": [
+        {
+            "date": "YYYY",
+            "name": "Название награды/рейтинга",
+            "position": "место в рейтинге или номинация",
+            "organizer": "кто присудил",
+            "url": "ссылка"
+        }
+    ],
+    "upcoming_events": [
+        {
+            "date": "YYYY-MM",
+            "name": "Название предстоящего мероприятия",
+            "type": "выставка/конференция/форум",
+            "url": "ссылка"
+        }
+    ],
+    "media_activity_score": "высокая/средняя/низкая",
+    "total_mentions_estimate": "примерное количество упоминаний в СМИ"
+}
+
+СТРОГО СОБЛЮДАЙ ВРЕМЕННЫЕ РАМКИ ИЗ ЗАПРОСА:
+- НЕ включай события старше 6 месяцев!
+- Минимум 5-10 новостей если компания активная
+- Укажи ВСЕ найденные выставки и конференции
+- Обязательно укажи ссылки на источники
+"""
+
+
+# JSON схемы ответов по типу поиска (response_format). Схемы повторяют форматы из инструкций,
+# поля не обязательны: модель может не найти часть сведений
+_TEXT = {"type": ["string", "null"]}
+_TEXTS = {"type": "array", "items": {"type": "string"}}
+
+
+def _object(**properties) -> Dict:
+    return {"type": "object", "properties": properties}
+
+
+def _list(**properties) -> Dict:
+    return {"type": "array", "items": _object(**properties)}
+
+
+SEARCH_SCHEMAS = {
+    "identification": _object(
+        found={"type": "boolean"},
+        variants=_list(name=_TEXT, short_name=_TEXT, inn=_TEXT, confidence={"type": "number"}, description=_TEXT),
+    ),
+    "online_presence": _object(website=_TEXT, vk=_TEXT, telegram=_TEXT, youtube=_TEXT, other=_TEXTS),
+    "executives": _object(
+        executives=_list(
+            name=_TEXT, position=_TEXT, tenchat=_TEXT, linkedin=_TEXT, telegram=_TEXT, vk=_TEXT,
+            email=_TEXT, phone=_TEXT, source=_TEXT,
+        ),
+    ),
+    "person": _object(
+        person=_object(name=_TEXT, position=_TEXT, company=_TEXT),
+        contacts=_object(work_email=_TEXT, personal_email=_TEXT, work_phone=_TEXT, personal_phone=_TEXT),
+        social_profiles=_object(
+            linkedin=_TEXT, tenchat=_TEXT, vk=_TEXT, facebook=_TEXT, instagram=_TEXT, telegram=_TEXT,
+        ),
+        content_platforms=_object(
+            personal_blog=_TEXT, vc_ru=_TEXT, habr=_TEXT, medium=_TEXT, youtube=_TEXT, podcasts=_TEXTS,
+        ),
+        publications=_list(title=_TEXT, url=_TEXT, platform=_TEXT, date=_TEXT),
+        professional=_object(
+            education=_TEXT, previous_experience=_TEXTS, achievements=_TEXTS, expertise=_TEXTS, speaking=_TEXTS,
+        ),
+        bio_summary=_TEXT,
+    ),
+    "business": _object(
+        finances=_object(
+            revenue_yearly_rub=_TEXT, revenue_monthly_rub=_TEXT, revenue_source=_TEXT, revenue_year=_TEXT,
+            profit=_TEXT, employees_count=_TEXT, company_size=_TEXT, growth_trend=_TEXT, growth_percentage=_TEXT,
+        ),
+        business=_object(
+            products=_TEXTS, target_audience=_TEXT, major_clients=_TEXTS, industry=_TEXT, geography=_TEXTS,
+            market_share=_TEXT,
+        ),
+        technologies=_object(crm=_TEXT, erp=_TEXT, automation=_TEXTS, tech_stack=_TEXTS),
+        market=_object(
+            competitors=_TEXTS, positioning=_TEXT, competitive_advantages=_TEXTS, investments=_TEXT,
+            partnerships=_TEXTS,
+        ),
+    ),
+    "news": _object(
+        news=_list(date=_TEXT, title=_TEXT, summary=_TEXT, source=_TEXT, url=_TEXT, type=_TEXT, sentiment=_TEXT),
+        exhibitions=_list(date=_TEXT, name=_TEXT, location=_TEXT, role=_TEXT, booth_info=_TEXT, url=_TEXT),
+        conferences=_list(
+            date=_TEXT, name=_TEXT, location=_TEXT, role=_TEXT, speakers=_TEXTS, topic=_TEXT, url=_TEXT,
+        ),
+        awards=_list(date=_TEXT, name=_TEXT, position=_TEXT, organizer=_TEXT, url=_TEXT),
+        upcoming_events=_list(date=_TEXT, name=_TEXT, type=_TEXT, url=_TEXT),
+        media_activity_score=_TEXT,
+        total_mentions_estimate=_TEXT,
+    ),
+}
+
+# Сколько символов неразобранного ответа передается дальше (для отладки, а не в промпт целиком)
+RAW_RESPONSE_LIMIT = 500
+
 
 class PerplexityService:
     """Сервис для работы с Perplexity через OpenRouter API"""
 
     def __init__(self):
         self.api_key = settings.OPENROUTER_API_KEY
-        self.base_url = "https://openrouter.ai/api/v1/chat/completions"
-        self.perplexity_model = "perplexity/sonar-pro"
+        self.base_url = f"{settings.OPENROUTER_BASE_URL}/chat/completions"
+        self.perplexity_model = settings.PERPLEXITY_MODEL
 
     def find_company_with_inn(self, query: str) -> Dict:
         """
@@ -29,38 +499,9 @@ class PerplexityService:
         Returns:
             Словарь с найденными вариантами компаний
         """
-        search_query = f"""
-        Найди РОССИЙСКУЮ компанию или ИП по запросу: "{query}"
-
-        ВАЖНО: Ищи ТОЛЬКО в российских источниках (сайты .ru, российские соцсети, российские базы данных)
-
-        Если это ИНН (10 или 12 цифр) - найди компанию по этому ИНН в российских реестрах.
-        Если это название - найди компанию работающую в России. Используй:
-        - Официальные сайты компаний
-        - ВКонтакте, Telegram
-        - Российские базы данных компаний
-        - Яндекс поиск
-
-        Верни ТОЛЬКО JSON без дополнительного текста:
-        {{
-            "found": true,
-            "variants": [
-                {{
-                    "name": "Полное название компании или ИП",
-                    "short_name": "Краткое коммерческое название",
-                    "inn": "ИНН (10 или 12 цифр, обязательно!)",
-                    "confidence": 0.95,
-                    "description": "Краткое описание деятельности"
-                }}
-            ]
-        }}
-
-        Если найдено несколько компаний - верни топ-5 самых релевантных.
-        Если точное совпадение - верни только его.
-        ОБЯЗАТЕЛЬНО укажи ИНН для каждого варианта!
-        """
+        search_query = f'Найди РОССИЙСКУЮ компанию или ИП по запросу: "{query}"'
 
-        return self._search(search_query, "Поиск компании и ИНН")
+        return self._search(search_query, "Поиск компании и ИНН", "identification", IDENTIFICATION_INSTRUCTIONS)
 
     def find_online_presence(self, company_name: str, inn: Optional[str] = None) -> Dict:
         """
@@ -74,28 +515,9 @@ class PerplexityService:
             Словарь с найденными ссылками
         """
         inn_part = f" (ИНН: {inn})" if inn else ""
-        query = f"""
-        Найди онлайн-присутствие российской компании {company_name}{inn_part}:
-
-        1. Официальный сайт (полный URL)
-        2. Страница ВКонтакте (полный URL)
-        3. Telegram канал или бот (полный URL, формат t.me/...)
-        4. YouTube канал (полный URL)
-        5. Другие социальные сети (если есть)
-
-        Верни ТОЛЬКО JSON без дополнительного текста в формате:
-        {{
-            "website": "https://...",
-            "vk": "https://vk.com/...",
-            "telegram": "https://t.me/...",
-            "youtube": "https://youtube.com/...",
-            "other": ["https://..."]
-        }}
+        query = f"Найди онлайн-присутствие российской компании {company_name}{inn_part}"
 
-        Если что-то не найдено, используй null.
-        """
-
-        return self._search(query, "Поиск онлайн-присутствия")
+        return self._search(query, "Поиск онлайн-присутствия", "online_presence", ONLINE_PRESENCE_INSTRUCTIONS)
 
     def find_executives(self, company_name: str) -> Dict:
         """
@@ -107,66 +529,9 @@ class PerplexityService:
         Returns:
             Словарь с информацией о руководителях и ключевых лицах
         """
-        query = f"""
-        Найди ключевых лиц компании "{company_name}" через поиск в следующих источниках:
-
-        ГДЕ ИСКАТЬ (в порядке приоритета):
-
-        1. TENCHAT (tenchat.ru) - ОБЯЗАТЕЛЬНО ПРОВЕРЬ:
-           - Поиск по названию компании в TenChat
-           - Поиск сотрудников компании в профилях
-           - Авторы постов от лица компании
-           - URL формат: https://tenchat.ru/имя_пользователя
-
-        2. LINKEDIN (linkedin.com) - ОБЯЗАТЕЛЬНО ПРОВЕРЬ:
-           - Страница компании на LinkedIn: linkedin.com/company/{company_name}
-           - Раздел "Сотрудники" на странице компании
-           - Поиск людей с указанием этой компании в профиле
-           - URL формат: https://linkedin.com/in/имя_пользователя
-
-        3. TELEGRAM - ОБЯЗАТЕЛЬНО ПРОВЕРЬ:
-           - Личные каналы сотрудников компании
-           - Упоминания в тематических чатах
-           - Авторские каналы руководителей
-           - URL формат: https://t.me/username или @username
-
-        4. ДОПОЛНИТЕЛЬНЫЕ ИСТОЧНИКИ:
-           - VC.ru - авторы статей от компании
-           - Habr - авторы от компании
-           - YouTube - спикеры от компании
-           - Конференции и вебинары - спикеры
-           - Пресс-релизы и новости - упоминаемые лица
-           - Сайт компании - раздел "Команда" или "О нас"
-
-        КОГО ИСКАТЬ:
-        - Генеральный директор, CEO, Основатель
-        - Коммерческий директор, Директор по продажам
-        - Директор по маркетингу, PR-директор
-        - Технический директор, CTO
-        - Публичные спикеры и эксперты компании
-
-        Верни ТОЛЬКО JSON:
-        {{
-            "executives": [
-                {{
-                    "name": "ФИО полностью",
-                    "position": "Должность",
-                    "tenchat": "https://tenchat.ru/...",
-                    "linkedin": "https://linkedin.com/in/...",
-                    "telegram": "@username или https://t.me/...",
-                    "vk": "https://vk.com/...",
-                    "email": "email@company.ru",
-                    "phone": "+7...",
-                    "source": "где найден (TenChat/LinkedIn/Telegram/сайт компании)"
-                }}
-            ]
-        }}
-
-        ВАЖНО: Приоритет - найти профили в TenChat, LinkedIn и Telegram!
-        Найди 3-7 ключевых лиц. Если данных нет - используй null.
-        """
+        query = f'Найди ключевых лиц компании "{company_name}"'
 
-        return self._search(query, "Поиск ключевых лиц компании")
+        return self._search(query, "Поиск ключевых лиц компании", "executives", EXECUTIVES_INSTRUCTIONS)
 
     def deep_search_person(self, person_name: str, company_name: str, position: str = None) -> Dict:
         """
@@ -181,92 +546,9 @@ class PerplexityService:
             Детальная информация о человеке
         """
         position_part = f" ({position})" if position else ""
-        query = f"""
-        Найди МАКСИМАЛЬНО ДЕТАЛЬНУЮ информацию о человеке: {person_name}{position_part} из компании "{company_name}"
-
-        ЛИЧНЫЕ КОНТАКТЫ И ПРОФИЛИ:
-        1. Рабочий email
-        2. Личный email (если публичный)
-        3. Рабочий телефон
-        4. Личный телефон (если публичен)
-        5. LinkedIn профиль (полный URL)
-        6. TenChat профиль
-        7. VK профиль (личная страница)
-        8. Facebook профиль
-        9. Instagram (если связан с бизнесом)
-        10. Telegram username
-
-        ПУБЛИЧНАЯ АКТИВНОСТЬ:
-        11. Личный блог или сайт
-        12. Статьи на VC.ru
-        13. Публикации на Habr
-        14. Статьи на Medium
-        15. Канал на YouTube
-        16. Подкасты (если есть)
-        17. Профиль на Forbes/РБК
-        18. Другие публичные площадки
-
-        ПРОФЕССИОНАЛЬНАЯ ИНФОРМАЦИЯ:
-        19. Образование (университет, специальность)
-        20. Предыдущий опыт работы
-        21. Достижения и награды
-        22. Выступления на конференциях
-        23. Интервью в СМИ (ссылки)
-        24. Цитаты и высказывания
-        25. Области экспертизы
-
-        Верни ТОЛЬКО JSON без дополнительного текста:
-        {{
-            "person": {{
-                "name": "ФИО",
-                "position": "должность",
-                "company": "компания"
-            }},
-            "contacts": {{
-                "work_email": "...",
-                "personal_email": "...",
-                "work_phone": "...",
-                "personal_phone": "..."
-            }},
-            "social_profiles": {{
-                "linkedin": "https://...",
-                "tenchat": "https://...",
-                "vk": "https://...",
-                "facebook": "https://...",
-                "instagram": "https://...",
-                "telegram": "@..."
-            }},
-            "content_platforms": {{
-                "personal_blog": "https://...",
-                "vc_ru": "https://vc.ru/u/...",
-                "habr": "https://habr.com/ru/users/...",
-                "medium": "https://medium.com/@...",
-                "youtube": "https://youtube.com/...",
-                "podcasts": ["ссылки на подкасты"]
-            }},
-            "publications": [
-                {{
-                    "title": "Название статьи/интервью",
-                    "url": "https://...",
-                    "platform": "VC.ru/Forbes/РБК/...",
-                    "date": "YYYY-MM"
-                }}
-            ],
-            "professional": {{
-                "education": "университет, специальность",
-                "previous_experience": ["предыдущие компании"],
-                "achievements": ["награды, достижения"],
-                "expertise": ["области экспертизы"],
-                "speaking": ["конференции где выступал"]
-            }},
-            "bio_summary": "Краткая биография (2-3 предложения)"
-        }}
-
-        Если информация не найдена - используй null.
-        ОЧЕНЬ ВАЖНО найти хотя бы один способ связи (email/телефон/соцсеть)!
-        """
+        query = f'Найди МАКСИМАЛЬНО ДЕТАЛЬНУЮ информацию о человеке: {person_name}{position_part} из компании "{company_name}"'
 
-        return self._search(query, f"Детальный поиск о {person_name}")
+        return self._search(query, f"Детальный поиск о {person_name}", "person", PERSON_INSTRUCTIONS)
 
     def find_business_info(self, company_name: str, inn: Optional[str] = None) -> Dict:
         """
@@ -280,84 +562,9 @@ class PerplexityService:
             Словарь с бизнес-информацией
         """
         inn_part = f" (ИНН: {inn})" if inn else ""
-        query = f"""
-        Найди МАКСИМАЛЬНО ДЕТАЛЬНУЮ бизнес-информацию о компании "{company_name}"{inn_part}:
-
-        1. ФИНАНСЫ И МАСШТАБ (ОЧЕНЬ ВАЖНО):
-           - Годовой оборот/выручка в рублях (поищи в:)
-             * Финансовых отчетах
-             * Интервью руководителей
-             * Новостях о компании
-             * Рейтингах и топах
-             * Данных о закупках/контрактах
-           - Месячный оборот (если найдешь)
-           - Динамика за последние годы (2023, 2024, 2025)
-           - Прибыль (если есть публичные данные)
-           - Количество сотрудников (точное или примерное)
-           - Размер компании (малый/средний/крупный бизнес)
-
-        2. ДЕЯТЕЛЬНОСТЬ:
-           - Основные продукты или услуги (детальный список)
-           - Целевая аудитория (B2B, B2C, B2G)
-           - Основные/крупнейшие клиенты
-           - Отрасль и сегмент рынка
-           - География работы (регионы, страны)
-           - Доля рынка (если известна)
-
-        3. ТЕХНОЛОГИИ:
-           - Какую CRM систему используют
-           - Какую ERP систему используют
-           - Системы автоматизации
-           - Технологический стек (для IT-компаний)
-           - Упоминания о цифровой трансформации
-
-        4. КОНКУРЕНТЫ И РЫНОК:
-           - Основные конкуренты (3-5 компаний)
-           - Позиционирование на рынке
-           - Конкурентные преимущества
-           - Инвестиции (если были)
-           - Партнерства и интеграции
-
-        Верни ТОЛЬКО JSON без дополнительного текста:
-        {{
-            "finances": {{
-                "revenue_yearly_rub": "число или диапазон",
-                "revenue_monthly_rub": "...",
-                "revenue_source": "откуда данные",
-                "revenue_year": "2024",
-                "profit": "...",
-                "employees_count": "число или диапазон",
-                "company_size": "малый/средний/крупный",
-                "growth_trend": "растет/стабильно/падает",
-                "growth_percentage": "..."
-            }},
-            "business": {{
-                "products": ["список продуктов/услуг"],
-                "target_audience": "B2B/B2C/B2G",
-                "major_clients": ["список клиентов"],
-                "industry": "отрасль",
-                "geography": ["регионы работы"],
-                "market_share": "..."
-            }},
-            "technologies": {{
-                "crm": "название CRM",
-                "erp": "название ERP",
-                "automation": ["другие системы"],
-                "tech_stack": ["технологии"]
-            }},
-            "market": {{
-                "competitors": ["список конкурентов"],
-                "positioning": "позиционирование",
-                "competitive_advantages": ["преимущества"],
-                "investments": "информация об инвестициях",
-                "partnerships": ["партнеры"]
-            }}
-        }}
-
-        ОСОБЕННО ВАЖНО найти оборот - проверь ВСЕ возможные источники!
-        """
+        query = f'Найди МАКСИМАЛЬНО ДЕТАЛЬНУЮ бизнес-информацию о компании "{company_name}"{inn_part}'
 
-        return self._search(query, "Поиск финансов и бизнес-информации")
+        return self._search(query, "Поиск финансов и бизнес-информации", "business", BUSINESS_INSTRUCTIONS)
 
     def find_news_and_events(self, company_name: str, inn: Optional[str] = None, industry: Optional[str] = None) -> Dict:
         """
@@ -393,129 +600,19 @@ class PerplexityService:
         • Новости: с {date_from} по {date_to_past} (последние 6 месяцев)
         • Прошедшие мероприятия: с {date_from} по {date_to_past} (последние 6 месяцев)
         • Предстоящие мероприятия: с {date_to_past} по {date_to_future} (следующие 6 месяцев)
-
-        ГДЕ ИСКАТЬ НОВОСТИ (проверь ВСЕ источники):
-
-        1. ДЕЛОВЫЕ СМИ:
-           - РБК (rbc.ru) - поиск по названию компании
-           - Коммерсантъ (kommersant.ru)
-           - Ведомости (vedomosti.ru)
-           - Forbes Russia (forbes.ru)
-           - Inc Russia (incrussia.ru)
-           - Деловой Петербург (dp.ru)
-           - The Bell (thebell.io)
-
-        2. ТЕХНОЛОГИЧЕСКИЕ И БИЗНЕС-ИЗДАНИЯ:
-           - VC.ru - статьи и новости
-           - Habr - если IT-компания
-           - CNews, TAdviser - если IT/технологии
-           - Retail.ru - если ритейл
-           - Другие отраслевые издания
-
-        3. ИНФОРМАГЕНТСТВА:
-           - ТАСС (tass.ru)
-           - Интерфакс (interfax.ru)
-           - РИА Новости (ria.ru)
-           - Прайм (1prime.ru)
-
-        4. ПРЕСС-РЕЛИЗЫ:
-           - Сайт компании (раздел "Новости" или "Пресс-центр")
-           - PR-службы и агрегаторы пресс-релизов
-
-        ГДЕ ИСКАТЬ МЕРОПРИЯТИЯ:
-
-        1. ВЫСТАВКИ И ЭКСПОЗИЦИИ:
-           - Expocentr.ru (Экспоцентр Москва)
-           - Expoforum.ru (Экспофорум СПб)
-           - Crocus-expo.ru (Крокус Экспо)
-           - Отраслевые выставки (поиск по отрасли компании)
-           - Региональные выставочные центры
-
-        2. КОНФЕРЕНЦИИ И ФОРУМЫ:
-           - ПМЭФ, ВЭФ и другие крупные форумы
-           - Отраслевые конференции
-           - Бизнес-форумы
-           - Профессиональные саммиты
-
-        3. НАГРАДЫ И РЕЙТИНГИ:
-           - Рейтинги РБК, Forbes, Коммерсантъ
-           - Отраслевые премии
-           - Бизнес-награды
-
-        Верни ТОЛЬКО JSON:
-        {{
-            "news": [
-                {{
-                    "date": "YYYY-MM-DD",
-                    "title": "Заголовок новости",
-                    "summary": "Краткое содержание (2-3 предложения)",
-                    "source": "Название издания",
-                    "url": "https://полная_ссылка",
-                    "type": "новость/интервью/пресс-релиз/аналитика",
-                    "sentiment": "позитивная/нейтральная/негативная"
-                }}
-            ],
-            "exhibitions": [
-                {{
-                    "date": "YYYY-MM",
-                    "name": "Название выставки",
-                    "location": "Место проведения",
-                    "role": "экспонент/посетитель/спонсор",
-                    "booth_info": "информация о стенде если есть",
-                    "url": "ссылка на информацию"
-                }}
-            ],
-            "conferences": [
-                {{
-                    "date": "YYYY-MM",
-                    "name": "Название конференции/форума",
-                    "location": "Место",
-                    "role": "спикер/участник/спонсор/организатор",
-                    "speakers": ["ФИО спикеров от компании"],
-                    "topic": "тема выступления если известна",
-                    "url": "ссылка"
-                }}
-            ],
-            "awards": [
-                {{
-                    "date": "YYYY",
-                    "name": "Название награды/рейтинга",
-                    "position": "место в рейтинге или номинация",
-                    "organizer": "кто присудил",
-                    "url": "ссылка"
-                }}
-            ],
-            "upcoming_events": [
-                {{
-                    "date": "YYYY-MM",
-                    "name": "Название предстоящего мероприятия",
-                    "type": "выставка/конференция/форум",
-                    "url": "ссылка"
-                }}
-            ],
-            "media_activity_score": "высокая/средняя/низкая",
-            "total_mentions_estimate": "примерное количество упоминаний в СМИ"
-        }}
-
-        СТРОГО СОБЛЮДАЙ ВРЕМЕННЫЕ РАМКИ:
-        - Новости ТОЛЬКО с {date_from} по {date_to_past}
-        - Прошедшие мероприятия ТОЛЬКО с {date_from} по {date_to_past}
-        - Предстоящие мероприятия ТОЛЬКО с {date_to_past} по {date_to_future}
-        - НЕ включай события старше 6 месяцев!
-        - Минимум 5-10 новостей если компания активная
-        - Укажи ВСЕ найденные выставки и конференции
-        - Обязательно укажи ссылки на источники
         """
 
-        return self._search(query, "Поиск новостей и мероприятий")
+        return self._search(query, "Поиск новостей и мероприятий", "news", NEWS_INSTRUCTIONS)
 
-    def _search(self, query: str, search_type: str) -> Dict:
+    def _search(self, query: str, search_type: str, stage: str, instructions: str) -> Dict:
         """
         Выполнение поискового запроса через Perplexity (OpenRouter)
 
         Args:
-            query: Текст запроса
+            query: Данные запроса (название, ИНН, даты)
             search_type: Тип поиска (для логирования)
+            stage: Код типа поиска для метрик и учета затрат
+            instructions: Статические инструкции и формат ответа типа поиска
 
         Returns:
             Распарсенный JSON ответ
@@ -523,23 +620,26 @@ class PerplexityService:
         payload = {
             "model": self.perplexity_model,
             "messages": [
-                {
-                    "role": "system",
-                    "content": "Ты - эксперт по поиску информации о российских компаниях. Возвращай ТОЛЬКО валидный JSON, без markdown форматирования, без дополнительного текста. Используй актуальные данные из интернета. Фокусируйся на российских источниках."
-                },
+                system_message(f"{SEARCH_SYSTEM_PROMPT}\n\n{instructions}", self.perplexity_model),
                 {
                     "role": "user",
                     "content": query
                 }
             ],
             "temperature": 0.2,
-            "max_tokens": 3000
+            "max_tokens": 3000,
+            # Просим OpenRouter вернуть стоимость вызова в usage.cost
+            "usage": {"include": True}
         }
+        schema = response_format(f"{stage}_search", SEARCH_SCHEMAS[stage], self.perplexity_model)
+        if schema is not None:
+            payload["response_format"] = schema
 
         try:
             logger.info(f"{search_type}: отправка запроса к Perplexity через OpenRouter")
 
-            response = requests.post(
+            response = upstream.request(
+                "openrouter", "perplexity", "POST",
                 self.base_url,
                 json=payload,
                 headers={
@@ -557,33 +657,27 @@ class PerplexityService:
             usage = data.get("usage", {})
 
             logger.info(f"{search_type}: получен ответ от Perplexity")
-            logger.debug(f"Использование токенов: {usage}")
-
-            # Парсим JSON из ответа
-            try:
-                # Убираем markdown форматирование если есть
-                content = content.strip()
-                if content.startswith("```json"):
-                    content = content[7:]
-                if content.startswith("```"):
-                    content = content[3:]
-                if content.endswith("```"):
-                    content = content[:-3]
-                content = content.strip()
-
-                result = json.loads(content)
-                result["_usage"] = usage  # Добавляем информацию об использовании токенов
-                return result
-
-            except json.JSONDecodeError as e:
-                logger.error(f"Ошибка парсинга JSON от Perplexity: {e}")
-                logger.error(f"Полученный контент: {content}")
-                # Возвращаем сырой ответ в случае ошибки
+            logger.debug(f"Использование токенов: {usage}, из кэша: {cached_tokens(usage)}")
+            metrics.record_usage(stage, self.perplexity_model, usage)
+            cost_ledger.record(stage, self.perplexity_model, usage)
+
+            # Парсим JSON из ответа (markdown, текст вокруг объекта, висячие запятые, обрыв)
+            with tracer.span("perplexity.parse", search_type=search_type, size=len(content or "")) as span:
+                result, outcome = salvage_json(content)
+                span.set(result=outcome)
+            metrics.search_parse.labels(stage, outcome).inc()
+
+            if result is None:
+                logger.error(f"{search_type}: в ответе Perplexity не найден JSON: {(content or '')[:RAW_RESPONSE_LIMIT]}")
                 return {
-                    "raw_response": content,
+                    "raw_response": (content or "")[:RAW_RESPONSE_LIMIT],
                     "_usage": usage,
                     "_error": "JSON parsing failed"
                 }
+            if outcome == "repaired":
+                logger.warning(f"{search_type}: JSON ответа Perplexity восстановлен")
+            result["_usage"] = usage  # Добавляем информацию об использовании токенов
+            return result
 
         except requests.exceptions.RequestException as e:
             logger.error(f"Ошибка запроса к Perplexity через OpenRouter: {e}")
@@ -594,4 +688,4 @@ class PerplexityService:
 
 
 # Глобальный экземпляр сервиса
-perplexity_service = PerplexityService()
+perplexity_service = Lazy(PerplexityService, "perplexity_service")
@@ -0,0 +1,257 @@
+"""
+Ночной прогрев досье по открытым сделкам Битрикс24
+
+В окне PREWARM_START_HOUR-PREWARM_END_HOUR (локальное время) задача обходит открытые
+сделки (crm.deal.list), берет ИНН из поля сделки или реквизитов компании и по одному
+строит досье компаний без актуальной сохраненной копии, пока не исчерпан бюджет по
+количеству и стоимости. Утренние запросы по этим компаниям отвечают из хранилища досье.
+
+Расписание запускается в каждом воркере, но проход выполняет один: блокировка и отчет
+последнего прохода хранятся в общем состоянии (SHARED_STATE_BACKEND).
+"""
+import time
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from app import request_context
+from app.config import settings
+from app.lazy import Lazy
+from app.services.bitrix import bitrix_service
+from app.services.cost_ledger import cost_ledger
+from app.services.dossier_store import dossier_store
+from app.services.shared_state import shared_state
+from app.services.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+LOCK_KEY = "prewarm:running"
+REPORT_KEY = "prewarm:last_report"
+# Блокировка продлевается перед каждым досье; блокировка упавшего воркера истекает через столько секунд
+LOCK_TTL = 900
+
+
+def _clean_inn(value) -> Optional[str]:
+    inn = "".join(filter(str.isdigit, str(value or "")))
+    return inn if len(inn) in (10, 12) else None
+
+
+def resolve_target(deal: Dict, company: Dict, inn_field: str) -> Optional[Dict]:
+    """
+    Компания для досье по сделке и/или компании CRM
+
+    Args:
+        deal: Поля сделки (пусто, если событие по компании)
+        company: {"title", "website", "inn"} из get_companies (пусто, если у сделки нет компании)
+        inn_field: Пользовательское поле сделки с ИНН
+
+    Returns:
+        {"inn", "name", "website", "deal_id"} или None, если ИНН не найден
+    """
+    inn = _clean_inn(deal.get(inn_field)) or _clean_inn(company.get("inn"))
+    if not inn:
+        return None
+    return {
+        "inn": inn,
+        "name": company.get("title") or deal.get("TITLE"),
+        "website": company.get("website"),
+        "deal_id": str(deal["ID"]) if deal.get("ID") else None,
+    }
+
+
+class PrewarmJob:
+    """Прогрев хранилища досье по открытым сделкам"""
+
+    def __init__(self, start_hour: int, end_hour: int, max_dossiers: int, max_cost_usd: float,
+                 fresh_margin_hours: float, pause_seconds: float, inn_field: str):
+        self.start_hour = start_hour
+        self.end_hour = end_hour
+        self.max_dossiers = max_dossiers
+        self.max_cost_usd = max_cost_usd
+        self.fresh_margin = fresh_margin_hours * 3600
+        self.pause_seconds = pause_seconds
+        self.inn_field = inn_field
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        """Проход выполняется (в любом воркере)"""
+        return shared_state.get(LOCK_KEY) is not None
+
+    @property
+    def last_report(self) -> Optional[Dict]:
+        """Отчет последнего прохода (в любом воркере)"""
+        return shared_state.get(REPORT_KEY)
+
+    def targets(self) -> List[Dict]:
+        """
+        Компании открытых сделок с ИНН (по одной записи на ИНН, недавно измененные сделки первыми)
+
+        Returns:
+            Список {"inn", "name", "website", "deal_id"}
+        """
+        deals = list(bitrix_service.list_open_deals(self.inn_field))
+        company_ids = sorted({str(deal["COMPANY_ID"]) for deal in deals if str(deal.get("COMPANY_ID") or "0") != "0"})
+        companies = bitrix_service.get_companies(company_ids) if company_ids else {}
+
+        targets: Dict[str, Dict] = {}
+        for deal in deals:
+            target = resolve_target(deal, companies.get(str(deal.get("COMPANY_ID")), {}), self.inn_field)
+            if target and target["inn"] not in targets:
+                targets[target["inn"]] = target
+        logger.info(f"Прогрев: {len(deals)} открытых сделок, {len(targets)} компаний с ИНН")
+        return list(targets.values())
+
+    def acquire(self) -> Optional[str]:
+        """
+        Захват блокировки прохода (во всех воркерах и хостах общего состояния)
+
+        Returns:
+            ID прохода или None (проход уже выполняется)
+        """
+        run_id = request_context.new_request_id()
+        return run_id if shared_state.add(LOCK_KEY, run_id, LOCK_TTL) else None
+
+    def release(self, run_id: str):
+        """Снятие блокировки прохода, который не был запущен"""
+        shared_state.release(LOCK_KEY, run_id)
+
+    async def run(self, deadline: Optional[float] = None, run_id: Optional[str] = None) -> Dict:
+        """
+        Один проход прогрева
+
+        Args:
+            deadline: Момент (time.time()), после которого новые досье не начинаются
+            run_id: ID прохода, блокировку которого уже захватил вызывающий (acquire в процессе API)
+
+        Returns:
+            Отчет: компании, актуальные, построенные, ошибки, стоимость, причина остановки
+        """
+        # Импорт при запуске: анализатор тянет LLM клиент
+        from app.services.sales_analyzer import sales_analyzer
+
+        if run_id is not None:
+            # Задание ждало в очереди: блокировка могла истечь - захватываем ее заново, если она свободна
+            held = (await asyncio.to_thread(shared_state.renew, LOCK_KEY, run_id, LOCK_TTL)
+                    or await asyncio.to_thread(shared_state.add, LOCK_KEY, run_id, LOCK_TTL))
+        else:
+            run_id = await asyncio.to_thread(self.acquire)
+            held = run_id is not None
+        if not held:
+            logger.info("Прогрев уже выполняется в другом воркере")
+            return {"status": "already_running"}
+        report = {
+            "started_at": datetime.now().isoformat(timespec="seconds"),
+            "companies": 0,
+            "fresh": 0,
+            "warmed": 0,
+            "errors": 0,
+            "cost_usd": 0.0,
+            "stopped": "done",
+        }
+        await asyncio.to_thread(shared_state.set, REPORT_KEY, report)
+        owned = True
+        try:
+            targets = await asyncio.to_thread(self.targets)
+            report["companies"] = len(targets)
+            for target in targets:
+                if report["warmed"] >= self.max_dossiers:
+                    report["stopped"] = "max_dossiers"
+                    break
+                if report["cost_usd"] >= self.max_cost_usd:
+                    report["stopped"] = "max_cost"
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    report["stopped"] = "window_closed"
+                    break
+
+                record = await asyncio.to_thread(dossier_store.load, target["inn"])
+                if record is not None and record.is_fresh(self.fresh_margin):
+                    report["fresh"] += 1
+                    continue
+
+                # Продление блокировки (только своей) и промежуточный отчет
+                owned = await asyncio.to_thread(shared_state.renew, LOCK_KEY, run_id, LOCK_TTL)
+                if not owned:
+                    report["stopped"] = "lock_lost"
+                    logger.error(f"Прогрев {run_id}: блокировка истекла и занята другим проходом, проход остановлен")
+                    break
+                await asyncio.to_thread(shared_state.set, REPORT_KEY, report)
+
+                request_id = request_context.new_request_id()
+                with (
+                    request_context.bind(request_id, deal_id=target["deal_id"], inn=target["inn"], source="prewarm"),
+                    tracer.trace(request_id, "research.prewarm", deal_id=target["deal_id"], inn=target["inn"]),
+                    cost_ledger.spend() as spent,
+                ):
+                    try:
+                        await sales_analyzer.create_company_dossier(inn=target["inn"], company_website=target["website"])
+                        report["warmed"] += 1
+                    except Exception as e:
+                        report["errors"] += 1
+                        logger.error(f"Прогрев: ошибка досье {target['inn']} ({target['name']}): {e}")
+                report["cost_usd"] = round(report["cost_usd"] + spent[0], 4)
+                # Низкий приоритет: пауза между досье оставляет внешние API дневным запросам
+                await asyncio.sleep(self.pause_seconds)
+        except Exception as e:
+            report["stopped"] = f"error: {e}"
+            logger.error(f"Прогрев прерван: {e}", exc_info=True)
+        finally:
+            report["finished_at"] = datetime.now().isoformat(timespec="seconds")
+            # Блокировку и отчет, перешедшие к другому проходу, не трогаем
+            if owned and await asyncio.to_thread(shared_state.renew, LOCK_KEY, run_id, LOCK_TTL):
+                await asyncio.to_thread(shared_state.set, REPORT_KEY, report)
+                await asyncio.to_thread(shared_state.release, LOCK_KEY, run_id)
+
+        logger.info(f"Прогрев завершен: {report}")
+        return report
+
+    def next_window(self, now: datetime) -> tuple:
+        """Начало и конец ближайшего окна прогрева (текущего, если оно уже идет)"""
+        start = now.replace(hour=self.start_hour, minute=0, second=0, microsecond=0)
+        end = now.replace(hour=self.end_hour, minute=0, second=0, microsecond=0)
+        if end <= start:
+            # Окно через полночь (например, 22-6)
+            if now < end:
+                start -= timedelta(days=1)
+            else:
+                end += timedelta(days=1)
+        if now >= end:
+            start += timedelta(days=1)
+            end += timedelta(days=1)
+        return start, end
+
+    async def _loop(self):
+        while True:
+            start, end = self.next_window(datetime.now())
+            delay = (start - datetime.now()).total_seconds()
+            if delay > 0:
+                logger.info(f"Следующий прогрев досье: {start:%Y-%m-%d %H:%M}")
+                await asyncio.sleep(delay)
+            await self.run(deadline=end.timestamp())
+            # Не больше одного прохода за окно
+            await asyncio.sleep(max(0.0, end.timestamp() - time.time()))
+
+    def start(self):
+        """Запуск расписания в текущем event loop (при старте приложения)"""
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    def stop(self):
+        """Остановка расписания"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+# Глобальный экземпляр
+prewarm_job = Lazy(lambda: PrewarmJob(
+    settings.PREWARM_START_HOUR,
+    settings.PREWARM_END_HOUR,
+    settings.PREWARM_MAX_DOSSIERS,
+    settings.PREWARM_MAX_COST_USD,
+    settings.PREWARM_FRESH_MARGIN_HOURS,
+    settings.PREWARM_PAUSE_SECONDS,
+    settings.BITRIX_DEAL_INN_FIELD,
+), "prewarm_job")
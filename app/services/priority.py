@@ -0,0 +1,328 @@
+"""
+Классы приоритета исследований и ограничение параллельных запросов к внешним API
+
+Класс определяется источником запроса (PRIORITY_SOURCES): менеджер в чате ждет ответа,
+робот сделки и пакетное обогащение - нет. Задания очереди выдаются воркерам по классу,
+а запросы к внешним API проходят через PriorityGate: из UPSTREAM_CONCURRENCY слотов
+PRIORITY_RESERVED_SLOTS[класс] доступны только этому классу и старшим, освободившийся слот
+достается самому старшему ожидающему. Так же воркер очереди оставляет WORKER_RESERVED_SLOTS
+своих слотов заданиям старших классов. Пакет из тысячи компаний не занимает слоты,
+зарезервированные для чата.
+
+Синхронные этапы досье выполняются в пуле потоков своего класса (PRIORITY_THREAD_POOLS), слот
+внешнего API занимается в event loop до запуска потока и освобождается, когда поток завершится
+(даже если вызывающий перестал ждать по таймауту). Фоновые исследования процесса API
+(RESEARCH_EXECUTION=inline) ограничены INLINE_JOB_CONCURRENCY по классу.
+"""
+import time
+import heapq
+import asyncio
+import logging
+import functools
+import itertools
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Callable, Dict, FrozenSet, List, Optional
+
+from app import request_context
+from app.config import settings
+from app.lazy import Lazy
+from app.services import deadline
+from app.services.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Классы от старшего к младшему
+CLASSES = ("interactive", "robot", "batch", "prefetch")
+DEFAULT_CLASS = "batch"
+
+
+# Внешние API, слот которых уже занят вызывающим (запросы из его потока идут без нового слота)
+_held: ContextVar[FrozenSet[str]] = ContextVar("held_upstream_slots", default=frozenset())
+
+
+def rank(priority: str) -> int:
+    """Номер класса (0 - старший; неизвестный класс - DEFAULT_CLASS)"""
+    return CLASSES.index(priority) if priority in CLASSES else CLASSES.index(DEFAULT_CLASS)
+
+
+def class_for(source: Optional[str]) -> str:
+    """Класс приоритета по источнику запроса (chat, robot, api, prefetch, prewarm)"""
+    return settings.PRIORITY_SOURCES.get(source or "", DEFAULT_CLASS)
+
+
+def current_class() -> str:
+    """Класс приоритета текущего запроса (по источнику в request_context)"""
+    ctx = request_context.current()
+    return class_for(ctx.source if ctx else None)
+
+
+def reserve_floors(reserved: Dict[str, int], limit: int) -> List[int]:
+    """
+    Сколько свободных слотов должно остаться, чтобы класс мог занять слот
+
+    Args:
+        reserved: Слоты, доступные только классу и старшим
+        limit: Всего слотов (младшим классам всегда остается хотя бы один)
+
+    Returns:
+        Порог по номеру класса: сумма резервов старших классов
+    """
+    return [min(sum(reserved.get(c, 0) for c in CLASSES[:i]), limit - 1) for i in range(len(CLASSES))]
+
+
+def max_rank(floors: List[int], free: int) -> int:
+    """Самый младший класс, которому доступен один из free свободных слотов (-1 - никому)"""
+    return max((position for position, floor in enumerate(floors) if free > floor), default=-1)
+
+
+class GateTimeout(TimeoutError):
+    """Слот не освободился до срока досье"""
+
+
+@dataclass(order=True)
+class _Waiter:
+    rank: int
+    seq: int
+    wake: object = field(compare=False)
+    granted: bool = field(default=False, compare=False)
+    cancelled: bool = field(default=False, compare=False)
+
+
+class PriorityGate:
+    """
+    Ограничение параллельных запросов к одному внешнему API с резервом слотов для старших классов
+
+    Работает и из потоков (slot), и из event loop (aslot): ожидающие обоих видов стоят в одной очереди.
+    """
+
+    def __init__(self, name: str, limit: int, reserved: Dict[str, int]):
+        self.name = name
+        self.limit = limit
+        # Класс может занять слот, только если свободных больше, чем зарезервировано для старших классов
+        self._floors = reserve_floors(reserved, limit)
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+
+    @property
+    def in_use(self) -> int:
+        return self._in_use
+
+    def _can_take(self, position: int) -> bool:
+        return self.limit - self._in_use > self._floors[position]
+
+    def _head(self) -> Optional[_Waiter]:
+        while self._waiters and self._waiters[0].cancelled:
+            heapq.heappop(self._waiters)
+        return self._waiters[0] if self._waiters else None
+
+    def _try_take(self, position: int) -> bool:
+        """Занять слот сразу, если он доступен классу и старшие не ждут (под блокировкой)"""
+        head = self._head()
+        if (head is None or head.rank > position) and self._can_take(position):
+            self._in_use += 1
+            return True
+        return False
+
+    def _dispatch(self):
+        """Выдача освободившихся слотов старшим ожидающим (под блокировкой)"""
+        while True:
+            head = self._head()
+            if head is None or not self._can_take(head.rank):
+                return
+            heapq.heappop(self._waiters)
+            self._in_use += 1
+            head.granted = True
+            head.wake()
+
+    def release(self):
+        """Освобождение занятого слота"""
+        with self._lock:
+            self._in_use -= 1
+            self._dispatch()
+
+    def _abandon(self, waiter: _Waiter) -> bool:
+        """Отказ от ожидания (таймаут, отмена). True - слот успели выдать, он занят"""
+        with self._lock:
+            if not waiter.granted:
+                waiter.cancelled = True
+            return waiter.granted
+
+    @contextmanager
+    def slot(self, priority: str, timeout: Optional[float] = None):
+        """Слот для синхронного запроса (ожидание не дольше timeout)"""
+        position = rank(priority)
+        started = time.perf_counter()
+        with self._lock:
+            waiter = None
+            if not self._try_take(position):
+                event = threading.Event()
+                waiter = _Waiter(position, next(self._seq), event.set)
+                heapq.heappush(self._waiters, waiter)
+        if waiter is not None and not event.wait(timeout) and not self._abandon(waiter):
+            raise GateTimeout(f"Нет свободного слота {self.name} за {timeout:.1f} с")
+        metrics.observe_upstream_wait(self.name, priority, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            self.release()
+
+    @asynccontextmanager
+    async def aslot(self, priority: str, timeout: Optional[float] = None):
+        """Слот для асинхронного запроса (ожидание не дольше timeout)"""
+        await self.acquire_async(priority, timeout)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire_async(self, priority: str, timeout: Optional[float] = None):
+        """Занять слот из event loop (ожидание не дольше timeout); освобождает release()"""
+        position = rank(priority)
+        started = time.perf_counter()
+        with self._lock:
+            waiter = None
+            if not self._try_take(position):
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+
+                def wake():
+                    loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+                waiter = _Waiter(position, next(self._seq), wake)
+                heapq.heappush(self._waiters, waiter)
+        if waiter is not None:
+            try:
+                await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                if not self._abandon(waiter):
+                    raise GateTimeout(f"Нет свободного слота {self.name} за {timeout:.1f} с") from None
+            except asyncio.CancelledError:
+                if self._abandon(waiter):
+                    self.release()
+                raise
+        metrics.observe_upstream_wait(self.name, priority, time.perf_counter() - started)
+
+
+class UpstreamGates:
+    """Ограничители по внешним API (без лимита в UPSTREAM_CONCURRENCY - без ограничения)"""
+
+    def __init__(self, limits: Dict[str, int], reserved: Dict[str, int]):
+        self.gates = {name: PriorityGate(name, limit, reserved) for name, limit in limits.items() if limit > 0}
+
+    @staticmethod
+    def _timeout() -> Optional[float]:
+        left = deadline.remaining()
+        return None if left is None else max(left, 0.0)
+
+    def slot(self, upstream: str):
+        """Слот запроса текущего класса к upstream (из потока; без слота, если его занял вызывающий)"""
+        gate = self.gates.get(upstream)
+        if gate is None or upstream in _held.get():
+            return nullcontext()
+        return gate.slot(current_class(), self._timeout())
+
+    def aslot(self, upstream: str):
+        """Слот запроса текущего класса к upstream (из event loop)"""
+        gate = self.gates.get(upstream)
+        return gate.aslot(current_class(), self._timeout()) if gate else nullcontext()
+
+    async def call(self, upstream: Optional[str], func: Callable, *args, timeout: Optional[float] = None):
+        """
+        Синхронная функция в пуле потоков текущего класса со слотом upstream, занятым в event loop
+
+        Поток не ждет слота и не занимает поток пула ожиданием. По таймауту вызывающий перестает ждать,
+        а слот освобождается, когда поток завершится (его HTTP запросы ограничены сроком досье).
+
+        Args:
+            upstream: Внешний API, к которому обращается функция (None или без лимита - без слота)
+            func: Функция (запросы к upstream из нее идут в занятом слоте)
+            *args: Аргументы функции
+            timeout: Сколько ждать результат, с
+
+        Returns:
+            Результат функции
+        """
+        priority = current_class()
+        gate = self.gates.get(upstream) if upstream else None
+        if gate is not None:
+            await gate.acquire_async(priority, self._timeout())
+        token = _held.set(_held.get() | {upstream}) if gate is not None else None
+        try:
+            context = contextvars.copy_context()
+            future = thread_pools.executor(priority).submit(context.run, functools.partial(func, *args))
+        except BaseException:
+            if gate is not None:
+                gate.release()
+            raise
+        finally:
+            if token is not None:
+                _held.reset(token)
+        if gate is not None:
+            future.add_done_callback(lambda _: gate.release())
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+
+
+class ThreadPools:
+    """Пулы потоков по классам приоритета: пакет не занимает потоки, нужные чату"""
+
+    def __init__(self, sizes: Dict[str, int]):
+        self.sizes = sizes
+        self._pools: Dict[str, ThreadPoolExecutor] = {}
+        self._lock = threading.Lock()
+
+    def executor(self, priority: str) -> ThreadPoolExecutor:
+        """Пул класса (создается при первом обращении)"""
+        priority = priority if priority in CLASSES else DEFAULT_CLASS
+        with self._lock:
+            pool = self._pools.get(priority)
+            if pool is None:
+                pool = ThreadPoolExecutor(self.sizes.get(priority, 4), thread_name_prefix=f"research-{priority}")
+                self._pools[priority] = pool
+            return pool
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """Аналог asyncio.to_thread в пуле класса текущего запроса"""
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor(current_class()), functools.partial(context.run, func, *args, **kwargs)
+        )
+
+    def shutdown(self):
+        """Остановка пулов (выполняемые функции дорабатывают)"""
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+class InlineJobs:
+    """Ограничение фоновых исследований процесса API по классу (нет в лимитах - без ограничения)"""
+
+    def __init__(self, limits: Dict[str, int]):
+        self.limits = limits
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def slot(self, priority: str):
+        """Место для фонового задания класса (задания сверх лимита ждут своей очереди)"""
+        limit = self.limits.get(priority, 0)
+        if limit <= 0:
+            return nullcontext()
+        semaphore = self._semaphores.get(priority)
+        if semaphore is None:
+            semaphore = self._semaphores[priority] = asyncio.Semaphore(limit)
+        return semaphore
+
+
+# Глобальные экземпляры (лимиты на процесс: API в режиме inline, каждый воркер в режиме queue)
+upstream_gates = Lazy(
+    lambda: UpstreamGates(settings.UPSTREAM_CONCURRENCY, settings.PRIORITY_RESERVED_SLOTS), "upstream_gates"
+)
+thread_pools = Lazy(lambda: ThreadPools(settings.PRIORITY_THREAD_POOLS), "thread_pools")
+inline_jobs = Lazy(lambda: InlineJobs(settings.INLINE_JOB_CONCURRENCY), "inline_jobs")
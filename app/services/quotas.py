@@ -0,0 +1,227 @@
+"""
+Квоты и справедливая очередь исследований по пользователям и порталам Битрикс24
+
+Арендатор - пользователь (user:<id>) и портал (portal:<домен>). У каждого есть лимит запросов
+в час и лимит стоимости за сутки (USD по журналу затрат); запрос проходит, только если
+оба арендатора в пределах лимитов. Сверх лимита запросов исследование откладывается
+до ближайшего часа со свободным лимитом (QUOTA_OVER_RATE=defer, режим очереди) или
+отклоняется; сверх дневного бюджета - отклоняется.
+
+Справедливость в очереди заданий - виртуальные часы потоков "портал + пользователь" (события
+CRM без пользователя - поток портала): задание получает метку max(сейчас, метка предыдущего
+задания потока) + QUOTA_FAIR_QUANTUM_SECONDS / (вес пользователя * вес портала). Внутри класса
+приоритета задания выдаются по метке, поэтому робот, поставивший сотню исследований,
+не задерживает остальных пользователей больше чем на одно задание в каждом кванте.
+
+Счетчики и метки хранятся в общем состоянии (app/services/shared_state.py).
+"""
+import time
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from urllib.parse import urlsplit
+
+from app import request_context
+from app.config import settings
+from app.lazy import Lazy
+from app.services.shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+# Источники без квот: ночной прогрев ограничен собственным бюджетом
+EXEMPT_SOURCES = ("prewarm",)
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+@dataclass
+class QuotaDecision:
+    """Результат проверки квот"""
+    allowed: bool
+    # Момент (time.time()), до которого исследование отложено (None - не отложено)
+    deferred_until: Optional[float] = None
+    # rate или cost - какой лимит превышен
+    reason: Optional[str] = None
+    tenant: Optional[str] = None
+    message: Optional[str] = None
+
+
+def default_portal() -> str:
+    """Домен портала из BITRIX24_WEBHOOK_URL (для запросов без auth[domain])"""
+    return urlsplit(settings.BITRIX24_WEBHOOK_URL).hostname or "default"
+
+
+def tenants(user_id: Optional[str], portal: Optional[str]) -> List[str]:
+    """Арендаторы запроса: пользователь (если известен) и портал"""
+    result = [f"portal:{portal or default_portal()}"]
+    if user_id:
+        result.insert(0, f"user:{user_id}")
+    return result
+
+
+def _describe(tenant: str) -> str:
+    kind, _, name = tenant.partition(":")
+    return f"пользователя {name}" if kind == "user" else f"портала {name}"
+
+
+def _at(timestamp: float) -> str:
+    moment = datetime.fromtimestamp(timestamp)
+    return f"{moment:%H:%M}" if moment.date() == datetime.now().date() else f"{moment:%d.%m %H:%M}"
+
+
+class Quotas:
+    """Лимиты запросов и стоимости арендаторов, метки справедливой очереди"""
+
+    def __init__(self, user_rate: int, portal_rate: int, user_cost: float, portal_cost: float,
+                 overrides: Dict[str, Dict[str, float]], over_rate: str, max_defer_hours: int, quantum: float):
+        self.defaults = {
+            "user": {"requests_per_hour": user_rate, "daily_cost_usd": user_cost, "weight": 1.0},
+            "portal": {"requests_per_hour": portal_rate, "daily_cost_usd": portal_cost, "weight": 1.0},
+        }
+        self.overrides = overrides
+        self.over_rate = over_rate
+        self.max_defer_hours = max_defer_hours
+        self.quantum = quantum
+
+    def limits(self, tenant: str) -> Dict[str, float]:
+        """Лимиты и вес арендатора (QUOTA_OVERRIDES поверх значений по умолчанию)"""
+        kind = tenant.partition(":")[0]
+        return {**self.defaults[kind], **self.overrides.get(tenant, {})}
+
+    @staticmethod
+    def _rate_key(tenant: str, hour: int) -> str:
+        return f"quota:rate:{tenant}:{hour}"
+
+    @staticmethod
+    def _cost_key(tenant: str, day: str) -> str:
+        return f"quota:cost:{tenant}:{day}"
+
+    def admit(self, user_id: Optional[str], portal: Optional[str], can_defer: bool) -> QuotaDecision:
+        """
+        Проверка квот перед постановкой исследования (запрос учитывается в лимите часа)
+
+        Args:
+            user_id: ID пользователя Битрикс24
+            portal: Домен портала (None - портал из BITRIX24_WEBHOOK_URL)
+            can_defer: Исследование можно отложить (режим очереди)
+
+        Returns:
+            Решение: разрешено сейчас, отложено до момента или отклонено с сообщением
+        """
+        now = time.time()
+        members = tenants(user_id, portal)
+
+        day = datetime.now().strftime("%Y-%m-%d")
+        for tenant in members:
+            limit = self.limits(tenant)["daily_cost_usd"]
+            spent = shared_state.get(self._cost_key(tenant, day)) or 0.0
+            if limit and spent >= limit:
+                tomorrow = datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+                return QuotaDecision(False, reason="cost", tenant=tenant, message=(
+                    f"⛔ Дневной бюджет на исследования для {_describe(tenant)} исчерпан "
+                    f"(${spent:.2f} из ${limit:.2f}). Повторите запрос после {_at(tomorrow.timestamp())}."
+                ))
+
+        defer = can_defer and self.over_rate == "defer"
+        hour = int(now // HOUR)
+        for offset in range(self.max_defer_hours + 1 if defer else 1):
+            blocked = self._take(members, hour + offset)
+            if blocked is None:
+                if offset == 0:
+                    return QuotaDecision(True)
+                until = (hour + offset) * HOUR
+                return QuotaDecision(True, deferred_until=until, reason="rate", tenant=first_blocked, message=(
+                    f"⏳ Лимит запросов для {_describe(first_blocked)} "
+                    f"({self.limits(first_blocked)['requests_per_hour']:g} в час) исчерпан. "
+                    f"Исследование поставлено в очередь и начнется после {_at(until)}."
+                ))
+            if offset == 0:
+                first_blocked = blocked
+
+        return QuotaDecision(False, reason="rate", tenant=first_blocked, message=(
+            f"⛔ Лимит запросов для {_describe(first_blocked)} "
+            f"({self.limits(first_blocked)['requests_per_hour']:g} в час) исчерпан. "
+            f"Повторите запрос после {_at((hour + 1) * HOUR)}."
+        ))
+
+    def _take(self, members: List[str], hour: int) -> Optional[str]:
+        """Учет запроса в часе hour у всех арендаторов (None - учтен; иначе арендатор без лимита)"""
+        taken: List[str] = []
+        for tenant in members:
+            limit = self.limits(tenant)["requests_per_hour"]
+            if not limit:
+                continue
+            key = self._rate_key(tenant, hour)
+            if shared_state.incr(key, 1, ttl=(hour + 1) * HOUR - time.time() + HOUR) > limit:
+                shared_state.incr(key, -1)
+                for key in taken:
+                    shared_state.incr(key, -1)
+                return tenant
+            taken.append(key)
+        return None
+
+    def charge(self, cost: float):
+        """Учет стоимости вызова LLM в дневном бюджете арендаторов текущего запроса"""
+        ctx = request_context.current()
+        if not cost or ctx is None or ctx.source in EXEMPT_SOURCES:
+            return
+        day = datetime.now().strftime("%Y-%m-%d")
+        for tenant in tenants(ctx.user_id, ctx.portal):
+            try:
+                shared_state.incr(self._cost_key(tenant, day), cost, ttl=2 * DAY)
+            except Exception as e:
+                logger.error(f"Ошибка учета стоимости {tenant}: {e}")
+
+    @staticmethod
+    def _clock_key(user_id: Optional[str], portal: Optional[str]) -> str:
+        return f"quota:clock:{portal or default_portal()}:{user_id or '-'}"
+
+    def fair_tag(self, user_id: Optional[str], portal: Optional[str]) -> float:
+        """Метка виртуальных часов для нового задания потока пользователя на портале"""
+        weight = 1.0
+        for tenant in tenants(user_id, portal):
+            weight *= self.limits(tenant)["weight"]
+        step = self.quantum / max(weight, 0.01)
+        # Часы простаивавшего потока догоняют реальное время; сдвиг атомарный в бэкенде
+        return shared_state.advance(self._clock_key(user_id, portal), time.time(), step, ttl=DAY)
+
+    def usage(self, user_id: Optional[str], portal: Optional[str]) -> Dict:
+        """
+        Расход квот арендаторов: запросы текущего часа и стоимость за сутки
+
+        Returns:
+            {арендатор: {requests_this_hour, requests_per_hour, rate_resets_at, cost_today_usd,
+            daily_cost_usd, weight}, backlog_seconds}
+        """
+        now = time.time()
+        hour = int(now // HOUR)
+        day = datetime.now().strftime("%Y-%m-%d")
+        # Насколько виртуальные часы потока ушли вперед (очередь его заданий)
+        clock = shared_state.get(self._clock_key(user_id, portal)) or now
+        result = {"backlog_seconds": round(max(0.0, clock - now), 1)}
+        for tenant in tenants(user_id, portal):
+            limits = self.limits(tenant)
+            result[tenant] = {
+                "requests_this_hour": int(shared_state.get(self._rate_key(tenant, hour)) or 0),
+                "requests_per_hour": limits["requests_per_hour"],
+                "rate_resets_at": datetime.fromtimestamp((hour + 1) * HOUR).isoformat(timespec="seconds"),
+                "cost_today_usd": round(shared_state.get(self._cost_key(tenant, day)) or 0.0, 4),
+                "daily_cost_usd": limits["daily_cost_usd"],
+                "weight": limits["weight"],
+            }
+        return result
+
+
+# Глобальный экземпляр
+quotas = Lazy(lambda: Quotas(
+    settings.QUOTA_USER_REQUESTS_PER_HOUR,
+    settings.QUOTA_PORTAL_REQUESTS_PER_HOUR,
+    settings.QUOTA_USER_DAILY_COST_USD,
+    settings.QUOTA_PORTAL_DAILY_COST_USD,
+    settings.QUOTA_OVERRIDES,
+    settings.QUOTA_OVER_RATE,
+    settings.QUOTA_MAX_DEFER_HOURS,
+    settings.QUOTA_FAIR_QUANTUM_SECONDS,
+), "quotas")
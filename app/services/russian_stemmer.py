@@ -0,0 +1,115 @@
+"""
+Стеммер русского языка (алгоритм Snowball, Портер) для полнотекстового поиска досье
+
+Токенайзеры SQLite FTS5 не знают русской морфологии, поэтому текст досье и запрос
+приводятся к основам до индексации: "компании", "компаниями" и "компания" дают одну основу.
+Слова не на кириллице (латиница, ИНН, домены) только приводятся к нижнему регистру.
+"""
+import re
+from typing import List, Optional, Sequence, Tuple
+
+VOWELS = set("аеиоуыэюя")
+
+_WORD = re.compile(r"\w+")
+_CYRILLIC = re.compile(r"[а-я]")
+
+# Группы окончаний: (окончания, перед окончанием должна стоять "а" или "я")
+PERFECTIVE_GERUND = (
+    (("в", "вши", "вшись"), True),
+    (("ив", "ивши", "ившись", "ыв", "ывши", "ывшись"), False),
+)
+ADJECTIVE = ((
+    ("ее", "ие", "ые", "ое", "ими", "ыми", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом",
+     "его", "ого", "ему", "ому", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею"),
+    False,
+),)
+PARTICIPLE = (
+    (("ем", "нн", "вш", "ющ", "щ"), True),
+    (("ивш", "ывш", "ующ"), False),
+)
+REFLEXIVE = ((("ся", "сь"), False),)
+VERB = (
+    (("ла", "на", "ете", "йте", "ли", "й", "л", "ем", "н", "ло", "но", "ет", "ют", "ны", "ть", "ешь", "нно"), True),
+    (("ила", "ыла", "ена", "ейте", "уйте", "ите", "или", "ыли", "ей", "уй", "ил", "ыл", "им", "ым", "ен",
+      "ило", "ыло", "ено", "ят", "ует", "уют", "ит", "ыт", "ены", "ить", "ыть", "ишь", "ую", "ю"), False),
+)
+NOUN = ((
+    ("а", "ев", "ов", "ие", "ье", "е", "иями", "ями", "ами", "еи", "ии", "и", "ией", "ей", "ой", "ий", "й",
+     "иям", "ям", "ием", "ем", "ам", "ом", "о", "у", "ах", "иях", "ях", "ы", "ь", "ию", "ью", "ю", "ия", "ья", "я"),
+    False,
+),)
+SUPERLATIVE = ((("ейше", "ейш"), False),)
+DERIVATIONAL = ((("ость", "ост"), False),)
+
+
+def _regions(word: str) -> Tuple[int, int]:
+    """Начало RV (после первой гласной) и R2 (Snowball)"""
+    length = len(word)
+    rv = next((i + 1 for i, char in enumerate(word) if char in VOWELS), length)
+    r1 = next((i + 1 for i in range(1, length) if word[i] not in VOWELS and word[i - 1] in VOWELS), length)
+    r2 = next((i + 1 for i in range(r1 + 1, length) if word[i] not in VOWELS and word[i - 1] in VOWELS), length)
+    return rv, r2
+
+
+def _strip(word: str, start: int, groups: Sequence[Tuple[Tuple[str, ...], bool]]) -> Optional[str]:
+    """
+    Удаление самого длинного окончания из групп, лежащего в области word[start:]
+
+    Returns:
+        Слово без окончания или None (окончания нет или перед окончанием группы нет "а"/"я")
+    """
+    best, needs_a = "", False
+    for endings, after_a in groups:
+        for ending in endings:
+            if len(ending) > len(best) and word.endswith(ending) and len(word) - len(ending) >= start:
+                best, needs_a = ending, after_a
+    if not best:
+        return None
+    stem = word[:-len(best)]
+    if needs_a and not (len(stem) > start and stem[-1] in "ая"):
+        return None
+    return stem
+
+
+def stem(word: str) -> str:
+    """Основа слова (нижний регистр, ё -> е)"""
+    word = word.lower().replace("ё", "е")
+    if not _CYRILLIC.search(word):
+        return word
+    rv, r2 = _regions(word)
+    if rv >= len(word):
+        return word
+
+    # Шаг 1: деепричастие совершенного вида, иначе возвратность и прилагательное/глагол/существительное
+    stripped = _strip(word, rv, PERFECTIVE_GERUND)
+    if stripped is not None:
+        word = stripped
+    else:
+        word = _strip(word, rv, REFLEXIVE) or word
+        adjective = _strip(word, rv, ADJECTIVE)
+        if adjective is not None:
+            word = _strip(adjective, rv, PARTICIPLE) or adjective
+        else:
+            word = _strip(word, rv, VERB) or _strip(word, rv, NOUN) or word
+
+    # Шаг 2: конечное "и"
+    if word.endswith("и") and len(word) - 1 >= rv:
+        word = word[:-1]
+
+    # Шаг 3: словообразовательное окончание в R2
+    word = _strip(word, max(r2, rv), DERIVATIONAL) or word
+
+    # Шаг 4: превосходная степень, двойное "н", мягкий знак
+    superlative = _strip(word, rv, SUPERLATIVE)
+    if superlative is not None:
+        word = superlative
+    if word.endswith("нн") and len(word) - 2 >= rv:
+        word = word[:-1]
+    elif superlative is None and word.endswith("ь") and len(word) - 1 >= rv:
+        word = word[:-1]
+    return word
+
+
+def tokens(text: str) -> List[str]:
+    """Основы всех слов текста в порядке следования"""
+    return [stem(word) for word in _WORD.findall(text or "")]
@@ -1,39 +1,376 @@
 """
 LangChain анализатор для создания досье компании с рекомендациями по продажам
 """
-import logging
+import re
+import time
 import json
-from typing import Dict
+import asyncio
+import hashlib
+import logging
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 from datetime import datetime
 
-from langchain_openai import ChatOpenAI
-from langchain.schema import SystemMessage, HumanMessage
-
+from app import request_context
 from app.config import settings
+from app.services import deadline
+from app.services.cassette import cassettes, cassette_name
+from app.services.cost_ledger import cost_ledger
+from app.services.metrics import metrics
+from app.services.openrouter_client import cached_tokens, message_text, openrouter_client, system_message
+from app.services.tracing import tracer
 from app.services.dadata import dadata_service
+from app.services.dossier_store import (
+    SECTIONS, SEPARATOR, DossierRecord, dossier_store, join_sections, split_sections, stale_sections,
+)
+from app.services.dossier_history import dossier_history
 from app.services.perplexity import perplexity_service
+from app.services.priority import thread_pools, upstream_gates
+from app.services.shared_state import shared_state
 from app.services.website_parser import website_parser
+from app.lazy import Lazy
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
 
 logger = logging.getLogger(__name__)
 
 
+# Шаблон досье. Входит в системный промпт, а не в промпт с данными: статический префикс
+# одинаков для всех компаний и кэшируется провайдером (см. system_message)
+DOSSIER_TEMPLATE = """═══════════════════════════════════
+📋 ДОСЬЕ КОМПАНИИ
+
+🏢 [НАЗВАНИЕ]
+📍 [Адрес]
+👤 Директор: [ФИО]
+✅ Статус: [Статус] с [Дата регистрации]
+
+═══════════════════════════════════
+
+📊 МАСШТАБ БИЗНЕСА
+💰 Оборот: [примерный оборот если найден]
+👥 Сотрудников: [примерное количество]
+📈 Динамика: [Растет/Стабильно/Падает - твоя оценка]
+🏆 Категория: [Малый/Средний/Крупный бизнес]
+
+═══════════════════════════════════
+
+🌐 ОНЛАЙН-ПРИСУТСТВИЕ
+• Сайт: [URL=https://example.com]example.com[/URL]
+• VK: [URL=https://vk.com/company]vk.com/company[/URL]
+• Telegram: [URL=https://t.me/channel]@channel[/URL]
+• YouTube: [URL=https://youtube.com/...]YouTube[/URL]
+
+📞 Телефоны:
+• [телефон 1]
+• [телефон 2]
+
+📧 Email:
+• [URL=mailto:email@company.ru]email@company.ru[/URL]
+
+═══════════════════════════════════
+
+👥 КЛЮЧЕВЫЕ ЛИЦА (публичные представители)
+
+[Для каждого найденного руководителя/публичного лица:]
+[N]️⃣ [ФИО] - [Должность]
+   📧 [URL=mailto:email@company.ru]email@company.ru[/URL]
+   📱 [телефон если найден]
+   🔗 LinkedIn: [URL=https://linkedin.com/in/...]профиль[/URL]
+   🔗 TenChat: [URL=https://tenchat.ru/...]профиль[/URL]
+   🔗 VK: [URL=https://vk.com/...]профиль[/URL]
+   💬 Telegram: [URL=https://t.me/username]@username[/URL]
+   📝 [Краткая справка о человеке если есть]
+
+[Если не найдены ЛПР, укажи директора из ЕГРЮЛ]
+
+═══════════════════════════════════
+
+💼 ЧЕМ ЗАНИМАЮТСЯ
+[Описание деятельности на основе ОКВЭД и найденной информации]
+
+Основные продукты/услуги:
+• [список если найдено]
+
+Целевая аудитория: [B2B/B2C/B2G]
+
+═══════════════════════════════════
+
+💻 ТЕХНОЛОГИИ
+[Если найдена информация об используемых технологиях:]
+• CRM: [название или "неизвестно"]
+• ERP: [название или "неизвестно"]
+• Другое: [список]
+
+[Если нет данных: "Информация о технологиях не найдена"]
+
+═══════════════════════════════════
+
+📰 ПОСЛЕДНИЕ НОВОСТИ
+[Из news_and_events.news - список 5-7 последних с кликабельными ссылками:]
+• [Дата]: [Краткое описание] - [URL=https://source.ru]источник[/URL]
+• [Дата]: [Краткое описание] - [URL=https://source.ru]источник[/URL]
+
+[Если нет: "Новости не найдены"]
+
+═══════════════════════════════════
+
+🎪 ВЫСТАВКИ И МЕРОПРИЯТИЯ
+[Из news_and_events.exhibitions и news_and_events.conferences]
+
+📍 Выставки:
+[Если есть выставки:]
+• [Дата]: [Название выставки] ([роль: экспонент/посетитель]) - [URL=https://...]ссылка[/URL]
+
+🎤 Конференции и форумы:
+[Если есть конференции:]
+• [Дата]: [Название] - спикер: [ФИО] - [URL=https://...]ссылка[/URL]
+
+🏆 Награды и рейтинги:
+[Из news_and_events.awards:]
+• [Год]: [Название награды/рейтинга] - [позиция] - [URL=https://...]ссылка[/URL]
+
+📅 Предстоящие мероприятия:
+[Из news_and_events.upcoming_events:]
+• [Дата]: [Название] ([тип]) - [URL=https://...]ссылка[/URL]
+
+[Если нет данных: "Информация о мероприятиях не найдена"]
+
+Медиа-активность: [news_and_events.media_activity_score]
+
+═══════════════════════════════════
+
+🎯 ВАЖНО ДЛЯ ПРОДАЖИ
+
+📌 НА ЧТО СДЕЛАТЬ АКЦЕНТ:
+• [Боль 1: что наш продукт может решить для такой компании]
+• [Боль 2]
+• [Боль 3]
+
+⚠️ ЧТО УЧЕСТЬ:
+• [Особенность 1: что важно знать о компании]
+• [Особенность 2: возможные возражения]
+• [Особенность 3: на что обратить внимание]
+
+═══════════════════════════════════
+
+Используй найденные данные для персонализации рекомендаций."""
+
+
+@contextmanager
+def _stage(name: str):
+    """Этап досье: гистограмма в метриках и спан в трейсе"""
+    with metrics.stage(name), tracer.span(f"stage.{name}"):
+        yield
+
+
+def _to_number(value) -> Optional[float]:
+    """Число из поля ЕГРЮЛ или ответа Perplexity ("50-100", "1 200", 250)"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        numbers = re.findall(r"\d+", value.replace(" ", "").replace("\u00a0", ""))
+        if numbers:
+            # Для диапазона берем верхнюю границу
+            return float(max(int(number) for number in numbers))
+    return None
+
+
+# Интервал проверки, закончил ли другой воркер сборку того же досье
+INFLIGHT_POLL_SECONDS = 1.0
+
+# Пометка сведений, которые не успели собрать к сроку досье
+MISSING_MARK = "⚠️ Нет данных: источник не ответил вовремя"
+
+
+# Ключи агрегированных данных по источникам досье (см. DOSSIER_SOURCE_TTL_DAYS)
+SOURCE_DATA_KEYS = {
+    "egrul": ("egrul",),
+    "online_presence": ("online_presence",),
+    "website": ("website_contacts", "website_legal_info"),
+    "executives": ("executives",),
+    "business": ("business_info",),
+    "news": ("news_and_events",),
+}
+
+# Внешний API, к которому обращается запрос источника (слот UPSTREAM_CONCURRENCY занимается до запуска потока)
+SOURCE_UPSTREAMS = {
+    "egrul": "dadata",
+    "online_presence": "openrouter",
+    "website": "website",
+    "executives": "openrouter",
+    "business": "openrouter",
+    "news": "openrouter",
+}
+
+
+@dataclass
+class LLMRoute:
+    """Выбранная модель генерации досье"""
+    name: str
+    model: str
+    max_tokens: int
+    reason: str
+
+
 class SalesAnalyzer:
     """Анализатор для создания досье компании"""
 
     def __init__(self):
-        self.llm = self._init_llm()
+        self.llm_client = settings.LLM_CLIENT
+        self._llm: Optional["ChatOpenAI"] = None
+        # Досье, которые строятся сейчас (ИНН -> результат): повторный запрос дожидается их
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    @property
+    def llm(self) -> "ChatOpenAI":
+        """LangChain LLM (строится при первом обращении, только для LLM_CLIENT=langchain)"""
+        if self._llm is None:
+            self._llm = self._init_llm()
+        return self._llm
+
+    def warm_up(self):
+        """Построение выбранного LLM клиента до первого досье"""
+        if self.llm_client == "langchain":
+            self.llm
+        else:
+            openrouter_client._http()
 
-    def _init_llm(self) -> ChatOpenAI:
+    def _init_llm(self) -> "ChatOpenAI":
         """Инициализация LLM через OpenRouter"""
+        # LangChain импортируется только если он выбран в LLM_CLIENT
+        from langchain_openai import ChatOpenAI
+
         return ChatOpenAI(
             model=settings.DEFAULT_MODEL,
-            openai_api_base="https://openrouter.ai/api/v1",
+            openai_api_base=settings.OPENROUTER_BASE_URL,
             openai_api_key=settings.OPENROUTER_API_KEY,
             temperature=0.3,
-            max_tokens=4000
+            max_tokens=settings.DEFAULT_MAX_TOKENS,
+            # Просим OpenRouter вернуть стоимость вызова в usage.cost
+            model_kwargs={"extra_body": {"usage": {"include": True}}}
         )
 
     async def create_company_dossier(self, inn: str = None, company_name: str = None, company_website: str = None) -> str:
+        """
+        Создание полного досье компании (с замером общего времени)
+
+        Запрос по ИНН, досье которого уже строится (например, предварительным исследованием
+        по событию CRM), не запускает сборку заново, а дожидается ее результата: в этом процессе -
+        по future, в другом воркере - по отметке в общем состоянии, после чего берет досье из хранилища.
+
+        Args:
+            inn: ИНН компании (опционально)
+            company_name: Название компании (опционально)
+            company_website: Сайт компании (опционально, если известен заранее)
+
+        Returns:
+            Отформатированное досье в виде текста
+        """
+        if inn and inn in self._inflight:
+            logger.info(f"Досье {inn} уже строится, ожидаем результат")
+            metrics.dossier_cache.labels(result="joined").inc()
+            return await asyncio.shield(self._inflight[inn])
+
+        future = None
+        claimed: Optional[str] = None
+        if inn:
+            future = asyncio.get_running_loop().create_future()
+            # Ошибку получает владелец сборки; без ожидающих future не должен о ней предупреждать
+            future.add_done_callback(lambda done: done.cancelled() or done.exception())
+            self._inflight[inn] = future
+        try:
+            with (
+                metrics.dossier_duration.time(),
+                cassettes.use(cassette_name(inn, company_name, company_website)),
+                deadline.within(self._deadline_seconds()),
+            ):
+                if inn and settings.DOSSIER_CACHE:
+                    claimed = await self._claim_build(inn)
+                dossier = await self._create_company_dossier(inn=inn, company_name=company_name, company_website=company_website)
+            if future is not None:
+                future.set_result(dossier)
+            return dossier
+        except asyncio.CancelledError:
+            if future is not None:
+                future.cancel()
+            raise
+        except Exception as e:
+            if future is not None:
+                future.set_exception(e)
+            raise
+        finally:
+            if inn:
+                self._inflight.pop(inn, None)
+            if claimed:
+                await asyncio.to_thread(self._release_build, inn, claimed)
+
+    async def _claim_build(self, inn: str) -> Optional[str]:
+        """
+        Отметка сборки досье в общем состоянии; пока досье строит другой воркер - ожидание
+
+        Returns:
+            Владелец отметки (ID запроса; снимается по завершении только им) или None - общее
+            состояние недоступно или ожидание исчерпало срок (досье строится без отметки)
+        """
+        key = f"inflight:{inn}"
+        owner = request_context.get_request_id() or request_context.new_request_id()
+        # Отметка упавшего воркера истекает вместе со сроком досье
+        ttl = (deadline.remaining() or settings.LLM_TIMEOUT) + 60
+        waiting = False
+        try:
+            while not await asyncio.to_thread(shared_state.add, key, owner, ttl):
+                if not waiting:
+                    logger.info(f"Досье {inn} строится в другом воркере, ожидаем результат")
+                    metrics.dossier_cache.labels(result="joined").inc()
+                    waiting = True
+                left = deadline.remaining()
+                if left is not None and left <= settings.DOSSIER_LLM_RESERVE_SECONDS:
+                    logger.warning(f"Досье {inn} не дождались от другого воркера, строим сами")
+                    return None
+                await asyncio.sleep(INFLIGHT_POLL_SECONDS)
+        except Exception as e:
+            logger.warning(f"Общее состояние недоступно, досье {inn} строится без отметки: {e}")
+            return None
+        return owner
+
+    def _release_build(self, inn: str, owner: str):
+        """Снятие своей отметки сборки досье (истекшую и занятую другим воркером не трогаем)"""
+        try:
+            if not shared_state.release(f"inflight:{inn}", owner):
+                logger.warning(f"Отметка сборки досье {inn} истекла до завершения сборки")
+        except Exception as e:
+            logger.warning(f"Не удалось снять отметку сборки досье {inn}: {e}")
+
+    def _identify(self, query: str) -> Dict:
+        """
+        Поиск компании и ИНН через Perplexity с кэшем найденных результатов в общем состоянии
+
+        Args:
+            query: Название, сайт или ИНН
+        """
+        key = f"identification:{hashlib.sha1(query.strip().lower().encode('utf-8')).hexdigest()[:20]}"
+        ttl = settings.IDENTIFICATION_CACHE_HOURS * 3600
+        if ttl:
+            try:
+                cached = shared_state.get(key)
+                if cached is not None:
+                    logger.info(f"Идентификация '{query}' взята из кэша")
+                    return cached
+            except Exception as e:
+                logger.warning(f"Кэш идентификации недоступен: {e}")
+
+        result = perplexity_service.find_company_with_inn(query)
+        if ttl and result.get("found") and result.get("variants"):
+            try:
+                shared_state.set(key, result, ttl)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить идентификацию в кэш: {e}")
+        return result
+
+    async def _create_company_dossier(self, inn: str = None, company_name: str = None, company_website: str = None) -> str:
         """
         Создание полного досье компании с рекомендациями по продажам
 
@@ -63,80 +400,92 @@ class SalesAnalyzer:
         confirmed_inn = inn        # Подтвержденный ИНН
         confirmed_website = company_website  # Подтвержденный сайт
         egrul_data = None
-
-        # ШАГ 1.1: Если есть сайт - парсим его для получения юр. данных
-        if company_website:
-            try:
-                logger.info("Шаг 1.1: Извлечение юридической информации с сайта")
-                legal_info = website_parser.extract_legal_info(company_website)
-
-                if legal_info.get("inn"):
-                    confirmed_inn = legal_info["inn"]
-                    logger.info(f"ИНН с сайта: {confirmed_inn}")
-
-                if legal_info.get("company_name"):
-                    confirmed_name = legal_info["company_name"]
-                    logger.info(f"Название компании с сайта: {confirmed_name}")
-            except Exception as e:
-                logger.warning(f"Ошибка извлечения юридической информации с сайта: {e}")
-
-        # ШАГ 1.2: Если есть ИНН - получаем данные из ЕГРЮЛ (DaData)
-        if confirmed_inn:
-            try:
-                logger.info("Шаг 1.2: Получение данных из ЕГРЮЛ (DaData)")
-                egrul_data = dadata_service.find_company_by_inn(confirmed_inn)
-
-                if egrul_data:
-                    # ЕГРЮЛ - официальный источник, его данные приоритетны
-                    confirmed_name = egrul_data["short_name"] or egrul_data["full_name"]
-                    logger.info(f"ЕГРЮЛ подтвердил: {confirmed_name}")
-            except Exception as e:
-                logger.error(f"Ошибка получения данных из DaData: {e}")
-
-        # ШАГ 1.3: Если нет ИНН - ищем компанию через Perplexity
-        if not confirmed_inn and (company_name or company_website):
-            try:
-                search_query = company_name or company_website
-                logger.info(f"Шаг 1.3: Поиск компании через Perplexity: {search_query}")
-                company_search = perplexity_service.find_company_with_inn(search_query)
-
-                if company_search.get("found") and company_search.get("variants"):
-                    first_variant = company_search["variants"][0]
-                    confirmed_inn = first_variant.get("inn")
-                    if not confirmed_name:
+        record = None  # Сохраненное досье (по ИНН)
+        fetched: Dict[str, Dict] = {}  # Источники, полученные в этом запросе
+
+        with _stage("identification"), deadline.within(self._stage_budget("identification")):
+            # ШАГ 1.1: Если есть сайт - парсим его для получения юр. данных
+            if company_website:
+                try:
+                    logger.info("Шаг 1.1: Извлечение юридической информации с сайта")
+                    legal_info = await upstream_gates.call("website", website_parser.extract_legal_info, company_website)
+
+                    if legal_info.get("inn"):
+                        confirmed_inn = legal_info["inn"]
+                        logger.info(f"ИНН с сайта: {confirmed_inn}")
+
+                    if legal_info.get("company_name"):
+                        confirmed_name = legal_info["company_name"]
+                        logger.info(f"Название компании с сайта: {confirmed_name}")
+                except Exception as e:
+                    logger.warning(f"Ошибка извлечения юридической информации с сайта: {e}")
+
+            # ШАГ 1.2: Если есть ИНН - получаем данные из ЕГРЮЛ (DaData)
+            if confirmed_inn:
+                try:
+                    logger.info("Шаг 1.2: Получение данных из ЕГРЮЛ (DaData)")
+                    record = await thread_pools.run(self._load_dossier, confirmed_inn)
+                    if not confirmed_website and record is not None and record.website:
+                        # Сайт, с которым досье строилось раньше (например, из карточки компании CRM)
+                        confirmed_website = record.website
+                    egrul_data = await self._source(
+                        record, fetched, "egrul", lambda: dadata_service.find_company_by_inn(confirmed_inn)
+                    )
+
+                    if egrul_data:
+                        # ЕГРЮЛ - официальный источник, его данные приоритетны
+                        confirmed_name = egrul_data["short_name"] or egrul_data["full_name"]
+                        logger.info(f"ЕГРЮЛ подтвердил: {confirmed_name}")
+                except Exception as e:
+                    logger.error(f"Ошибка получения данных из DaData: {e}")
+
+            # ШАГ 1.3: Если нет ИНН - ищем компанию через Perplexity
+            if not confirmed_inn and (company_name or company_website):
+                try:
+                    search_query = company_name or company_website
+                    logger.info(f"Шаг 1.3: Поиск компании через Perplexity: {search_query}")
+                    company_search = await upstream_gates.call("openrouter", self._identify, search_query)
+
+                    if company_search.get("found") and company_search.get("variants"):
+                        first_variant = company_search["variants"][0]
+                        confirmed_inn = first_variant.get("inn")
+                        if not confirmed_name:
+                            confirmed_name = first_variant.get("short_name") or first_variant.get("name")
+                        # Также получаем сайт если его нет
+                        if not confirmed_website and first_variant.get("website"):
+                            confirmed_website = first_variant["website"]
+
+                        logger.info(f"Perplexity нашел: {confirmed_name}, ИНН: {confirmed_inn}")
+
+                        # Теперь подтверждаем через ЕГРЮЛ
+                        if confirmed_inn and not egrul_data:
+                            try:
+                                record = await thread_pools.run(self._load_dossier, confirmed_inn)
+                                egrul_data = await self._source(
+                                    record, fetched, "egrul", lambda: dadata_service.find_company_by_inn(confirmed_inn)
+                                )
+                                if egrul_data:
+                                    confirmed_name = egrul_data["short_name"] or egrul_data["full_name"]
+                                    logger.info(f"ЕГРЮЛ подтвердил: {confirmed_name}")
+                            except Exception as e:
+                                logger.error(f"Ошибка подтверждения через DaData: {e}")
+                except Exception as e:
+                    logger.error(f"Ошибка поиска через Perplexity: {e}")
+
+            # ШАГ 1.4: Если ИНН есть, но название не найдено - пробуем Perplexity по ИНН
+            if confirmed_inn and not confirmed_name:
+                try:
+                    logger.info("Шаг 1.4: Поиск названия по ИНН через Perplexity")
+                    company_search = await upstream_gates.call("openrouter", self._identify, confirmed_inn)
+
+                    if company_search.get("found") and company_search.get("variants"):
+                        first_variant = company_search["variants"][0]
                         confirmed_name = first_variant.get("short_name") or first_variant.get("name")
-                    # Также получаем сайт если его нет
-                    if not confirmed_website and first_variant.get("website"):
-                        confirmed_website = first_variant["website"]
-
-                    logger.info(f"Perplexity нашел: {confirmed_name}, ИНН: {confirmed_inn}")
-
-                    # Теперь подтверждаем через ЕГРЮЛ
-                    if confirmed_inn and not egrul_data:
-                        try:
-                            egrul_data = dadata_service.find_company_by_inn(confirmed_inn)
-                            if egrul_data:
-                                confirmed_name = egrul_data["short_name"] or egrul_data["full_name"]
-                                logger.info(f"ЕГРЮЛ подтвердил: {confirmed_name}")
-                        except Exception as e:
-                            logger.error(f"Ошибка подтверждения через DaData: {e}")
-            except Exception as e:
-                logger.error(f"Ошибка поиска через Perplexity: {e}")
-
-        # ШАГ 1.4: Если ИНН есть, но название не найдено - пробуем Perplexity по ИНН
-        if confirmed_inn and not confirmed_name:
-            try:
-                logger.info("Шаг 1.4: Поиск названия по ИНН через Perplexity")
-                company_search = perplexity_service.find_company_with_inn(confirmed_inn)
-
-                if company_search.get("found") and company_search.get("variants"):
-                    first_variant = company_search["variants"][0]
-                    confirmed_name = first_variant.get("short_name") or first_variant.get("name")
-                    if not confirmed_website and first_variant.get("website"):
-                        confirmed_website = first_variant["website"]
-                    logger.info(f"Perplexity нашел по ИНН: {confirmed_name}")
-            except Exception as e:
-                logger.error(f"Ошибка поиска через Perplexity по ИНН: {e}")
+                        if not confirmed_website and first_variant.get("website"):
+                            confirmed_website = first_variant["website"]
+                        logger.info(f"Perplexity нашел по ИНН: {confirmed_name}")
+                except Exception as e:
+                    logger.error(f"Ошибка поиска через Perplexity по ИНН: {e}")
 
         # Финальная проверка - должно быть хотя бы название
         if not confirmed_name:
@@ -156,17 +505,31 @@ class SalesAnalyzer:
         # Используем confirmed_name, confirmed_inn, confirmed_website
         # =================================================================
 
+        # ИНН мог стать известен только сейчас - помечаем им трейс и учет затрат
+        request_context.update(inn=confirmed_inn)
+        if record is None:
+            record = await thread_pools.run(self._load_dossier, confirmed_inn)
+
         logger.info(f"=== КОМПАНИЯ ИДЕНТИФИЦИРОВАНА ===")
         logger.info(f"Название: {confirmed_name}")
         logger.info(f"ИНН: {confirmed_inn}")
         logger.info(f"Сайт: {confirmed_website}")
         logger.info(f"=================================")
 
+        # Этапы сбора необязательны: при нехватке времени или ошибке источник попадает в missing,
+        # и досье строится из собранного
+        missing: List[str] = []
+
         # ШАГ 2.1: ПОИСК ОНЛАЙН-ПРИСУТСТВИЯ (если сайт еще не известен)
         logger.info("Шаг 2/5: Поиск сайта и соцсетей")
         online_presence = {}
         if not confirmed_website:
-            online_presence = perplexity_service.find_online_presence(confirmed_name, confirmed_inn)
+            online_presence = await self._source(
+                record, fetched, "online_presence",
+                lambda: perplexity_service.find_online_presence(confirmed_name, confirmed_inn),
+                stage="online_presence",
+                missing=missing,
+            )
             if online_presence.get("website"):
                 confirmed_website = online_presence["website"]
                 logger.info(f"Найден сайт: {confirmed_website}")
@@ -178,16 +541,35 @@ class SalesAnalyzer:
         website_contacts = {}
         website_legal_info = {}
         if confirmed_website:
-            website_contacts = website_parser.parse_contacts(confirmed_website)
-            website_legal_info = website_parser.extract_legal_info(confirmed_website)
+            website = await self._source(
+                record, fetched, "website",
+                lambda: {
+                    "url": confirmed_website,
+                    "contacts": website_parser.parse_contacts(confirmed_website),
+                    "legal_info": website_parser.extract_legal_info(confirmed_website),
+                },
+                stage="website",
+                valid=lambda cached: cached.get("url") == confirmed_website,
+                missing=missing,
+            )
+            website_contacts = website.get("contacts") or {}
+            website_legal_info = website.get("legal_info") or {}
             if website_legal_info:
                 logger.info(f"Юридическая информация с сайта: {website_legal_info}")
 
         # ШАГ 2.3: ПОИСК ЛПР И БИЗНЕС-ИНФОРМАЦИИ
         logger.info("Шаг 4/5: Поиск ЛПР и бизнес-информации (Perplexity)")
         # ВАЖНО: используем confirmed_name и confirmed_inn для консистентности
-        executives_data = perplexity_service.find_executives(confirmed_name)
-        business_info = perplexity_service.find_business_info(confirmed_name, confirmed_inn)
+        executives_data = await self._source(
+            record, fetched, "executives", lambda: perplexity_service.find_executives(confirmed_name),
+            stage="executives", missing=missing,
+        )
+        business_info = await self._source(
+            record, fetched, "business",
+            lambda: perplexity_service.find_business_info(confirmed_name, confirmed_inn),
+            stage="business",
+            missing=missing,
+        )
 
         # ШАГ 2.4: ПОИСК НОВОСТЕЙ И МЕРОПРИЯТИЙ
         logger.info("Шаг 5/5: Поиск новостей и мероприятий (Perplexity)")
@@ -196,7 +578,12 @@ class SalesAnalyzer:
         if business_info and business_info.get("business"):
             industry = business_info["business"].get("industry")
         # ВАЖНО: используем confirmed_name и confirmed_inn
-        news_and_events = perplexity_service.find_news_and_events(confirmed_name, confirmed_inn, industry)
+        news_and_events = await self._source(
+            record, fetched, "news",
+            lambda: perplexity_service.find_news_and_events(confirmed_name, confirmed_inn, industry),
+            stage="news",
+            missing=missing,
+        )
 
         # Агрегируем все данные
         aggregated_data = {
@@ -213,46 +600,346 @@ class SalesAnalyzer:
                 "website": confirmed_website
             }
         }
+        if missing:
+            aggregated_data["missing_sources"] = missing
+            logger.warning(f"Досье строится без источников {missing}: не получены к сроку")
 
         logger.info("Генерация итогового досье с помощью LLM")
 
-        # Генерируем досье с помощью LLM
-        dossier = self._generate_dossier_with_llm(aggregated_data)
+        # Генерируем досье с помощью LLM (или обновляем разделы сохраненного)
+        dossier = await self._compose_dossier(record, fetched, aggregated_data)
+        await thread_pools.run(self._archive_dossier, aggregated_data, dossier)
+        return dossier
+
+    async def _compose_dossier(self, record: Optional[DossierRecord], fetched: Dict[str, Dict], data: Dict) -> str:
+        """
+        Досье из сохраненных разделов и собранных данных
+
+        Все источники взяты из хранилища - сохраненный текст без вызова LLM; часть источников
+        получена заново - перегенерация только зависящих от них разделов; иначе генерация целиком.
+
+        Args:
+            record: Сохраненное досье (None - нет или хранилище выключено)
+            fetched: Источники, полученные в этом запросе
+            data: Агрегированные данные о компании
+
+        Returns:
+            Отформатированное досье
+        """
+        if record is not None and record.complete:
+            stale = stale_sections(fetched)
+            if not stale:
+                metrics.dossier_cache.labels("hit").inc()
+                logger.info("Досье из хранилища: все источники актуальны")
+                return record.text
+            try:
+                with _stage("llm"):
+                    sections = await self._generate_dossier_with_llm(data, stale)
+                updated = split_sections(sections)
+                if not updated:
+                    raise ValueError("в ответе нет ни одного раздела")
+            except Exception as e:
+                logger.error(f"Ошибка обновления разделов досье {stale}, генерация целиком: {e}")
+            else:
+                # Разделы, которые модель не вернула, остаются прежними
+                updated = {key: updated[key] for key in stale if key in updated}
+                merged = {key: entry["text"] for key, entry in record.sections.items()}
+                merged.update(updated)
+                dossier = join_sections(merged)
+                metrics.dossier_cache.labels("sections").inc()
+                await thread_pools.run(self._save_dossier, data, fetched, updated, dossier)
+                return dossier
+
+        try:
+            with _stage("llm"):
+                dossier = await self._generate_dossier_with_llm(data)
+        except Exception as e:
+            logger.error(f"Ошибка при генерации досье: {e}")
+            await thread_pools.run(self._save_dossier, data, fetched, {}, None)
+            # Fallback: возвращаем базовое досье без LLM анализа
+            return self._generate_fallback_dossier(data)
 
+        metrics.dossier_cache.labels("full").inc()
+        await thread_pools.run(self._save_dossier, data, fetched, split_sections(dossier), dossier, full=True)
         return dossier
 
-    def _generate_dossier_with_llm(self, data: Dict) -> str:
+    async def _generate_dossier_with_llm(self, data: Dict, sections: Optional[List[str]] = None) -> str:
         """
         Генерация досье с использованием LLM
 
         Args:
             data: Агрегированные данные о компании
+            sections: Только эти разделы (ключи SECTIONS), None - досье целиком
 
         Returns:
-            Отформатированное досье
+            Отформатированное досье или запрошенные разделы
         """
         # Формируем промпт для LLM
         system_prompt = self._get_system_prompt()
-        user_prompt = self._get_user_prompt(data)
+        route = self._choose_route(data)
+        if sections is None:
+            user_prompt = self._get_user_prompt(data)
+        else:
+            user_prompt = self._get_sections_prompt(data, sections)
+            route = LLMRoute(
+                "sections",
+                route.model,
+                min(route.max_tokens, settings.DOSSIER_SECTION_MAX_TOKENS * len(sections)),
+                f"разделы {', '.join(sections)}; {route.reason}",
+            )
+
+        messages = [
+            system_message(system_prompt, route.model),
+            {"role": "user", "content": user_prompt},
+        ]
+
+        timeout = self._llm_timeout()
+        start = time.perf_counter()
+        with tracer.span(
+            "llm.generate", model=route.model, route=route.name, max_tokens=route.max_tokens, client=self.llm_client,
+            timeout=round(timeout, 1),
+        ) as span:
+            dossier, token_usage = await self._invoke_llm(messages, route, timeout)
+            span.set(size=len(dossier), usage=token_usage)
+        duration = time.perf_counter() - start
+        metrics.observe_llm_route(route.name, route.model, duration)
+        metrics.record_usage("llm", route.model, token_usage)
+        cost_ledger.record("llm", route.model, token_usage)
+        logger.info(
+            f"Досье сгенерировано маршрутом {route.name} ({route.model}, max_tokens={route.max_tokens}) "
+            f"за {duration:.1f} с: {route.reason}, "
+            f"токенов {(token_usage or {}).get('completion_tokens', '?')}, из кэша {cached_tokens(token_usage)}"
+        )
 
+        return dossier
+
+    def _load_dossier(self, inn: Optional[str]) -> Optional[DossierRecord]:
+        """Сохраненное досье по ИНН (None - нет ИНН, хранилище выключено или недоступно)"""
+        if not settings.DOSSIER_CACHE or not inn:
+            return None
         try:
-            messages = [
-                SystemMessage(content=system_prompt),
-                HumanMessage(content=user_prompt)
-            ]
+            return dossier_store.load(inn)
+        except Exception as e:
+            logger.error(f"Ошибка чтения сохраненного досье {inn}: {e}")
+            return None
 
-            response = self.llm.invoke(messages)
-            dossier = response.content
+    async def _source(self, record: Optional[DossierRecord], fetched: Dict[str, Dict], source: str,
+                      fetch: Callable[[], Dict], stage: Optional[str] = None,
+                      valid: Optional[Callable[[Dict], bool]] = None,
+                      missing: Optional[List[str]] = None) -> Dict:
+        """
+        Данные источника: из сохраненного досье, если не устарели, иначе запрос (в отдельном потоке)
 
-            return dossier
+        Args:
+            record: Сохраненное досье
+            fetched: Полученные в этом запросе источники (дополняется)
+            source: Источник (ключ DOSSIER_SOURCE_TTL_DAYS)
+            fetch: Запрос источника
+            stage: Этап досье для метрик запроса
+            valid: Дополнительная проверка сохраненных данных (например, тот же сайт)
+            missing: Недостающие источники (дополняется). Если передан, источник необязательный:
+                запрос ограничен бюджетом этапа, при неудаче - устаревшие сохраненные данные или {}
 
+        Returns:
+            Данные источника
+        """
+        stored = record.sources.get(source) if record is not None else None
+        if stored is not None and valid is not None and not valid(stored["data"]):
+            stored = None
+        if stored is not None and record.fresh_source(source) is not None:
+            logger.info(f"Источник {source} взят из сохраненного досье")
+            return stored["data"]
+
+        upstream = SOURCE_UPSTREAMS.get(source)
+        if missing is None:
+            if stage:
+                with _stage(stage):
+                    data = await upstream_gates.call(upstream, fetch)
+            else:
+                data = await upstream_gates.call(upstream, fetch)
+        else:
+            data = await self._optional_stage(stage, fetch, upstream)
+            if data is None:
+                if stored is not None:
+                    logger.warning(f"Источник {source} не обновлен, используются устаревшие данные")
+                    return stored["data"]
+                missing.append(source)
+                return {}
+        fetched[source] = data
+        return data
+
+    async def _optional_stage(self, stage: str, fetch: Callable[[], Dict],
+                              upstream: Optional[str] = None) -> Optional[Dict]:
+        """
+        Необязательный этап в пределах бюджета
+
+        Args:
+            stage: Этап (ключ DOSSIER_STAGE_BUDGETS)
+            fetch: Запрос источника
+            upstream: Внешний API источника (слот занимается до запуска потока)
+
+        Returns:
+            Данные или None (этап пропущен, прерван или завершился ошибкой)
+        """
+        budget = self._stage_budget(stage)
+        if budget is not None and budget < settings.DOSSIER_MIN_STAGE_SECONDS:
+            logger.warning(f"Этап {stage} пропущен: до срока досье {deadline.remaining():.0f} с")
+            metrics.stage_skipped.labels(stage, "deadline").inc()
+            return None
+        try:
+            with _stage(stage), deadline.within(budget):
+                # Поток по таймауту не прерывается, но его HTTP запросы ограничены тем же сроком,
+                # а слот внешнего API освобождается, когда поток завершится
+                return await upstream_gates.call(upstream, fetch, timeout=budget)
+        except asyncio.TimeoutError:
+            logger.warning(f"Этап {stage} прерван: бюджет {budget:.1f} с исчерпан")
+            metrics.stage_skipped.labels(stage, "timeout").inc()
         except Exception as e:
-            logger.error(f"Ошибка при генерации досье: {e}")
-            # Fallback: возвращаем базовое досье без LLM анализа
-            return self._generate_fallback_dossier(data)
+            logger.error(f"Ошибка этапа {stage}: {e}")
+            metrics.stage_skipped.labels(stage, "error").inc()
+        return None
+
+    def _deadline_seconds(self) -> Optional[float]:
+        """Срок досье для точки входа текущего запроса (DOSSIER_DEADLINE_SECONDS)"""
+        ctx = request_context.current()
+        deadlines = settings.DOSSIER_DEADLINE_SECONDS
+        return deadlines.get((ctx.source if ctx else None) or "default", deadlines.get("default"))
+
+    def _stage_budget(self, stage: str) -> Optional[float]:
+        """Бюджет этапа: не больше DOSSIER_STAGE_BUDGETS и остатка срока за вычетом резерва на LLM"""
+        budget = settings.DOSSIER_STAGE_BUDGETS.get(stage)
+        left = deadline.remaining()
+        if left is not None:
+            left -= settings.DOSSIER_LLM_RESERVE_SECONDS
+            budget = left if budget is None else min(budget, left)
+        return budget
+
+    def _llm_timeout(self) -> float:
+        """Таймаут генерации: остаток срока, но не меньше резерва и не больше бюджета этапа llm"""
+        timeout = min(settings.LLM_TIMEOUT, settings.DOSSIER_STAGE_BUDGETS.get("llm", settings.LLM_TIMEOUT))
+        left = deadline.remaining()
+        if left is not None:
+            timeout = min(timeout, max(left, settings.DOSSIER_LLM_RESERVE_SECONDS))
+        return timeout
+
+    def _save_dossier(self, data: Dict, fetched: Dict[str, Dict], sections: Dict[str, str],
+                      text: Optional[str], full: bool = False):
+        """Сохранение полученных источников и сгенерированных разделов (по ИНН)"""
+        company = data["confirmed_company"]
+        if not settings.DOSSIER_CACHE or not company["inn"]:
+            return
+        # Пустые ответы и ответы с ошибкой разбора не сохраняем - перезапросим в следующий раз
+        sources = {
+            source: value for source, value in fetched.items()
+            if value and not value.get("_error") and not value.get("error")
+        }
+        try:
+            dossier_store.save(company["inn"], company["name"], company["website"], sources, sections, text, full)
+        except Exception as e:
+            logger.error(f"Ошибка сохранения досье {company['inn']}: {e}")
+
+    def _archive_dossier(self, data: Dict, dossier: str):
+        """Запись досье в историю для полнотекстового поиска (с ИНН и без)"""
+        if not settings.DOSSIER_HISTORY:
+            return
+        company = data["confirmed_company"]
+        try:
+            dossier_history.add(company["inn"], company["name"], company["website"], dossier)
+        except Exception as e:
+            logger.error(f"Ошибка записи досье {company['inn'] or company['name']} в историю: {e}")
+
+    def _choose_route(self, data: Dict) -> LLMRoute:
+        """
+        Выбор модели и max_tokens по объему собранных данных и размеру компании
+
+        Args:
+            data: Агрегированные данные о компании
+
+        Returns:
+            LLMRoute: fast (FAST_MODEL) для скудных данных о небольшой компании, иначе full
+        """
+        full = LLMRoute("full", settings.DEFAULT_MODEL, settings.DEFAULT_MAX_TOKENS, "маршрутизация выключена")
+        if not settings.MODEL_ROUTING:
+            return full
+
+        egrul = data.get("egrul") or {}
+        finances = (data.get("business_info") or {}).get("finances") or {}
+        news = (data.get("news_and_events") or {}).get("news")
+        employees = _to_number(egrul.get("employee_count"))
+        if employees is None:
+            employees = _to_number(finances.get("employees_count"))
+        capital = _to_number(egrul.get("capital"))
+        news_count = len(news) if isinstance(news, list) else 0
+        data_chars = len(json.dumps(data, ensure_ascii=False))
+
+        signals = f"данные {data_chars} симв., сотрудников {employees}, капитал {capital}, новостей {news_count}"
+        large = (
+            (employees is not None and employees >= settings.ROUTING_LARGE_EMPLOYEES)
+            or (capital is not None and capital >= settings.ROUTING_LARGE_CAPITAL)
+            or news_count >= settings.ROUTING_LARGE_NEWS
+        )
+        if large or data_chars > settings.ROUTING_SMALL_DATA_CHARS:
+            full.reason = signals
+            return full
+        return LLMRoute("fast", settings.FAST_MODEL, settings.FAST_MODEL_MAX_TOKENS, signals)
+
+    async def _invoke_llm(self, messages: List[Dict], route: LLMRoute, timeout: float) -> Tuple[str, Optional[Dict]]:
+        """
+        Вызов LLM выбранным клиентом (с записью/воспроизведением кассеты)
+
+        Args:
+            messages: Сообщения в формате OpenAI ({"role", "content"})
+            route: Модель и max_tokens
+            timeout: Общий таймаут вызова в секундах
+
+        Returns:
+            Текст ответа и usage
+        """
+        cassette = cassettes.active()
+        key = hashlib.sha1("\n".join(message_text(m) for m in messages).encode("utf-8")).hexdigest()[:20]
+        if cassette is not None and cassette.replaying:
+            value = cassettes.replay_value(cassette, "openrouter", "llm", key)
+            return value["content"], value["usage"]
+
+        start = time.perf_counter()
+        if self.llm_client == "langchain":
+            content, token_usage = await upstream_gates.call(
+                "openrouter", self._invoke_langchain, messages, route, timeout=timeout
+            )
+        else:
+            result = await openrouter_client.chat(
+                messages,
+                model=route.model,
+                max_tokens=route.max_tokens,
+                temperature=0.3,
+                timeout=timeout,
+                stream=settings.LLM_STREAM,
+            )
+            content, token_usage = result.content, result.usage
+
+        if cassette is not None:
+            cassettes.record_value(
+                cassette, "openrouter", "llm", key,
+                {"content": content, "usage": token_usage}, time.perf_counter() - start,
+            )
+        return content, token_usage
+
+    def _invoke_langchain(self, messages: List[Dict], route: LLMRoute) -> Tuple[str, Optional[Dict]]:
+        """Синхронный вызов через LangChain (в пуле потоков класса, слот openrouter занят вызывающим)"""
+        from langchain.schema import SystemMessage, HumanMessage
+
+        message_types = {"system": SystemMessage, "user": HumanMessage}
+        # generate() вместо invoke(): в llm_output есть token_usage. Части content с cache_control
+        # передаются как есть, model и max_tokens маршрута переопределяют параметры запроса
+        result = self.llm.generate(
+            [[message_types[m["role"]](content=m["content"]) for m in messages]],
+            model=route.model,
+            max_tokens=route.max_tokens,
+        )
+        return result.generations[0][0].message.content, (result.llm_output or {}).get("token_usage")
 
     def _get_system_prompt(self) -> str:
-        """Системный промпт для LLM"""
+        """Системный промпт для LLM: инструкции и шаблон досье (одинаковы для всех компаний)"""
         return f"""Ты - эксперт по B2B продажам с 15-летним опытом.
 
 Твоя задача: создать детальное досье компании для менеджера по продажам.
@@ -274,136 +961,43 @@ class SalesAnalyzer:
 - Профили соцсетей: [URL=https://vk.com/company]VK[/URL]
 - Telegram: [URL=https://t.me/channel]@channel[/URL]
 
-Формат ответа - структурированное досье с эмодзи для наглядности и кликабельными ссылками."""
-
-    def _get_user_prompt(self, data: Dict) -> str:
-        """Промпт с данными о компании"""
-        data_json = json.dumps(data, ensure_ascii=False, indent=2)
-
-        return f"""Создай досье компании на основе собранных данных:
-
-{data_json}
+Формат ответа - структурированное досье с эмодзи для наглядности и кликабельными ссылками.
 
 Используй следующий формат:
 
-═══════════════════════════════════
-📋 ДОСЬЕ КОМПАНИИ
-
-🏢 [НАЗВАНИЕ]
-📍 [Адрес]
-👤 Директор: [ФИО]
-✅ Статус: [Статус] с [Дата регистрации]
-
-═══════════════════════════════════
-
-📊 МАСШТАБ БИЗНЕСА
-💰 Оборот: [примерный оборот если найден]
-👥 Сотрудников: [примерное количество]
-📈 Динамика: [Растет/Стабильно/Падает - твоя оценка]
-🏆 Категория: [Малый/Средний/Крупный бизнес]
-
-═══════════════════════════════════
-
-🌐 ОНЛАЙН-ПРИСУТСТВИЕ
-• Сайт: [URL=https://example.com]example.com[/URL]
-• VK: [URL=https://vk.com/company]vk.com/company[/URL]
-• Telegram: [URL=https://t.me/channel]@channel[/URL]
-• YouTube: [URL=https://youtube.com/...]YouTube[/URL]
-
-📞 Телефоны:
-• [телефон 1]
-• [телефон 2]
-
-📧 Email:
-• [URL=mailto:email@company.ru]email@company.ru[/URL]
+{DOSSIER_TEMPLATE}"""
 
-═══════════════════════════════════
-
-👥 КЛЮЧЕВЫЕ ЛИЦА (публичные представители)
-
-[Для каждого найденного руководителя/публичного лица:]
-[N]️⃣ [ФИО] - [Должность]
-   📧 [URL=mailto:email@company.ru]email@company.ru[/URL]
-   📱 [телефон если найден]
-   🔗 LinkedIn: [URL=https://linkedin.com/in/...]профиль[/URL]
-   🔗 TenChat: [URL=https://tenchat.ru/...]профиль[/URL]
-   🔗 VK: [URL=https://vk.com/...]профиль[/URL]
-   💬 Telegram: [URL=https://t.me/username]@username[/URL]
-   📝 [Краткая справка о человеке если есть]
-
-[Если не найдены ЛПР, укажи директора из ЕГРЮЛ]
-
-═══════════════════════════════════
-
-💼 ЧЕМ ЗАНИМАЮТСЯ
-[Описание деятельности на основе ОКВЭД и найденной информации]
-
-Основные продукты/услуги:
-• [список если найдено]
-
-Целевая аудитория: [B2B/B2C/B2G]
-
-═══════════════════════════════════
-
-💻 ТЕХНОЛОГИИ
-[Если найдена информация об используемых технологиях:]
-• CRM: [название или "неизвестно"]
-• ERP: [название или "неизвестно"]
-• Другое: [список]
-
-[Если нет данных: "Информация о технологиях не найдена"]
-
-═══════════════════════════════════
-
-📰 ПОСЛЕДНИЕ НОВОСТИ
-[Из news_and_events.news - список 5-7 последних с кликабельными ссылками:]
-• [Дата]: [Краткое описание] - [URL=https://source.ru]источник[/URL]
-• [Дата]: [Краткое описание] - [URL=https://source.ru]источник[/URL]
-
-[Если нет: "Новости не найдены"]
-
-═══════════════════════════════════
-
-🎪 ВЫСТАВКИ И МЕРОПРИЯТИЯ
-[Из news_and_events.exhibitions и news_and_events.conferences]
-
-📍 Выставки:
-[Если есть выставки:]
-• [Дата]: [Название выставки] ([роль: экспонент/посетитель]) - [URL=https://...]ссылка[/URL]
-
-🎤 Конференции и форумы:
-[Если есть конференции:]
-• [Дата]: [Название] - спикер: [ФИО] - [URL=https://...]ссылка[/URL]
-
-🏆 Награды и рейтинги:
-[Из news_and_events.awards:]
-• [Год]: [Название награды/рейтинга] - [позиция] - [URL=https://...]ссылка[/URL]
+    def _get_user_prompt(self, data: Dict) -> str:
+        """Промпт с данными о компании (изменяемая часть после статического префикса)"""
+        data_json = json.dumps(data, ensure_ascii=False, indent=2)
 
-📅 Предстоящие мероприятия:
-[Из news_and_events.upcoming_events:]
-• [Дата]: [Название] ([тип]) - [URL=https://...]ссылка[/URL]
+        return f"""Создай досье компании по формату из инструкции на основе собранных данных:
 
-[Если нет данных: "Информация о мероприятиях не найдена"]
+{data_json}{self._missing_note(data)}"""
 
-Медиа-активность: [news_and_events.media_activity_score]
+    def _get_sections_prompt(self, data: Dict, sections: List[str]) -> str:
+        """Промпт обновления отдельных разделов: только данные источников этих разделов"""
+        sources = {source for section in SECTIONS if section.key in sections for source in section.sources}
+        keys = ["confirmed_company"] + [key for source in SOURCE_DATA_KEYS if source in sources for key in SOURCE_DATA_KEYS[source]]
+        data_json = json.dumps({key: data.get(key) for key in keys}, ensure_ascii=False, indent=2)
+        titles = ", ".join(section.title for section in SECTIONS if section.key in sections)
 
-═══════════════════════════════════
+        return f"""Обнови в досье компании только разделы: {titles}.
+Верни только эти разделы по формату из инструкции, в том же порядке, каждый раздел отдели строкой {SEPARATOR}. Остальные разделы не выводи.
 
-🎯 ВАЖНО ДЛЯ ПРОДАЖИ
+Собранные данные:
 
-📌 НА ЧТО СДЕЛАТЬ АКЦЕНТ:
-• [Боль 1: что наш продукт может решить для такой компании]
-• [Боль 2]
-• [Боль 3]
+{data_json}{self._missing_note(data)}"""
 
-⚠️ ЧТО УЧЕСТЬ:
-• [Особенность 1: что важно знать о компании]
-• [Особенность 2: возможные возражения]
-• [Особенность 3: на что обратить внимание]
+    def _missing_note(self, data: Dict) -> str:
+        """Указание пометить разделы, для которых источники не ответили к сроку"""
+        missing = data.get("missing_sources")
+        if not missing:
+            return ""
+        titles = ", ".join(section.title for section in SECTIONS if section.key in stale_sections(missing))
+        return f"""
 
-═══════════════════════════════════
-
-Используй найденные данные для персонализации рекомендаций."""
+Часть данных не получена к сроку (источники: {", ".join(missing)}). В разделах {titles} не додумывай недостающие сведения: отметь их строкой «{MISSING_MARK}»."""
 
     def _generate_fallback_dossier(self, data: Dict) -> str:
         """Запасной вариант досье без LLM (если API недоступен)"""
@@ -437,4 +1031,4 @@ class SalesAnalyzer:
 
 
 # Глобальный экземпляр анализатора
-sales_analyzer = SalesAnalyzer()
+sales_analyzer = Lazy(SalesAnalyzer, "sales_analyzer")
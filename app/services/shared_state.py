@@ -0,0 +1,404 @@
+"""
+Общее состояние воркеров: кэши, сборки в работе, ключи идемпотентности, счетчики лимитов
+
+Ключ - строка, значение - JSON-сериализуемый объект, у ключа может быть срок жизни.
+Бэкенд выбирается SHARED_STATE_BACKEND:
+- memory - словарь процесса (один воркер uvicorn);
+- sqlite - таблица в DATABASE_PATH (несколько воркеров на одном хосте);
+- redis - сервер с протоколом Redis по REDIS_URL (несколько хостов).
+"""
+import json
+import time
+import sqlite3
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, Optional, Tuple
+
+from app.config import settings
+from app.lazy import Lazy
+from app.services.feedback_store import connect
+
+logger = logging.getLogger(__name__)
+
+# Удаление истекших ключей раз в столько записей (memory и sqlite)
+PURGE_EVERY = 1000
+
+
+class SharedState(ABC):
+    """Интерфейс общего состояния (все операции атомарны в пределах бэкенда)"""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        """Значение ключа (None - нет или истек)"""
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        """
+        Запись значения
+
+        Args:
+            key: Ключ
+            value: JSON-сериализуемое значение
+            ttl: Срок жизни в секундах (None - бессрочно)
+        """
+
+    @abstractmethod
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        """Запись, только если ключа нет (захват блокировки, ключа идемпотентности). True - записано"""
+
+    @abstractmethod
+    def delete(self, key: str):
+        """Удаление ключа"""
+
+    @abstractmethod
+    def renew(self, key: str, value: Any, ttl: float) -> bool:
+        """Продление срока ключа, только если его значение равно value (владелец блокировки). True - продлен"""
+
+    @abstractmethod
+    def release(self, key: str, value: Any) -> bool:
+        """Удаление ключа, только если его значение равно value (владелец блокировки). True - удален"""
+
+    @abstractmethod
+    def incr(self, key: str, amount: float = 1, ttl: Optional[float] = None) -> float:
+        """
+        Увеличение счетчика
+
+        Args:
+            key: Ключ
+            amount: Приращение
+            ttl: Срок жизни, задается при создании счетчика (окно лимита)
+
+        Returns:
+            Новое значение
+        """
+
+    @abstractmethod
+    def advance(self, key: str, floor: float, step: float, ttl: Optional[float] = None) -> float:
+        """
+        Атомарный сдвиг часов: max(текущее значение, floor) + step
+
+        Args:
+            key: Ключ
+            floor: Нижняя граница текущего значения (реальное время для простаивающих часов)
+            step: Приращение
+            ttl: Срок жизни, обновляется при каждом сдвиге
+
+        Returns:
+            Новое значение
+        """
+
+
+class MemoryState(SharedState):
+    """Состояние в памяти процесса"""
+
+    def __init__(self):
+        self._data: Dict[str, Tuple[Any, Optional[float]]] = {}
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _live(self, key: str, now: float) -> Optional[Tuple[Any, Optional[float]]]:
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._data[key]
+            return None
+        return entry
+
+    def _written(self, now: float):
+        self._writes += 1
+        if self._writes % PURGE_EVERY == 0:
+            for key in [key for key, (_, expires) in self._data.items() if expires is not None and expires <= now]:
+                del self._data[key]
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._live(key, time.time())
+            return entry[0] if entry is not None else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        now = time.time()
+        with self._lock:
+            self._data[key] = (value, now + ttl if ttl else None)
+            self._written(now)
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        now = time.time()
+        with self._lock:
+            if self._live(key, now) is not None:
+                return False
+            self._data[key] = (value, now + ttl if ttl else None)
+            self._written(now)
+            return True
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def renew(self, key: str, value: Any, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None or entry[0] != value:
+                return False
+            self._data[key] = (value, now + ttl)
+            return True
+
+    def release(self, key: str, value: Any) -> bool:
+        with self._lock:
+            entry = self._live(key, time.time())
+            if entry is None or entry[0] != value:
+                return False
+            del self._data[key]
+            return True
+
+    def incr(self, key: str, amount: float = 1, ttl: Optional[float] = None) -> float:
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+            if entry is None:
+                entry = (0, now + ttl if ttl else None)
+            value = entry[0] + amount
+            self._data[key] = (value, entry[1])
+            self._written(now)
+            return value
+
+    def advance(self, key: str, floor: float, step: float, ttl: Optional[float] = None) -> float:
+        now = time.time()
+        with self._lock:
+            entry = self._live(key, now)
+            value = max(entry[0] if entry is not None else floor, floor) + step
+            self._data[key] = (value, now + ttl if ttl else None)
+            self._written(now)
+            return value
+
+
+class SqliteState(SharedState):
+    """Состояние в SQLite (WAL): общее для процессов одного хоста"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS shared_state (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL,
+        expires_at REAL
+    );
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+        self._writes = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path)
+            # Транзакции открываются явно (BEGIN IMMEDIATE) - чтение и запись без гонок между процессами
+            conn.isolation_level = None
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(self.SCHEMA)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _write(self, operation):
+        """Операция записи в транзакции с удалением истекшего значения ключа"""
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = operation(conn, time.time())
+            self._writes += 1
+            if self._writes % PURGE_EVERY == 0:
+                conn.execute("DELETE FROM shared_state WHERE expires_at <= ?", (time.time(),))
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _expire(conn: sqlite3.Connection, key: str, now: float):
+        conn.execute("DELETE FROM shared_state WHERE key = ? AND expires_at <= ?", (key, now))
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self._conn().execute(
+            "SELECT value FROM shared_state WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return json.loads(row["value"]) if row else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        def operation(conn, now):
+            conn.execute(
+                "INSERT OR REPLACE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None),
+            )
+        self._write(operation)
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        def operation(conn, now):
+            self._expire(conn, key, now)
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO shared_state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + ttl if ttl else None),
+            )
+            return cursor.rowcount == 1
+        return self._write(operation)
+
+    def delete(self, key: str):
+        self._write(lambda conn, now: conn.execute("DELETE FROM shared_state WHERE key = ?", (key,)))
+
+    def renew(self, key: str, value: Any, ttl: float) -> bool:
+        def operation(conn, now):
+            cursor = conn.execute(
+                "UPDATE shared_state SET expires_at = ? WHERE key = ? AND value = ? "
+                "AND (expires_at IS NULL OR expires_at > ?)",
+                (now + ttl, key, json.dumps(value, ensure_ascii=False), now),
+            )
+            return cursor.rowcount == 1
+        return self._write(operation)
+
+    def release(self, key: str, value: Any) -> bool:
+        def operation(conn, now):
+            cursor = conn.execute(
+                "DELETE FROM shared_state WHERE key = ? AND value = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, json.dumps(value, ensure_ascii=False), now),
+            )
+            return cursor.rowcount == 1
+        return self._write(operation)
+
+    def incr(self, key: str, amount: float = 1, ttl: Optional[float] = None) -> float:
+        def operation(conn, now):
+            self._expire(conn, key, now)
+            row = conn.execute(
+                "INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS REAL) + excluded.value "
+                "RETURNING value",
+                (key, amount, now + ttl if ttl else None),
+            ).fetchone()
+            return float(row["value"])
+        return self._write(operation)
+
+    def advance(self, key: str, floor: float, step: float, ttl: Optional[float] = None) -> float:
+        def operation(conn, now):
+            self._expire(conn, key, now)
+            row = conn.execute(
+                "INSERT INTO shared_state (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = MAX(CAST(value AS REAL), ?) + ?, "
+                "expires_at = excluded.expires_at RETURNING value",
+                (key, floor + step, now + ttl if ttl else None, floor, step),
+            ).fetchone()
+            return float(row["value"])
+        return self._write(operation)
+
+
+class RedisState(SharedState):
+    """Состояние на сервере с протоколом Redis (Redis, Valkey, KeyDB): общее для хостов"""
+
+    # INCRBYFLOAT со сроком жизни, заданным при создании счетчика
+    INCR_SCRIPT = """
+    local value = redis.call('INCRBYFLOAT', KEYS[1], ARGV[1])
+    if tonumber(ARGV[2]) > 0 and redis.call('PTTL', KEYS[1]) == -1 then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return value
+    """
+
+    # Сдвиг часов max(значение, floor) + step; число возвращается строкой (Lua-числа Redis целые)
+    ADVANCE_SCRIPT = """
+    local value = math.max(tonumber(redis.call('GET', KEYS[1]) or ARGV[1]), tonumber(ARGV[1])) + tonumber(ARGV[2])
+    value = string.format('%.6f', value)
+    if tonumber(ARGV[3]) > 0 then
+        redis.call('SET', KEYS[1], value, 'PX', ARGV[3])
+    else
+        redis.call('SET', KEYS[1], value)
+    end
+    return value
+    """
+
+    # Продление и удаление ключа владельцем (значение совпадает)
+    RENEW_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    RELEASE_SCRIPT = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, url: str, prefix: str):
+        self.prefix = prefix
+        self._client = redis_client(url)
+        self._incr = self._client.register_script(self.INCR_SCRIPT)
+        self._advance = self._client.register_script(self.ADVANCE_SCRIPT)
+        self._renew = self._client.register_script(self.RENEW_SCRIPT)
+        self._release = self._client.register_script(self.RELEASE_SCRIPT)
+
+    def _key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    @staticmethod
+    def _ms(ttl: Optional[float]) -> Optional[int]:
+        return max(1, int(ttl * 1000)) if ttl else None
+
+    def get(self, key: str) -> Optional[Any]:
+        raw = self._client.get(self._key(key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self._client.set(self._key(key), json.dumps(value, ensure_ascii=False), px=self._ms(ttl))
+
+    def add(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        return bool(self._client.set(self._key(key), json.dumps(value, ensure_ascii=False), px=self._ms(ttl), nx=True))
+
+    def delete(self, key: str):
+        self._client.delete(self._key(key))
+
+    def renew(self, key: str, value: Any, ttl: float) -> bool:
+        return bool(self._renew(keys=[self._key(key)], args=[json.dumps(value, ensure_ascii=False), self._ms(ttl)]))
+
+    def release(self, key: str, value: Any) -> bool:
+        return bool(self._release(keys=[self._key(key)], args=[json.dumps(value, ensure_ascii=False)]))
+
+    def incr(self, key: str, amount: float = 1, ttl: Optional[float] = None) -> float:
+        return float(self._incr(keys=[self._key(key)], args=[amount, self._ms(ttl) or 0]))
+
+    def advance(self, key: str, floor: float, step: float, ttl: Optional[float] = None) -> float:
+        return float(self._advance(keys=[self._key(key)], args=[floor, step, self._ms(ttl) or 0]))
+
+
+def redis_client(url: str):
+    """Клиент Redis (пакет redis нужен только при SHARED_STATE_BACKEND=redis)"""
+    import redis
+
+    return redis.Redis.from_url(url, socket_timeout=5, socket_connect_timeout=5)
+
+
+def create_shared_state(backend: str) -> SharedState:
+    """
+    Бэкенд общего состояния по имени
+
+    Args:
+        backend: memory, sqlite или redis
+    """
+    if backend == "memory":
+        return MemoryState()
+    if backend == "sqlite":
+        return SqliteState(settings.DATABASE_PATH)
+    if backend == "redis":
+        logger.info(
+            "Общее состояние redis: досье, квоты, очередь и идемпотентность общие для хостов; журнал затрат, "
+            "трейсы, история досье (поиск) и оценки остаются на каждом хосте"
+        )
+        return RedisState(settings.REDIS_URL, settings.SHARED_STATE_PREFIX)
+    raise ValueError(f"Неизвестный SHARED_STATE_BACKEND: {backend} (memory, sqlite, redis)")
+
+
+# Глобальный экземпляр
+shared_state = Lazy(lambda: create_shared_state(settings.SHARED_STATE_BACKEND), "shared_state")
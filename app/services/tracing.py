@@ -0,0 +1,311 @@
+"""
+Трейсинг запросов на исследование: дерево спанов с записью в локальную базу SQLite
+
+Спаны пишет фоновый поток пачками (запрос не ждет диска), таблица индексирована по request_id,
+трейсы старше TRACE_RETENTION_DAYS удаляются.
+"""
+import json
+import time
+import uuid
+import queue
+import random
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+from app.config import settings
+from app.lazy import Lazy
+from app.services.feedback_store import connect
+
+logger = logging.getLogger(__name__)
+
+# Сколько последних трейсов держим в памяти для быстрого /debug/trace
+RECENT_TRACES_LIMIT = 200
+# Очередь трейсов фоновой записи: при переполнении (диск не успевает) новые трейсы не пишутся
+WRITE_QUEUE_LIMIT = 1000
+# Трейсов в одной транзакции записи
+WRITE_BATCH = 100
+# Как часто удаляются старые трейсы, с
+PURGE_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trace_spans (
+    request_id TEXT NOT NULL,
+    span_id TEXT NOT NULL,
+    parent_id TEXT,
+    name TEXT NOT NULL,
+    start REAL NOT NULL,
+    duration_ms REAL,
+    status TEXT NOT NULL,
+    attrs TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_trace_spans_request ON trace_spans(request_id);
+CREATE INDEX IF NOT EXISTS idx_trace_spans_start ON trace_spans(start);
+"""
+
+
+class Span:
+    """Один замер внутри трейса (HTTP вызов, парсинг, генерация LLM, этап)"""
+
+    __slots__ = ("name", "span_id", "parent_id", "start", "duration_ms", "status", "attrs")
+
+    def __init__(self, name: str, parent_id: Optional[str], attrs: Dict):
+        self.name = name
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration_ms = None
+        self.status = "ok"
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        """Добавление атрибутов (размер ответа, HTTP код, ...)"""
+        self.attrs.update(attrs)
+
+    def to_dict(self, request_id: str) -> Dict:
+        return {
+            "request_id": request_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "attrs": self.attrs,
+        }
+
+
+class _NoopSpan:
+    """Заглушка для несэмплированных запросов - без аллокаций и записи"""
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class _Trace:
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()
+
+
+_current_trace: ContextVar[Optional[_Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """Запись трейсов в SQLite и построение waterfall"""
+
+    def __init__(self, path: str, sample_rate: float, retention_days: float):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.retention_days = retention_days
+        self._write_lock = threading.Lock()
+        self._recent: "OrderedDict[str, List[Dict]]" = OrderedDict()
+        self._queue: "queue.Queue[Optional[List[Dict]]]" = queue.Queue(maxsize=WRITE_QUEUE_LIMIT)
+        self._writer: Optional[threading.Thread] = None
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+        self._schema_ready = False
+
+    @contextmanager
+    def trace(self, request_id: str, name: str, **attrs):
+        """
+        Корневой спан запроса. По завершении спаны записываются в хранилище.
+
+        Args:
+            request_id: ID запроса
+            name: Название корневого спана
+            **attrs: Атрибуты (user_id, deal_id, ...)
+        """
+        if _current_trace.get() is not None or random.random() >= self.sample_rate:
+            # Уже внутри трейса или запрос не попал в выборку
+            with self.span(name, **attrs) as span:
+                yield span
+            return
+
+        trace = _Trace(request_id)
+        trace_token = _current_trace.set(trace)
+        try:
+            with self.span(name, **attrs) as span:
+                yield span
+        finally:
+            _current_trace.reset(trace_token)
+            self._store(trace)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """
+        Вложенный спан. Вне трейса ничего не делает.
+
+        Args:
+            name: Название (dadata.findById, stage.news, llm.generate, ...)
+            **attrs: Атрибуты спана
+        """
+        trace = _current_trace.get()
+        if trace is None:
+            yield _NOOP_SPAN
+            return
+
+        parent = _current_span.get()
+        span = Span(name, parent.span_id if parent else None, attrs)
+        span_token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.status = "error"
+            span.attrs.setdefault("error", type(e).__name__)
+            raise
+        finally:
+            span.duration_ms = round((time.perf_counter() - start) * 1000, 1)
+            _current_span.reset(span_token)
+            with trace.lock:
+                trace.spans.append(span)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = connect(self.path)
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(SCHEMA)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    def _store(self, trace: _Trace):
+        """Трейс в память (последние) и в очередь фоновой записи"""
+        records = [span.to_dict(trace.request_id) for span in trace.spans]
+        with self._write_lock:
+            self._recent[trace.request_id] = records
+            self._recent.move_to_end(trace.request_id)
+            while len(self._recent) > RECENT_TRACES_LIMIT:
+                self._recent.popitem(last=False)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name="trace-writer", daemon=True)
+                self._writer.start()
+        try:
+            self._queue.put_nowait(records)
+        except queue.Full:
+            logger.warning(f"Очередь записи трейсов переполнена, трейс {trace.request_id} только в памяти")
+
+    def _write_loop(self):
+        """Фоновая запись трейсов пачками и удаление старых"""
+        purged_at = 0.0
+        while True:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < WRITE_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            rows = [
+                (r["request_id"], r["span_id"], r["parent_id"], r["name"], r["start"], r["duration_ms"], r["status"],
+                 json.dumps(r["attrs"], ensure_ascii=False, default=str))
+                for records in batch if records is not None for r in records
+            ]
+            try:
+                conn = self._conn()
+                with conn:
+                    conn.executemany("INSERT INTO trace_spans VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                    if self.retention_days > 0 and time.time() - purged_at > PURGE_INTERVAL:
+                        conn.execute("DELETE FROM trace_spans WHERE start < ?",
+                                     (time.time() - self.retention_days * 86400,))
+                        purged_at = time.time()
+            except sqlite3.Error as e:
+                logger.error(f"Ошибка записи {len(rows)} спанов в {self.path}: {e}")
+            if stop:
+                return
+
+    def close(self, timeout: float = 5.0):
+        """Дописать очередь трейсов (остановка процесса)"""
+        with self._write_lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            self._queue.put(None)
+            writer.join(timeout)
+
+    def load(self, request_id: str) -> List[Dict]:
+        """
+        Спаны трейса: из памяти или из базы (индекс по request_id)
+
+        Args:
+            request_id: ID запроса
+
+        Returns:
+            Список спанов (пустой, если трейс не найден)
+        """
+        with self._write_lock:
+            if request_id in self._recent:
+                return list(self._recent[request_id])
+
+        rows = self._conn().execute(
+            "SELECT * FROM trace_spans WHERE request_id = ? ORDER BY start", (request_id,)
+        ).fetchall()
+        return [{**dict(row), "attrs": json.loads(row["attrs"])} for row in rows]
+
+    def waterfall(self, spans: List[Dict], width: int = 60) -> Dict:
+        """
+        Построение waterfall: смещение от начала, глубина и текстовая полоса
+
+        Args:
+            spans: Спаны трейса
+            width: Ширина полосы в символах
+
+        Returns:
+            Словарь с общей длительностью и упорядоченными строками
+        """
+        if not spans:
+            return {"total_ms": 0, "spans": []}
+
+        t0 = min(s["start"] for s in spans)
+        t_end = max(s["start"] + (s["duration_ms"] or 0) / 1000 for s in spans)
+        total_ms = max((t_end - t0) * 1000, 1e-3)
+
+        by_parent: Dict[Optional[str], List[Dict]] = {}
+        for span in spans:
+            by_parent.setdefault(span.get("parent_id"), []).append(span)
+
+        rows = []
+
+        def walk(parent_id, depth):
+            for span in sorted(by_parent.get(parent_id, []), key=lambda s: s["start"]):
+                offset_ms = (span["start"] - t0) * 1000
+                duration_ms = span["duration_ms"] or 0
+                begin = int(offset_ms / total_ms * width)
+                length = max(1, int(duration_ms / total_ms * width))
+                rows.append({
+                    "name": span["name"],
+                    "depth": depth,
+                    "offset_ms": round(offset_ms, 1),
+                    "duration_ms": duration_ms,
+                    "status": span["status"],
+                    "attrs": span["attrs"],
+                    "bar": " " * begin + "█" * min(length, width - begin),
+                })
+                walk(span["span_id"], depth + 1)
+
+        walk(None, 0)
+        return {"total_ms": round(total_ms, 1), "spans": rows}
+
+    def render_text(self, request_id: str, waterfall: Dict) -> str:
+        """Текстовый waterfall для просмотра в терминале"""
+        lines = [f"trace {request_id}: {waterfall['total_ms']} ms"]
+        for row in waterfall["spans"]:
+            name = ("  " * row["depth"] + row["name"])[:40]
+            mark = "" if row["status"] == "ok" else " !"
+            lines.append(f"{name:<40} |{row['bar']:<60}| {row['duration_ms']:>9.1f} ms{mark}")
+        return "\n".join(lines)
+
+
+# Глобальный экземпляр трейсера
+tracer = Lazy(lambda: Tracer(settings.TRACE_STORE_PATH, settings.TRACE_SAMPLE_RATE, settings.TRACE_RETENTION_DAYS), "tracer")
@@ -0,0 +1,77 @@
+"""
+Общая точка выхода HTTP запросов к внешним API (DaData, OpenRouter, Битрикс24, сайты)
+
+Все сервисы ходят наружу через request(), поэтому метрики, спаны трейса, запись/воспроизведение
+кассет, ограничение таймаутов сроком досье (app/services/deadline.py) и слоты по классам
+приоритета (app/services/priority.py) собираются в одном месте.
+"""
+import time
+import logging
+from urllib.parse import urlsplit
+
+import requests
+
+from app.services import deadline
+from app.services.cassette import cassettes, request_key
+from app.services.metrics import metrics
+from app.services.priority import GateTimeout, upstream_gates
+from app.services.tracing import tracer
+
+logger = logging.getLogger(__name__)
+
+# Одна сессия на процесс - переиспользуем TCP/TLS соединения к одним и тем же хостам
+_session = requests.Session()
+
+
+def request(upstream: str, operation: str, method: str, url: str, **kwargs) -> requests.Response:
+    """
+    HTTP запрос к внешнему API с учетом в метриках и трейсе
+
+    Args:
+        upstream: Внешний сервис (dadata, openrouter, bitrix, website)
+        operation: Операция для метрик (findById, imbot.message.add, ...)
+        method: HTTP метод
+        url: URL запроса
+        **kwargs: Аргументы requests (json, data, params, headers, timeout, ...)
+
+    Returns:
+        Ответ requests (raise_for_status вызывает вызывающий код)
+    """
+    status = "error"
+    start = time.perf_counter()
+    with tracer.span(f"{upstream}.{operation}", method=method, host=urlsplit(url).hostname) as span:
+        try:
+            # Слот по классу приоритета запроса (UPSTREAM_CONCURRENCY); ждем не дольше срока досье
+            with upstream_gates.slot(upstream):
+                # Таймаут не дольше остатка срока досье и бюджета этапа
+                kwargs["timeout"] = deadline.cap(kwargs.get("timeout"))
+                response = _send(upstream, operation, method, url, start, kwargs)
+            status = str(response.status_code)
+            span.set(status=response.status_code, size=len(response.content))
+            return response
+        except (requests.exceptions.Timeout, GateTimeout):
+            status = "timeout"
+            raise
+        except requests.exceptions.ConnectionError:
+            status = "connection_error"
+            raise
+        finally:
+            metrics.observe_upstream(upstream, operation, status, time.perf_counter() - start)
+
+
+def _send(upstream: str, operation: str, method: str, url: str, start: float, kwargs: dict) -> requests.Response:
+    """Отправка запроса или ответ из кассеты (запись обмена, если кассета пишется)"""
+    cassette = cassettes.active()
+    if cassette is not None and cassette.replaying:
+        return cassettes.replay_response(cassette, upstream, operation, request_key(method, url, kwargs), url)
+    if cassette is None:
+        return _session.request(method, url, **kwargs)
+
+    key = request_key(method, url, kwargs)
+    try:
+        response = _session.request(method, url, **kwargs)
+    except requests.exceptions.RequestException as e:
+        cassettes.record_error(cassette, upstream, operation, key, e, time.perf_counter() - start)
+        raise
+    cassettes.record_response(cassette, upstream, operation, key, response, time.perf_counter() - start)
+    return response
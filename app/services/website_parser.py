@@ -7,6 +7,10 @@ import logging
 from typing import Dict, List
 from bs4 import BeautifulSoup
 
+from app.services import upstream
+from app.services.tracing import tracer
+from app.lazy import Lazy
+
 logger = logging.getLogger(__name__)
 
 
@@ -37,17 +41,18 @@ class WebsiteParser:
                 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
             }
 
-            response = requests.get(url, headers=headers, timeout=15, allow_redirects=True)
+            response = upstream.request("website", "page", "GET", url, headers=headers, timeout=15, allow_redirects=True)
             response.raise_for_status()
 
-            html = response.text
-            text = BeautifulSoup(response.content, 'html.parser').get_text()
+            with tracer.span("website.parse_legal", size=len(response.content)):
+                html = response.text
+                text = BeautifulSoup(response.content, 'html.parser').get_text()
 
-            # Ищем ИНН
-            inn = self._extract_inn(text, html)
+                # Ищем ИНН
+                inn = self._extract_inn(text, html)
 
-            # Ищем название компании (ООО, АО, ИП и т.д.)
-            company_name = self._extract_company_name(text, html)
+                # Ищем название компании (ООО, АО, ИП и т.д.)
+                company_name = self._extract_company_name(text, html)
 
             logger.info(f"Найдено на сайте: ИНН={inn}, Компания={company_name}")
 
@@ -150,21 +155,22 @@ class WebsiteParser:
                 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36'
             }
 
-            response = requests.get(url, headers=headers, timeout=15, allow_redirects=True)
+            response = upstream.request("website", "page", "GET", url, headers=headers, timeout=15, allow_redirects=True)
             response.raise_for_status()
 
-            # Парсим HTML
-            soup = BeautifulSoup(response.content, 'html.parser')
-            text = soup.get_text()
+            with tracer.span("website.parse_contacts", size=len(response.content)):
+                # Парсим HTML
+                soup = BeautifulSoup(response.content, 'html.parser')
+                text = soup.get_text()
 
-            # Также ищем в HTML (для ссылок mailto: и tel:)
-            html = response.text
+                # Также ищем в HTML (для ссылок mailto: и tel:)
+                html = response.text
 
-            # Извлекаем телефоны
-            phones = self._extract_phones(text, html)
+                # Извлекаем телефоны
+                phones = self._extract_phones(text, html)
 
-            # Извлекаем email
-            emails = self._extract_emails(text, html)
+                # Извлекаем email
+                emails = self._extract_emails(text, html)
 
             logger.info(f"Найдено: {len(phones)} телефонов, {len(emails)} email")
 
@@ -242,4 +248,4 @@ class WebsiteParser:
 
 
 # Глобальный экземпляр парсера
-website_parser = WebsiteParser()
+website_parser = Lazy(WebsiteParser, "website_parser")
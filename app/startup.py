@@ -0,0 +1,106 @@
+"""
+Отчет о холодном старте: время импорта модулей, построения сервисов и первого запроса
+
+Учет импорта включается переменной окружения STARTUP_IMPORT_TIMER при импорте пакета app
+(app/__init__.py, до чтения настроек) и замеряет каждый впервые загружаемый модуль включительно
+с его зависимостями. После первого обработанного запроса исходный __import__ восстанавливается.
+"""
+import os
+import sys
+import time
+import builtins
+import threading
+from typing import Dict, Optional
+
+_original_import = builtins.__import__
+
+
+def import_timer_enabled() -> bool:
+    """Учет импорта включен (STARTUP_IMPORT_TIMER=true)"""
+    return os.environ.get("STARTUP_IMPORT_TIMER", "").strip().lower() in ("1", "true", "yes", "on")
+
+
+class StartupReport:
+    """Вехи запуска процесса"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.started_wall = time.time()
+        self.imports: Dict[str, float] = {}
+        self.builds: Dict[str, float] = {}
+        self.marks: Dict[str, float] = {}
+        self.first_request: Optional[Dict] = None
+        self._lock = threading.Lock()
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level or name in sys.modules:
+            return _original_import(name, globals, locals, fromlist, level)
+        started = time.perf_counter()
+        try:
+            return _original_import(name, globals, locals, fromlist, level)
+        finally:
+            # Включительное время: вложенные импорты учитываются и в родителе
+            seconds = time.perf_counter() - started
+            with self._lock:
+                self.imports.setdefault(name, seconds)
+
+    def install_import_timer(self):
+        """Замер времени импорта модулей (через builtins.__import__)"""
+        if builtins.__import__ is _original_import:
+            builtins.__import__ = self._timed_import
+
+    def uninstall_import_timer(self):
+        """Восстановление исходного __import__ (если его не подменил кто-то после нас)"""
+        if builtins.__import__ == self._timed_import:
+            builtins.__import__ = _original_import
+
+    def mark(self, name: str):
+        """Веха запуска (секунды от импорта пакета app)"""
+        self.marks.setdefault(name, round(time.perf_counter() - self.started, 4))
+
+    def record_build(self, name: str, seconds: float):
+        """Время построения ленивого сервиса при первом обращении"""
+        self.builds[name] = round(seconds, 4)
+
+    def record_first_request(self, path: str, duration: float) -> bool:
+        """
+        Первый обработанный HTTP запрос
+
+        Returns:
+            True если запрос действительно первый
+        """
+        with self._lock:
+            if self.first_request is not None:
+                return False
+            self.first_request = {
+                "path": path,
+                "at": round(time.perf_counter() - self.started, 4),
+                "duration": round(duration, 4),
+            }
+            return True
+
+    def report(self, top: int = 30) -> Dict:
+        """
+        Отчет о запуске
+
+        Args:
+            top: Сколько самых медленных импортов показать
+
+        Returns:
+            Вехи, первый запрос, построение сервисов и медленные импорты (секунды)
+        """
+        with self._lock:
+            imports = list(self.imports.items())
+        slowest = sorted(imports, key=lambda item: item[1], reverse=True)[:top]
+        return {
+            "process_started_at": self.started_wall,
+            "uptime": round(time.perf_counter() - self.started, 2),
+            "marks": self.marks,
+            "first_request": self.first_request,
+            "service_builds": self.builds,
+            "imports": {name: round(seconds, 4) for name, seconds in slowest},
+        }
+
+
+# Глобальный экземпляр
+startup_report = StartupReport()
@@ -2,14 +2,76 @@
 Обработчик webhook от Битрикс24
 """
 import re
+import hmac
+import asyncio
 import logging
-from typing import Dict
+from datetime import datetime
+from typing import Dict, Optional, Tuple
 
+from app import request_context
+from app.config import settings
 from app.services.bitrix import bitrix_service
+from app.services.cassette import cassettes, cassette_name
+from app.services.dossier_history import dossier_history
+from app.services.dossier_store import dossier_store
+from app.services.feedback_store import feedback_store
+from app.services.idempotency import DONE as IDEMPOTENCY_DONE, FAILED as IDEMPOTENCY_FAILED, idempotency
+from app.services.job_queue import first_attempt, retry_pending
+from app.services.prewarm import resolve_target
+from app.services.tracing import tracer
 from app.services.sales_analyzer import sales_analyzer
 
 logger = logging.getLogger(__name__)
 
+# События CRM, по которым досье строится заранее (без ответа в чат)
+CRM_EVENTS = ("ONCRMDEALADD", "ONCRMCOMPANYADD")
+
+# Команды кнопок оценки под досье
+FEEDBACK_COMMANDS = ("positive", "negative", "feedback")
+
+# Команда поиска по истории досье: "/поиск логистика Казань", "поиск: логистика", "что мы знаем о Яндекс".
+# Просто "поиск ..." - запрос исследования ("поиск компании ООО Ромашка"), а не команда
+SEARCH_PREFIXES = ("/search", "/поиск", "поиск:", "что мы знаем об", "что мы знаем о", "что знаем об", "что знаем о")
+
+
+def crm_event_authorized(webhook_data: Dict) -> bool:
+    """
+    Событие CRM подписано токеном приложения BITRIX_APPLICATION_TOKEN
+
+    Без настроенного токена события CRM не принимаются: иначе любой POST на /webhook/bitrix
+    с выдуманными сделкой и порталом запускал бы платное исследование.
+    """
+    event = webhook_data.get("event")
+    if not settings.BITRIX_APPLICATION_TOKEN:
+        logger.warning(f"Событие {event} отклонено: BITRIX_APPLICATION_TOKEN не задан")
+        return False
+    token = str(webhook_data.get("auth", {}).get("application_token") or "")
+    if not hmac.compare_digest(token, settings.BITRIX_APPLICATION_TOKEN):
+        logger.warning(f"Событие {event} с неверным application_token отклонено")
+        return False
+    return True
+
+
+def extract_search_query(text: str) -> Optional[str]:
+    """
+    Запрос команды поиска по истории досье
+
+    Args:
+        text: Текст сообщения от пользователя
+
+    Returns:
+        Слова запроса (пустая строка - команда без запроса) или None, если это не команда поиска
+    """
+    lowered = text.strip().lower()
+    for prefix in SEARCH_PREFIXES:
+        if lowered.startswith(prefix):
+            rest = text.strip()[len(prefix):]
+            # Команда - только отдельное слово ("/поисковик" - не команда)
+            if rest and rest[0].isalnum() and prefix[-1].isalnum():
+                continue
+            return rest.strip(" :?!.,")
+    return None
+
 
 def extract_inn(text: str) -> str:
     """
@@ -63,7 +125,7 @@ def is_company_query(text: str) -> bool:
         True если это запрос о компании
     """
     # Игнорируем команды от кнопок
-    if text.strip().lower() in ["positive", "negative", "feedback"]:
+    if text.strip().lower() in FEEDBACK_COMMANDS:
         return False
 
     # Если есть ИНН - это точно запрос
@@ -81,151 +143,312 @@ def is_company_query(text: str) -> bool:
     return False
 
 
-async def handle_bitrix_message(webhook_data: Dict):
+async def handle_bitrix_message(webhook_data: Dict, request_id: str = None):
     """
     Обработка входящего сообщения от Битрикс24
 
     Args:
         webhook_data: Данные webhook от Битрикс24
+        request_id: ID запроса (для трейса и логов)
     """
-    try:
-        event = webhook_data.get("event")
+    message_data = webhook_data.get("data", {}).get("MESSAGE", {})
+    portal = webhook_data.get("auth", {}).get("domain") or None
+    with (
+        request_context.bind(request_id, user_id=message_data.get("author_id") or None, source="chat", portal=portal) as ctx,
+        tracer.trace(ctx.request_id, "research.chat", event=webhook_data.get("event"), dialog_id=message_data.get("chat_id")),
+    ):
+        try:
+            event = webhook_data.get("event")
 
-        # Обрабатываем только сообщения
-        if event != "ONIMBOTMESSAGEADD":
-            logger.debug(f"Игнорируем событие: {event}")
-            return
+            # Обрабатываем только сообщения
+            if event != "ONIMBOTMESSAGEADD":
+                logger.debug(f"Игнорируем событие: {event}")
+                return
 
-        message_data = webhook_data.get("data", {}).get("MESSAGE", {})
+            message_data = webhook_data.get("data", {}).get("MESSAGE", {})
 
-        # Игнорируем системные сообщения
-        if message_data.get("system") == "Y":
-            logger.debug("Игнорируем системное сообщение")
-            return
+            # Игнорируем системные сообщения
+            if message_data.get("system") == "Y":
+                logger.debug("Игнорируем системное сообщение")
+                return
 
-        text = message_data.get("text", "")
-        dialog_id = message_data.get("chat_id")
+            text = message_data.get("text", "")
+            dialog_id = message_data.get("chat_id")
 
-        # Извлекаем auth токен из webhook данных (для отправки ответов)
-        auth_data = webhook_data.get("auth", {})
+            # Извлекаем auth токен из webhook данных (для отправки ответов)
+            auth_data = webhook_data.get("auth", {})
 
-        if not dialog_id:
-            logger.warning("Отсутствует dialog_id в сообщении")
-            return
+            if not dialog_id:
+                logger.warning("Отсутствует dialog_id в сообщении")
+                return
 
-        logger.info(f"Получено сообщение из диалога {dialog_id}: {text}")
+            logger.info(f"Получено сообщение из диалога {dialog_id}: {text}")
 
-        # Проверяем, это команда от кнопки или обычное сообщение
-        if text in ["positive", "negative", "feedback"]:
-            await handle_feedback(dialog_id, text, webhook_data)
-            return
+            # Проверяем, это команда от кнопки или обычное сообщение
+            if text in FEEDBACK_COMMANDS:
+                await handle_feedback(dialog_id, text, webhook_data)
+                return
 
-        # СРАЗУ ОТПРАВЛЯЕМ БЫСТРУЮ РЕАКЦИЮ (только для новых запросов)
-        bitrix_service.send_message(
-            dialog_id,
-            "✅ Запрос получен! Формирую детальное досье компании.\n\n⏱️ Это займет 1-3 минуты, вернусь с результатами..."
-        )
+            # Поиск по истории досье - без исследования
+            query = extract_search_query(text)
+            if query is not None:
+                await handle_search(dialog_id, query)
+                return
 
-        # Проверяем что это запрос о компании
-        if not is_company_query(text):
-            bitrix_service.send_message(
-                dialog_id,
-                "❓ Пожалуйста, отправьте:\n\n"
-                "• ИНН компании (10 или 12 цифр), например: 7707083893\n"
-                "• или название компании, например: Яндекс\n"
-                "• или название компании, например: ООО Рога и Копыта"
-            )
-            return
-
-        # Определяем тип запроса
-        inn = extract_inn(text)
-        url = extract_url(text)
-
-        # Определяем что передано
-        company_name_query = None
-        company_website = None
-
-        if inn:
-            # Поиск по ИНН
-            logger.info(f"Найден ИНН: {inn}")
-            company_identifier = inn
-        elif url:
-            # Передан URL - используем его как сайт компании
-            company_website = url
-            # Если в тексте есть что-то кроме URL - это название компании
-            text_without_url = text.replace(url, '').strip()
-            if text_without_url and len(text_without_url) > 2:
-                company_name_query = text_without_url
-            logger.info(f"Найден URL: {url}, название: {company_name_query}")
-            company_identifier = url
-        else:
-            # Поиск по названию
-            company_name_query = text.strip()
-            logger.info(f"Поиск по названию: {company_name_query}")
-            company_identifier = company_name_query
+            # СРАЗУ ОТПРАВЛЯЕМ БЫСТРУЮ РЕАКЦИЮ (только для новых запросов, не при повторе задания)
+            if first_attempt():
+                bitrix_service.send_message(
+                    dialog_id,
+                    "✅ Запрос получен! Формирую детальное досье компании.\n\n⏱️ Это займет 1-3 минуты, вернусь с результатами..."
+                )
 
-        # Создаем досье компании
-        try:
-            if inn:
-                dossier = await sales_analyzer.create_company_dossier(inn=inn)
-                feedback_id = inn
-            elif company_website:
-                # Если есть сайт - передаем его, название может быть None
-                dossier = await sales_analyzer.create_company_dossier(
-                    company_name=company_name_query,
-                    company_website=company_website
+            # Проверяем что это запрос о компании
+            if not is_company_query(text):
+                bitrix_service.send_message(
+                    dialog_id,
+                    "❓ Пожалуйста, отправьте:\n\n"
+                    "• ИНН компании (10 или 12 цифр), например: 7707083893\n"
+                    "• или название компании, например: Яндекс\n"
+                    "• или название компании, например: ООО Рога и Копыта"
                 )
-                feedback_id = company_website
+                return
+
+            # Определяем тип запроса
+            inn = extract_inn(text)
+            url = extract_url(text)
+
+            # Определяем что передано
+            company_name_query = None
+            company_website = None
+
+            if inn:
+                # Поиск по ИНН
+                logger.info(f"Найден ИНН: {inn}")
+                company_identifier = inn
+            elif url:
+                # Передан URL - используем его как сайт компании
+                company_website = url
+                # Если в тексте есть что-то кроме URL - это название компании
+                text_without_url = text.replace(url, '').strip()
+                if text_without_url and len(text_without_url) > 2:
+                    company_name_query = text_without_url
+                logger.info(f"Найден URL: {url}, название: {company_name_query}")
+                company_identifier = url
             else:
-                dossier = await sales_analyzer.create_company_dossier(company_name=company_name_query)
-                # Для кнопок оценки используем название (если ИНН не был найден)
-                feedback_id = company_name_query
+                # Поиск по названию
+                company_name_query = text.strip()
+                logger.info(f"Поиск по названию: {company_name_query}")
+                company_identifier = company_name_query
 
-            # Отправляем досье БЕЗ кнопок (чтобы избежать 400 ошибки)
-            bitrix_service.send_message(
-                dialog_id,
-                dossier,
-                keyboard=None  # Пока без кнопок
-            )
+            # Создаем досье компании
+            try:
+                if inn:
+                    dossier = await sales_analyzer.create_company_dossier(inn=inn)
+                    feedback_id = inn
+                elif company_website:
+                    # Если есть сайт - передаем его, название может быть None
+                    dossier = await sales_analyzer.create_company_dossier(
+                        company_name=company_name_query,
+                        company_website=company_website
+                    )
+                    feedback_id = company_website
+                else:
+                    dossier = await sales_analyzer.create_company_dossier(company_name=company_name_query)
+                    # Для кнопок оценки используем название (если ИНН не был найден)
+                    feedback_id = company_name_query
 
-            logger.info(f"Досье для {company_identifier} успешно отправлено")
+                # Отправляем досье БЕЗ кнопок (чтобы избежать 400 ошибки)
+                bitrix_service.send_message(
+                    dialog_id,
+                    dossier,
+                    keyboard=None  # Пока без кнопок
+                )
 
-            # Отправляем кнопки отдельным сообщением (только если досье успешно)
-            if not dossier.startswith("❌") and not dossier.startswith("😔"):
+                logger.info(f"Досье для {company_identifier} успешно отправлено")
+
+                # Отправляем кнопки отдельным сообщением (только если досье успешно)
+                if not dossier.startswith("❌") and not dossier.startswith("😔"):
+                    try:
+                        keyboard = bitrix_service.create_feedback_keyboard(feedback_id, request_context.get_request_id())
+                        bitrix_service.send_message(
+                            dialog_id,
+                            "Оцените полезность досье:",
+                            keyboard=keyboard
+                        )
+                        logger.info("Кнопки оценки отправлены")
+                    except Exception as e:
+                        logger.warning(f"Не удалось отправить кнопки оценки: {e}")
+                        # Не критично, продолжаем работу
+
+            except Exception as e:
+                # Задание очереди повторит воркер - пользователю сообщаем только после последней попытки
+                if retry_pending():
+                    raise
+                logger.error(f"Ошибка при создании досье: {e}", exc_info=True)
+
+                # Отправляем понятное сообщение пользователю
                 try:
-                    keyboard = bitrix_service.create_feedback_keyboard(feedback_id)
                     bitrix_service.send_message(
                         dialog_id,
-                        "Оцените полезность досье:",
-                        keyboard=keyboard
+                        f"😔 К сожалению, не удалось собрать информацию о компании '{company_identifier}'.\n\n"
+                        "Возможные причины:\n"
+                        "• Компания не зарегистрирована в России\n"
+                        "• Неправильное название или ИНН\n"
+                        "• Временные проблемы с источниками данных\n\n"
+                        "Попробуйте:\n"
+                        "• Уточнить название компании\n"
+                        "• Использовать ИНН (10 или 12 цифр)\n"
+                        "• Попробовать через несколько минут"
                     )
-                    logger.info("Кнопки оценки отправлены")
-                except Exception as e:
-                    logger.warning(f"Не удалось отправить кнопки оценки: {e}")
-                    # Не критично, продолжаем работу
+                except:
+                    logger.error("Не удалось отправить сообщение об ошибке")
 
         except Exception as e:
-            logger.error(f"Ошибка при создании досье: {e}", exc_info=True)
+            if retry_pending():
+                raise
+            logger.error(f"Критическая ошибка при обработке сообщения: {e}", exc_info=True)
 
-            # Отправляем понятное сообщение пользователю
-            try:
-                bitrix_service.send_message(
-                    dialog_id,
-                    f"😔 К сожалению, не удалось собрать информацию о компании '{company_identifier}'.\n\n"
-                    "Возможные причины:\n"
-                    "• Компания не зарегистрирована в России\n"
-                    "• Неправильное название или ИНН\n"
-                    "• Временные проблемы с источниками данных\n\n"
-                    "Попробуйте:\n"
-                    "• Уточнить название компании\n"
-                    "• Использовать ИНН (10 или 12 цифр)\n"
-                    "• Попробовать через несколько минут"
-                )
-            except:
-                logger.error("Не удалось отправить сообщение об ошибке")
 
-    except Exception as e:
-        logger.error(f"Критическая ошибка при обработке сообщения: {e}", exc_info=True)
+async def handle_crm_event(webhook_data: Dict, request_id: str = None):
+    """
+    Предварительное исследование компании при создании сделки или компании в CRM
+
+    Досье только сохраняется в хранилище - в чат ничего не отправляется. Последующий
+    запрос менеджера по этому ИНН отвечает из хранилища (или дожидается уже идущей сборки).
+
+    Args:
+        webhook_data: Данные события (event, data.FIELDS.ID, auth)
+        request_id: ID запроса (для трейса и логов)
+    """
+    event = webhook_data.get("event")
+    entity_id = str(webhook_data.get("data", {}).get("FIELDS", {}).get("ID") or "")
+    deal_id = entity_id if event == "ONCRMDEALADD" else None
+    portal = webhook_data.get("auth", {}).get("domain") or None
+    with (
+        request_context.bind(request_id, deal_id=deal_id, source="prefetch", portal=portal) as ctx,
+        tracer.trace(ctx.request_id, "research.prefetch", event=event, entity_id=entity_id),
+    ):
+        try:
+            if not settings.CRM_PREFETCH or not settings.DOSSIER_CACHE:
+                logger.debug(f"Предварительное исследование отключено, событие {event} пропущено")
+                return
+
+            if not crm_event_authorized(webhook_data):
+                return
+
+            if not entity_id:
+                logger.warning(f"Отсутствует ID в событии {event}")
+                return
+
+            target = await asyncio.to_thread(_crm_target, event, entity_id)
+            if target is None:
+                logger.info(f"Событие {event} ({entity_id}): ИНН не указан, исследование не запускается")
+                return
+
+            request_context.update(inn=target["inn"])
+            record = await asyncio.to_thread(dossier_store.load, target["inn"])
+            if record is not None and record.is_fresh():
+                logger.info(f"Событие {event}: досье {target['inn']} актуально")
+                return
+
+            logger.info(f"Событие {event}: предварительное исследование {target['inn']} ({target['name']})")
+            await sales_analyzer.create_company_dossier(inn=target["inn"], company_website=target["website"])
+            logger.info(f"Досье {target['inn']} подготовлено заранее")
+
+        except Exception as e:
+            if retry_pending():
+                raise
+            logger.error(f"Ошибка предварительного исследования по событию {event} ({entity_id}): {e}", exc_info=True)
+
+
+async def handle_dossier_refresh(inn: str, user_id: str = None, request_id: str = None, idempotency_key: str = None):
+    """
+    Обновление сохраненного досье по запросу GET /api/dossier/{inn}?refresh=true
+
+    Досье только сохраняется в хранилище (актуальные источники не перезапрашиваются) -
+    в чат ничего не отправляется, клиент забирает результат тем же GET.
+
+    Args:
+        inn: ИНН компании
+        user_id: ID пользователя Битрикс24, запросившего обновление (для квот и затрат)
+        request_id: ID запроса (для трейса и логов)
+        idempotency_key: Ключ идемпотентности запроса
+    """
+    with (
+        request_context.bind(request_id, user_id=user_id, inn=inn, source="api") as ctx,
+        tracer.trace(ctx.request_id, "research.refresh", user_id=user_id, inn=inn),
+    ):
+        try:
+            await sales_analyzer.create_company_dossier(inn=inn)
+            logger.info(f"Досье {inn} обновлено по запросу API")
+            idempotency.finish(idempotency_key, IDEMPOTENCY_DONE)
+        except Exception as e:
+            # Ключ идемпотентности остается в работе, пока воркер повторяет задание
+            if retry_pending():
+                raise
+            logger.error(f"Ошибка обновления досье {inn}: {e}", exc_info=True)
+            idempotency.finish(idempotency_key, IDEMPOTENCY_FAILED)
+
+
+def _crm_target(event: str, entity_id: str) -> Optional[Dict]:
+    """
+    Компания с ИНН по созданной сделке или компании
+
+    Args:
+        event: ONCRMDEALADD или ONCRMCOMPANYADD
+        entity_id: ID сделки или компании
+
+    Returns:
+        {"inn", "name", "website", "deal_id"} или None
+    """
+    deal = {}
+    company_id = entity_id
+    if event == "ONCRMDEALADD":
+        deal = bitrix_service.get_deal(entity_id)
+        company_id = str(deal.get("COMPANY_ID") or "0")
+    company = {}
+    if company_id != "0":
+        company = bitrix_service.get_companies([company_id]).get(company_id, {})
+    return resolve_target(deal, company, settings.BITRIX_DEAL_INN_FIELD)
+
+
+async def handle_search(dialog_id: str, query: str):
+    """
+    Ответ на команду поиска: найденные досье из истории (дата, кто запросил, строка со словами запроса)
+
+    Args:
+        dialog_id: ID диалога
+        query: Слова запроса
+    """
+    if not query:
+        bitrix_service.send_message(
+            dialog_id, "🔎 Укажите, что искать в истории досье, например: /поиск логистика Казань"
+        )
+        return
+
+    results = await asyncio.to_thread(dossier_history.search, query, settings.DOSSIER_SEARCH_BOT_RESULTS)
+    if not results:
+        bitrix_service.send_message(
+            dialog_id,
+            f"🔎 В истории досье ничего не найдено по запросу «{query}».\n\n"
+            "Отправьте ИНН или название компании, чтобы запустить исследование."
+        )
+        return
+
+    lines = [f"🔎 Найдено в истории досье по запросу «{query}»:"]
+    for number, entry in enumerate(results, 1):
+        title = entry["name"] or entry["website"] or "Компания"
+        inn = f" (ИНН {entry['inn']})" if entry["inn"] else ""
+        date = datetime.fromisoformat(entry["created_at"]).strftime("%d.%m.%Y")
+        requester = f", запросил пользователь {entry['user_id']}" if entry["user_id"] else ""
+        deal = f", сделка {entry['deal_id']}" if entry["deal_id"] else ""
+        lines.append(f"\n{number}. {title}{inn} - {date}{requester}{deal}\n   {entry['snippet']}")
+    lines.append(
+        "\nЧтобы получить досье, отправьте ИНН: при актуальных источниках оно придет из хранилища "
+        "без нового исследования."
+    )
+    bitrix_service.send_message(dialog_id, "\n".join(lines))
+    logger.info(f"Поиск по истории досье «{query}»: найдено {len(results)}")
 
 
 async def handle_feedback(dialog_id: str, feedback_type: str, webhook_data: Dict):
@@ -242,9 +465,12 @@ async def handle_feedback(dialog_id: str, feedback_type: str, webhook_data: Dict
         params = webhook_data.get("data", {}).get("MESSAGE", {}).get("params", {})
         command_params = params.get("COMMAND_PARAMS", "")
 
-        company_id = command_params.replace("company=", "") if command_params else "неизвестна"
+        company_id, research_request_id = _parse_command_params(command_params)
+
+        logger.info(f"Получена оценка '{feedback_type}' для компании {company_id} (запрос {research_request_id})")
 
-        logger.info(f"Получена оценка '{feedback_type}' для компании {company_id}")
+        # Оценка сохраняется даже если ответ в чат не доставлен
+        _log_feedback(company_id, feedback_type, dialog_id, research_request_id)
 
         if feedback_type == "positive":
             message = "✅ Спасибо за положительную оценку! Рад, что досье было полезным."
@@ -260,14 +486,11 @@ async def handle_feedback(dialog_id: str, feedback_type: str, webhook_data: Dict
 
         bitrix_service.send_message(dialog_id, message)
 
-        # Здесь можно добавить логирование оценок в файл или БД
-        _log_feedback(company_id, feedback_type, dialog_id)
-
     except Exception as e:
         logger.error(f"Ошибка при обработке оценки: {e}", exc_info=True)
 
 
-async def handle_direct_research_request(company_name: str = None, inn: str = None, user_id: str = None, deal_id: str = None, company_website: str = None):
+async def handle_direct_research_request(company_name: str = None, inn: str = None, user_id: str = None, deal_id: str = None, company_website: str = None, request_id: str = None, source: str = "robot", idempotency_key: str = None):
     """
     Обработка прямого API запроса на исследование компании
 
@@ -277,105 +500,144 @@ async def handle_direct_research_request(company_name: str = None, inn: str = No
         user_id: ID пользователя Битрикс24 для отправки результата
         deal_id: ID сделки для добавления комментария с досье
         company_website: Сайт компании (если известен)
+        request_id: ID запроса (для трейса и логов)
+        source: Источник запроса: robot (робот сделки) или api (автоматизации, пакетные запросы)
+        idempotency_key: Ключ идемпотентности запроса (комментарий к сделке по ключу - один раз)
     """
-    try:
-        logger.info(f"Прямой API запрос: company_name={company_name}, inn={inn}, user_id={user_id}, deal_id={deal_id}, website={company_website}")
+    with (
+        request_context.bind(request_id, user_id=user_id, deal_id=deal_id, inn=inn, source=source) as ctx,
+        tracer.trace(ctx.request_id, "research.direct", user_id=user_id, deal_id=deal_id, inn=inn),
+        cassettes.use(cassette_name(inn, company_name, company_website)),
+    ):
+        try:
+            logger.info(f"Прямой API запрос: company_name={company_name}, inn={inn}, user_id={user_id}, deal_id={deal_id}, website={company_website}")
 
-        if not user_id:
-            logger.error("Отсутствует user_id в запросе")
-            return
+            if not user_id:
+                logger.error("Отсутствует user_id в запросе")
+                return
 
-        # Отправляем быструю отбивку пользователю
-        bitrix_service.send_message(
-            user_id,
-            f"✅ Запрос на исследование компании '{company_name or inn}' получен!\n\n"
-            "⏱️ Формирование детального досье займет 1-3 минуты.\n\n"
-            "Собираю информацию из интернета..."
-        )
-
-        # Создаем досье
-        try:
-            if inn:
-                dossier = await sales_analyzer.create_company_dossier(inn=inn, company_website=company_website)
-                feedback_id = inn
-            else:
-                dossier = await sales_analyzer.create_company_dossier(company_name=company_name, company_website=company_website)
-                feedback_id = company_name
-
-            # Отправляем досье
-            bitrix_service.send_message(
-                user_id,
-                dossier,
-                keyboard=None
-            )
-
-            # Добавляем комментарий к сделке если указан deal_id
-            if deal_id and not dossier.startswith("❌") and not dossier.startswith("😔"):
-                try:
-                    bitrix_service.add_deal_comment(deal_id, dossier)
-                    logger.info(f"Досье добавлено как комментарий к сделке {deal_id}")
-                except Exception as e:
-                    logger.warning(f"Не удалось добавить комментарий к сделке {deal_id}: {e}")
+            # Отправляем быструю отбивку пользователю (при повторе задания - не отправляем)
+            if first_attempt():
+                bitrix_service.send_message(
+                    user_id,
+                    f"✅ Запрос на исследование компании '{company_name or inn}' получен!\n\n"
+                    "⏱️ Формирование детального досье займет 1-3 минуты.\n\n"
+                    "Собираю информацию из интернета..."
+                )
 
-            # Отправляем кнопки оценки
-            if not dossier.startswith("❌") and not dossier.startswith("😔"):
-                try:
-                    keyboard = bitrix_service.create_feedback_keyboard(feedback_id)
-                    bitrix_service.send_message(
-                        user_id,
-                        "Оцените полезность досье:",
-                        keyboard=keyboard
-                    )
-                except Exception as e:
-                    logger.warning(f"Не удалось отправить кнопки оценки: {e}")
+            # Создаем досье
+            try:
+                if inn:
+                    dossier = await sales_analyzer.create_company_dossier(inn=inn, company_website=company_website)
+                    feedback_id = inn
+                else:
+                    dossier = await sales_analyzer.create_company_dossier(company_name=company_name, company_website=company_website)
+                    feedback_id = company_name
+
+                # Отправляем досье
+                bitrix_service.send_message(
+                    user_id,
+                    dossier,
+                    keyboard=None
+                )
 
-            logger.info(f"Досье для {company_name or inn} отправлено пользователю {user_id}")
+                # Добавляем комментарий к сделке если указан deal_id (повтор задания его не дублирует)
+                if deal_id and not dossier.startswith("❌") and not dossier.startswith("😔"):
+                    if idempotency.once(idempotency_key, "deal_comment"):
+                        try:
+                            bitrix_service.add_deal_comment(deal_id, dossier)
+                            logger.info(f"Досье добавлено как комментарий к сделке {deal_id}")
+                        except Exception as e:
+                            idempotency.undo(idempotency_key, "deal_comment")
+                            logger.warning(f"Не удалось добавить комментарий к сделке {deal_id}: {e}")
+                    else:
+                        logger.info(f"Комментарий к сделке {deal_id} уже добавлен по ключу {idempotency_key}")
+
+                # Отправляем кнопки оценки
+                if not dossier.startswith("❌") and not dossier.startswith("😔"):
+                    try:
+                        keyboard = bitrix_service.create_feedback_keyboard(feedback_id, request_context.get_request_id())
+                        bitrix_service.send_message(
+                            user_id,
+                            "Оцените полезность досье:",
+                            keyboard=keyboard
+                        )
+                    except Exception as e:
+                        logger.warning(f"Не удалось отправить кнопки оценки: {e}")
+
+                logger.info(f"Досье для {company_name or inn} отправлено пользователю {user_id}")
+                idempotency.finish(idempotency_key, IDEMPOTENCY_DONE)
+
+            except Exception as e:
+                # Задание очереди повторит воркер - пользователю сообщаем только после последней попытки
+                if retry_pending():
+                    raise
+                logger.error(f"Ошибка при создании досье: {e}", exc_info=True)
+                idempotency.finish(idempotency_key, IDEMPOTENCY_FAILED)
+
+                # Отправляем понятное сообщение об ошибке
+                bitrix_service.send_message(
+                    user_id,
+                    f"😔 К сожалению, не удалось собрать информацию о компании '{company_name or inn}'.\n\n"
+                    "Возможные причины:\n"
+                    "• Компания не зарегистрирована в России\n"
+                    "• Неправильное название или ИНН\n"
+                    "• Временные проблемы с источниками данных\n\n"
+                    "Попробуйте:\n"
+                    "• Уточнить название компании\n"
+                    "• Использовать ИНН (10 или 12 цифр)\n"
+                    "• Попробовать через несколько минут"
+                )
 
         except Exception as e:
-            logger.error(f"Ошибка при создании досье: {e}", exc_info=True)
-
-            # Отправляем понятное сообщение об ошибке
-            bitrix_service.send_message(
-                user_id,
-                f"😔 К сожалению, не удалось собрать информацию о компании '{company_name or inn}'.\n\n"
-                "Возможные причины:\n"
-                "• Компания не зарегистрирована в России\n"
-                "• Неправильное название или ИНН\n"
-                "• Временные проблемы с источниками данных\n\n"
-                "Попробуйте:\n"
-                "• Уточнить название компании\n"
-                "• Использовать ИНН (10 или 12 цифр)\n"
-                "• Попробовать через несколько минут"
-            )
+            if retry_pending():
+                raise
+            logger.error(f"Критическая ошибка в прямом API запросе: {e}", exc_info=True)
+            idempotency.finish(idempotency_key, IDEMPOTENCY_FAILED)
 
-    except Exception as e:
-        logger.error(f"Критическая ошибка в прямом API запросе: {e}", exc_info=True)
 
+def _parse_command_params(command_params: str) -> Tuple[str, Optional[str]]:
+    """
+    Разбор COMMAND_PARAMS кнопки оценки
+
+    Args:
+        command_params: "company=<ИНН или название>[&request_id=<id>]" или просто идентификатор компании
+
+    Returns:
+        (идентификатор компании, ID запроса, по которому строилось досье)
+    """
+    if not command_params:
+        return "неизвестна", None
+    company_id, separator, request_id = command_params.rpartition("&request_id=")
+    if not separator:
+        company_id, request_id = command_params, None
+    return company_id.replace("company=", "", 1), request_id or None
 
-def _log_feedback(company_id: str, feedback_type: str, dialog_id: str):
+
+def _log_feedback(company_id: str, feedback_type: str, dialog_id: str, research_request_id: Optional[str] = None):
     """
-    Логирование оценок в файл
+    Запись оценки в хранилище (в очередь пакетной записи)
 
     Args:
         company_id: ИНН или название компании
         feedback_type: Тип оценки
         dialog_id: ID диалога
+        research_request_id: ID запроса, по которому строилось досье (связь с трейсом и затратами)
     """
     try:
         from datetime import datetime
-        import json
 
-        log_entry = {
-            "timestamp": datetime.now().isoformat(),
+        ctx = request_context.current()
+        feedback_store.add({
+            "ts": datetime.now().isoformat(),
             "company": company_id,
             "feedback": feedback_type,
-            "dialog_id": dialog_id
-        }
-
-        with open("feedback_log.jsonl", "a", encoding="utf-8") as f:
-            f.write(json.dumps(log_entry, ensure_ascii=False) + "\n")
+            "dialog_id": dialog_id,
+            "user_id": ctx.user_id if ctx else None,
+            "request_id": research_request_id,
+        })
 
-        logger.info(f"Оценка '{feedback_type}' для компании '{company_id}' записана в лог")
+        logger.info(f"Оценка '{feedback_type}' для компании '{company_id}' поставлена в очередь записи")
 
     except Exception as e:
-        logger.error(f"Ошибка при записи оценки в лог: {e}")
+        logger.error(f"Ошибка при записи оценки: {e}")
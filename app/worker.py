@@ -0,0 +1,246 @@
+"""
+Воркер исследований Sales Scout (RESEARCH_EXECUTION=queue)
+
+    python -m app.worker [--concurrency N]
+
+Забирает задания из очереди (app/services/job_queue.py) и выполняет их обработчики.
+Пока задание выполняется, аренда продлевается каждую треть JOB_LEASE_SECONDS; если аренда
+потеряна (воркер завис дольше аренды и задание забрал другой), выполнение прерывается.
+По SIGTERM/SIGINT новые задания не берутся, выполняемые дожидаются WORKER_SHUTDOWN_SECONDS,
+незавершенные вернутся в очередь по истечении аренды. Задание, обработчик которого завершился
+ошибкой, повторяется через JOB_RETRY_SECONDS (с удвоением), всего не больше JOB_MAX_ATTEMPTS попыток;
+обработчики исследований сообщают пользователю об ошибке только на последней попытке.
+"""
+import os
+import signal
+import socket
+import asyncio
+import logging
+import argparse
+from typing import Dict, Set
+
+from dotenv import load_dotenv
+
+from app.config import settings
+from app.logging_config import setup_logging, shutdown_logging
+from app.services.job_queue import DONE, FAILED, Job, JobQueue, attempt, job_queue
+from app.services.metrics import metrics
+from app.services.priority import max_rank, reserve_floors
+
+logger = logging.getLogger(__name__)
+
+
+def job_handler(name: str):
+    """
+    Асинхронный обработчик задания по имени
+
+    Args:
+        name: bitrix_message, crm_event, direct_research, dossier_refresh или prewarm
+    """
+    from app.webhooks.bitrix_handler import (
+        handle_bitrix_message,
+        handle_crm_event,
+        handle_direct_research_request,
+        handle_dossier_refresh,
+    )
+    from app.services.prewarm import prewarm_job
+
+    handlers = {
+        "bitrix_message": handle_bitrix_message,
+        "crm_event": handle_crm_event,
+        "direct_research": handle_direct_research_request,
+        "dossier_refresh": handle_dossier_refresh,
+        "prewarm": prewarm_job.run,
+    }
+    if name not in handlers:
+        raise ValueError(f"Неизвестное задание: {name}")
+    return handlers[name]
+
+
+class ResearchWorker:
+    """Цикл захвата и выполнения заданий с ограничением параллельности"""
+
+    def __init__(self, queue: JobQueue, concurrency: int, lease_seconds: float, poll_seconds: float,
+                 shutdown_seconds: float, reserved: Dict[str, int], max_attempts: int, retry_seconds: float):
+        self.queue = queue
+        self.concurrency = concurrency
+        # Младшие классы не занимают последние слоты, зарезервированные для старших
+        self._floors = reserve_floors(reserved, concurrency)
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.shutdown_seconds = shutdown_seconds
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stopping = asyncio.Event()
+        self._tasks: Set[asyncio.Task] = set()
+
+    def stop(self):
+        """Прекратить захват новых заданий"""
+        if not self._stopping.is_set():
+            logger.info("Остановка воркера: новые задания не берутся")
+            self._stopping.set()
+
+    async def run(self):
+        """Захват заданий до остановки, затем ожидание выполняемых"""
+        logger.info(f"Воркер {self.worker_id} запущен, параллельность {self.concurrency}")
+        slots = asyncio.Semaphore(self.concurrency)
+        while not self._stopping.is_set():
+            await slots.acquire()
+            job = None
+            try:
+                if not self._stopping.is_set():
+                    allowed = max_rank(self._floors, self.concurrency - len(self._tasks))
+                    job = await asyncio.to_thread(self.queue.claim, self.worker_id, self.lease_seconds, allowed)
+            except Exception as e:
+                logger.error(f"Ошибка захвата задания: {e}")
+            if job is None:
+                slots.release()
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.poll_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task = asyncio.create_task(self._execute(job))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+
+        if self._tasks:
+            logger.info(f"Ожидание выполняемых заданий: {len(self._tasks)}")
+            _, pending = await asyncio.wait(self._tasks, timeout=self.shutdown_seconds)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+                logger.warning(f"Не завершено заданий: {len(pending)} (вернутся в очередь по истечении аренды)")
+
+    async def _execute(self, job: Job):
+        """Выполнение задания с продлением аренды"""
+        logger.info(f"Задание {job.id} ({job.name}, {job.priority}), попытка {job.attempts}")
+        heartbeat = asyncio.create_task(self._heartbeat(job, asyncio.current_task()))
+        metrics.in_flight.inc()
+        status, error = DONE, None
+        try:
+            with attempt(job.attempts, self.max_attempts):
+                await job_handler(job.name)(**job.kwargs)
+        except asyncio.CancelledError:
+            # Аренда потеряна или воркер останавливается - задание не завершаем
+            logger.warning(f"Задание {job.id} прервано")
+            return
+        except Exception as e:
+            status, error = FAILED, str(e)
+            if job.attempts < self.max_attempts:
+                logger.warning(f"Задание {job.id} завершилось ошибкой, будет повторено: {e}")
+            else:
+                logger.error(f"Задание {job.id} завершилось ошибкой: {e}", exc_info=True)
+        finally:
+            heartbeat.cancel()
+            metrics.in_flight.dec()
+
+        try:
+            if status == FAILED and job.attempts < self.max_attempts:
+                delay = self.retry_seconds * 2 ** (job.attempts - 1)
+                await asyncio.to_thread(self.queue.retry, job.id, self.worker_id, delay, error)
+            else:
+                await asyncio.to_thread(self.queue.complete, job.id, self.worker_id, status, error)
+        except Exception as e:
+            logger.error(f"Не удалось завершить задание {job.id}: {e}")
+
+    async def _heartbeat(self, job: Job, task: asyncio.Task):
+        """Продление аренды; при потере аренды выполнение задания отменяется"""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                owned = await asyncio.to_thread(self.queue.heartbeat, job.id, self.worker_id, self.lease_seconds)
+            except Exception as e:
+                logger.warning(f"Не удалось продлить аренду задания {job.id}: {e}")
+                continue
+            if not owned:
+                logger.error(f"Аренда задания {job.id} потеряна, выполнение прерывается")
+                task.cancel()
+                return
+
+
+def _warm_up():
+    """Построение тяжелых сервисов до первого задания"""
+    from app.services.sales_analyzer import sales_analyzer
+
+    try:
+        sales_analyzer.warm_up()
+    except Exception as e:
+        logger.warning(f"Не удалось заранее построить сервисы: {e}")
+
+
+async def serve(concurrency: int):
+    """Воркер с остановкой по сигналам и фоновыми сервисами процесса"""
+    from app.services.feedback_store import feedback_store
+    from app.services.openrouter_client import openrouter_client
+    from app.services.prewarm import prewarm_job
+    from app.services.priority import thread_pools
+    from app.services.tracing import tracer
+    from app.startup import startup_report
+
+    # Отчета о запуске у воркера нет: учет импорта (STARTUP_IMPORT_TIMER) не нужен
+    startup_report.uninstall_import_timer()
+    worker = ResearchWorker(
+        job_queue,
+        concurrency,
+        settings.JOB_LEASE_SECONDS,
+        settings.JOB_POLL_SECONDS,
+        settings.WORKER_SHUTDOWN_SECONDS,
+        settings.WORKER_RESERVED_SLOTS,
+        settings.JOB_MAX_ATTEMPTS,
+        settings.JOB_RETRY_SECONDS,
+    )
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.stop)
+
+    if settings.PREWARM_SERVICES:
+        # Анализатор и LLM клиент строятся до первого задания
+        loop.run_in_executor(None, _warm_up)
+    # В режиме очереди ночной прогрев идет в воркерах (один проход - блокировка в общем состоянии)
+    if settings.PREWARM_ENABLED:
+        prewarm_job.start()
+    try:
+        await worker.run()
+    finally:
+        if prewarm_job.is_built:
+            prewarm_job.stop()
+        await asyncio.to_thread(feedback_store.close)
+        if tracer.is_built:
+            await asyncio.to_thread(tracer.close)
+        if thread_pools.is_built:
+            thread_pools.shutdown()
+        await openrouter_client.aclose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воркер исследований Sales Scout")
+    parser.add_argument("--concurrency", type=int, default=None, help="Параллельные задания (по умолчанию WORKER_CONCURRENCY)")
+    args = parser.parse_args()
+
+    load_dotenv()
+    setup_logging(
+        settings.LOG_LEVEL,
+        settings.LOG_FILE,
+        settings.LOG_MAX_BYTES,
+        settings.LOG_BACKUP_COUNT,
+        settings.LOG_SAMPLE_RATE,
+        settings.LOG_SAMPLE_BURST,
+        settings.LOG_JSON_CONSOLE,
+    )
+    if settings.WORKER_METRICS_PORT:
+        from prometheus_client import start_http_server
+
+        start_http_server(settings.WORKER_METRICS_PORT, registry=metrics.registry)
+    try:
+        asyncio.run(serve(args.concurrency or settings.WORKER_CONCURRENCY))
+    finally:
+        shutdown_logging()
+
+
+if __name__ == "__main__":
+    main()
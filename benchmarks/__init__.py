@@ -0,0 +1 @@
+"""Бенчмарки и нагрузочные инструменты Sales Scout (работают без внешней сети)"""
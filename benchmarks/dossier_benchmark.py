@@ -0,0 +1,164 @@
+"""
+Бенчмарк пропускной способности create_company_dossier на локальных заглушках
+
+Запускает N досье с заданной конкурентностью в одном event loop (как фоновые
+задачи в uvicorn) и печатает throughput и p50/p95/p99 латентности.
+
+Запуск:
+    python -m benchmarks.dossier_benchmark --requests 40 --concurrency 8 --start-mocks
+    python -m benchmarks.dossier_benchmark --mock-url http://127.0.0.1:9100 --inn-file golden.txt
+
+Золотой набор на кассетах (реальные данные без платных вызовов):
+    # один раз: запись реальных обменов (ключи API из .env)
+    python -m benchmarks.dossier_benchmark --live --record --inn-file golden.txt --concurrency 1
+    # сколько угодно раз: воспроизведение без задержек или с исходными задержками
+    python -m benchmarks.dossier_benchmark --replay --latency-scale 0 --inn-file golden.txt
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+
+from benchmarks.mock_upstreams import env_for, start_in_thread, parse_profiles, add_profile_arguments
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def latency_summary(latencies: List[float]) -> Dict:
+    """p50/p95/p99/max в секундах"""
+    return {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": max(latencies) if latencies else None,
+    }
+
+
+def synthetic_inns(count: int, seed: int = 42) -> List[str]:
+    """Детерминированный набор 10-значных ИНН"""
+    rng = random.Random(seed)
+    return [str(rng.randint(10 ** 9, 10 ** 10 - 1)) for _ in range(count)]
+
+
+async def run_benchmark(inns: List[str], concurrency: int) -> Dict:
+    """
+    Прогон досье по списку ИНН
+
+    Args:
+        inns: ИНН компаний (по одному досье на элемент)
+        concurrency: Сколько досье выполняется одновременно
+
+    Returns:
+        Отчет: количество, ошибки, throughput, перцентили
+    """
+    # Импорт после настройки окружения: settings читаются при импорте
+    from app.services.sales_analyzer import sales_analyzer
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+
+    async def one(inn: str):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                dossier = await sales_analyzer.create_company_dossier(inn=inn)
+                if dossier.startswith("❌") or dossier.startswith("😔"):
+                    errors["not_found"] = errors.get("not_found", 0) + 1
+                    return
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(inn) for inn in inns))
+    wall = time.perf_counter() - started
+
+    return {
+        "requests": len(inns),
+        "concurrency": concurrency,
+        "ok": len(latencies),
+        "errors": errors,
+        "wall_seconds": round(wall, 3),
+        "throughput_per_min": round(len(latencies) / wall * 60, 2) if wall else None,
+        "latency_seconds": {k: (round(v, 3) if v is not None else None) for k, v in latency_summary(latencies).items()},
+    }
+
+
+def print_report(report: Dict):
+    latency = report["latency_seconds"]
+    print(f"Досье: {report['ok']}/{report['requests']} успешно, конкурентность {report['concurrency']}")
+    if report["errors"]:
+        print(f"Ошибки: {report['errors']}")
+    print(f"Время: {report['wall_seconds']} с, throughput: {report['throughput_per_min']} досье/мин")
+    print(f"Латентность: p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} max={latency['max']} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк create_company_dossier на заглушках")
+    parser.add_argument("--requests", type=int, default=20, help="Количество досье")
+    parser.add_argument("--concurrency", type=int, default=4, help="Одновременных досье")
+    parser.add_argument("--inn-file", help="Файл со списком ИНН (по одному в строке)")
+    parser.add_argument("--mock-url", default="http://127.0.0.1:9100", help="Адрес заглушек")
+    parser.add_argument("--start-mocks", action="store_true", help="Поднять заглушки в этом процессе")
+    parser.add_argument("--json", action="store_true", help="Вывести отчет в JSON")
+    parser.add_argument("--live", action="store_true", help="Реальные API из .env вместо заглушек")
+    cassette_mode = parser.add_mutually_exclusive_group()
+    cassette_mode.add_argument("--record", action="store_true", help="Записать обмены в кассеты")
+    cassette_mode.add_argument("--replay", action="store_true", help="Воспроизвести обмены из кассет")
+    parser.add_argument("--cassette-dir", default="cassettes", help="Каталог кассет")
+    parser.add_argument("--latency-scale", type=float, default=1.0, help="Множитель записанных задержек (0 - без задержек)")
+    parser.add_argument("--dossier-cache", action="store_true", help="Использовать сохраненные досье и кэш идентификации (по умолчанию каждый прогон - полный пайплайн)")
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    if args.record or args.replay:
+        os.environ["CASSETTE_MODE"] = "record" if args.record else "replay"
+        os.environ["CASSETTE_DIR"] = args.cassette_dir
+        os.environ["CASSETTE_LATENCY_SCALE"] = str(args.latency_scale)
+
+    if args.start_mocks:
+        host_port = args.mock_url.split("://", 1)[-1]
+        host, _, port = host_port.partition(":")
+        start_in_thread(host, int(port or 9100), parse_profiles(args.latency, args.jitter, args.errors, args.error_status))
+
+    if not args.live:
+        # При воспроизведении заглушки не вызываются, но settings требуют значения
+        for name, value in env_for(args.mock_url).items():
+            os.environ.setdefault(name, value)
+    # Нагрузочный прогон не должен засорять рабочие журналы
+    os.environ.setdefault("TRACE_SAMPLE_RATE", "0")
+    os.environ.setdefault("COST_LEDGER_PATH", os.devnull)
+    os.environ.setdefault("DOSSIER_HISTORY", "false")
+    if not args.dossier_cache:
+        os.environ.setdefault("DOSSIER_CACHE", "false")
+        os.environ.setdefault("IDENTIFICATION_CACHE_HOURS", "0")
+
+    if args.inn_file:
+        with open(args.inn_file, encoding="utf-8") as f:
+            inns = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+        inns = (inns * (args.requests // len(inns) + 1))[:args.requests] if args.requests > len(inns) else inns
+    else:
+        inns = synthetic_inns(args.requests)
+
+    report = asyncio.run(run_benchmark(inns, args.concurrency))
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,554 @@
+"""
+Локальные заглушки внешних API для нагрузочного тестирования
+
+Один процесс обслуживает все upstream под разными префиксами:
+- /dadata/findById/party, /dadata/suggest/party          - DaData
+- /openrouter/api/v1/chat/completions                    - OpenRouter (Perplexity и LLM досье, SSE при stream)
+- /bitrix/rest/imbot.message.add.json, batch.json,
+  crm.timeline.comment.add.json, crm.deal.list.json,
+  crm.deal.get.json, crm.company.list.json,
+  crm.requisite.list.json                                - Битрикс24
+- /sites/{inn}/                                          - статические сайты компаний
+
+У каждого upstream настраиваются задержка, разброс и доля ошибок.
+
+Запуск:
+    python -m benchmarks.mock_upstreams --port 9100 --latency openrouter=1500 --errors openrouter=0.05
+
+Приложение направляется на заглушки переменными окружения (см. env_for()).
+"""
+import re
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+import threading
+from collections import deque
+from dataclasses import dataclass, asdict
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
+
+UPSTREAMS = ("dadata", "openrouter", "bitrix", "website")
+
+# Сколько последних вызовов Битрикс24 храним для отчетов нагрузочных тестов
+BITRIX_LOG_LIMIT = 50000
+# Открытые сделки в crm.deal.list (у четных ИНН в поле сделки, у нечетных - в реквизитах компании)
+MOCK_OPEN_DEALS = 120
+
+
+@dataclass
+class UpstreamProfile:
+    """Поведение заглушки: задержка (мс), разброс (мс), доля ошибок и код ошибки"""
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 500
+
+
+DEFAULT_PROFILES = {
+    "dadata": UpstreamProfile(latency_ms=80, jitter_ms=20),
+    "openrouter": UpstreamProfile(latency_ms=1500, jitter_ms=500),
+    "bitrix": UpstreamProfile(latency_ms=100, jitter_ms=30),
+    "website": UpstreamProfile(latency_ms=300, jitter_ms=100),
+}
+
+
+def env_for(base_url: str) -> Dict[str, str]:
+    """
+    Переменные окружения, направляющие приложение на заглушки
+
+    Args:
+        base_url: Адрес заглушек, например http://127.0.0.1:9100
+
+    Returns:
+        Словарь переменных окружения
+    """
+    return {
+        "DADATA_BASE_URL": f"{base_url}/dadata",
+        "DADATA_API_KEY": "mock",
+        "OPENROUTER_BASE_URL": f"{base_url}/openrouter/api/v1",
+        "OPENROUTER_API_KEY": "mock",
+        "BITRIX24_WEBHOOK_URL": f"{base_url}/bitrix/rest",
+        "BITRIX24_BOT_ID": "1",
+    }
+
+
+# =================================================================
+# Синтетические данные компаний (детерминированы по ИНН)
+# =================================================================
+
+def _inn_from_name(name: str) -> str:
+    digest = hashlib.sha1(name.lower().encode("utf-8")).hexdigest()
+    return str(int(digest, 16))[:10]
+
+
+def _company(inn: str) -> Dict:
+    suffix = inn[-4:]
+    return {
+        "inn": inn,
+        "short_name": f"ООО «Тест-{suffix}»",
+        "full_name": f"ОБЩЕСТВО С ОГРАНИЧЕННОЙ ОТВЕТСТВЕННОСТЬЮ «ТЕСТ-{suffix}»",
+        "director": f"Иванов Иван {suffix}",
+        "employee_count": int(suffix) % 500 + 1,
+        "capital": (int(suffix) % 100 + 1) * 10000,
+    }
+
+
+def _dadata_party(inn: str) -> Dict:
+    company = _company(inn)
+    return {
+        "value": company["short_name"],
+        "data": {
+            "inn": inn,
+            "kpp": "770101001",
+            "ogrn": "1" + inn.ljust(12, "0"),
+            "okved": "62.01",
+            "name": {"full_with_opf": company["full_name"], "short_with_opf": company["short_name"]},
+            "state": {"status": "ACTIVE", "registration_date": 1262304000000},
+            "management": {"name": company["director"], "post": "ГЕНЕРАЛЬНЫЙ ДИРЕКТОР"},
+            "address": {
+                "value": "г Москва, ул Тестовая, д 1",
+                "data": {"region": "Москва", "city": "Москва"},
+            },
+            "capital": {"value": company["capital"]},
+            "employee_count": company["employee_count"],
+        },
+    }
+
+
+def _perplexity_payload(kind: str, inn: str, site_base: str) -> Dict:
+    """JSON в форме, которую ожидают методы PerplexityService"""
+    company = _company(inn)
+    website = f"{site_base}/sites/{inn}/"
+
+    if kind == "identification":
+        return {"found": True, "variants": [{
+            "name": company["full_name"],
+            "short_name": company["short_name"],
+            "inn": inn,
+            "confidence": 0.95,
+            "description": "Разработка программного обеспечения",
+            "website": website,
+        }]}
+    if kind == "online_presence":
+        return {
+            "website": website,
+            "vk": f"https://vk.com/test{inn}",
+            "telegram": f"https://t.me/test{inn}",
+            "youtube": None,
+            "other": [],
+        }
+    if kind == "executives":
+        return {"executives": [{
+            "name": company["director"],
+            "position": "Генеральный директор",
+            "tenchat": None,
+            "linkedin": None,
+            "telegram": f"@ceo{inn[-4:]}",
+            "vk": None,
+            "email": f"ceo@test{inn}.ru",
+            "phone": None,
+            "source": "сайт компании",
+        }]}
+    if kind == "business":
+        return {
+            "finances": {
+                "revenue_yearly_rub": "100-200 млн",
+                "employees_count": str(company["employee_count"]),
+                "company_size": "средний",
+                "growth_trend": "растет",
+            },
+            "business": {
+                "products": ["Внедрение CRM", "Разработка ПО"],
+                "target_audience": "B2B",
+                "major_clients": [],
+                "industry": "IT",
+                "geography": ["Москва"],
+            },
+            "technologies": {"crm": None, "erp": None, "automation": [], "tech_stack": []},
+            "market": {"competitors": [], "positioning": "", "competitive_advantages": []},
+        }
+    if kind == "news":
+        return {
+            "news": [{
+                "date": "2025-10-01",
+                "title": f"{company['short_name']} открыла новый офис",
+                "summary": "Компания расширяет присутствие в регионах.",
+                "source": "VC.ru",
+                "url": f"https://vc.ru/test/{inn}",
+                "type": "новость",
+                "sentiment": "позитивная",
+            }],
+            "exhibitions": [],
+            "conferences": [],
+            "awards": [],
+            "upcoming_events": [],
+            "media_activity_score": "низкая",
+            "total_mentions_estimate": "5",
+        }
+    if kind == "person":
+        return {"person": {"name": company["director"], "position": "Генеральный директор"}, "bio_summary": ""}
+    return {}
+
+
+def _dossier_text(inn: Optional[str]) -> str:
+    """Текст досье в формате шаблона SalesAnalyzer"""
+    company = _company(inn or "0000000000")
+    separator = "═══════════════════════════════════"
+    sections = [
+        f"📋 ДОСЬЕ КОМПАНИИ\n\n🏢 {company['short_name']}\n📍 г Москва\n👤 Директор: {company['director']}\n✅ Статус: ACTIVE",
+        f"📊 МАСШТАБ БИЗНЕСА\n💰 Оборот: 100-200 млн\n👥 Сотрудников: {company['employee_count']}",
+        "🌐 ОНЛАЙН-ПРИСУТСТВИЕ\n• Сайт: [URL=https://example.ru]example.ru[/URL]",
+        f"👥 КЛЮЧЕВЫЕ ЛИЦА (публичные представители)\n1️⃣ {company['director']} - Генеральный директор",
+        "💼 ЧЕМ ЗАНИМАЮТСЯ\nРазработка программного обеспечения",
+        "💻 ТЕХНОЛОГИИ\nИнформация о технологиях не найдена",
+        "📰 ПОСЛЕДНИЕ НОВОСТИ\n• 2025-10-01: Открытие нового офиса",
+        "🎪 ВЫСТАВКИ И МЕРОПРИЯТИЯ\nИнформация о мероприятиях не найдена",
+        "🎯 ВАЖНО ДЛЯ ПРОДАЖИ\n📌 НА ЧТО СДЕЛАТЬ АКЦЕНТ:\n• Автоматизация продаж",
+    ]
+    return f"\n\n{separator}\n\n".join(sections)
+
+
+def _deal_inn(deal_id: int) -> str:
+    return str(7700000000 + deal_id)
+
+
+def _crm_list(method: str, params: Dict, site_base: str) -> Dict:
+    """Страница списочного метода CRM (по 50 записей, как в Битрикс24)"""
+    flt = params.get("filter") or {}
+    ids = [int(value) for value in (flt.get("ID") or flt.get("ENTITY_ID") or [])]
+    if method == "crm.deal.list":
+        records = [
+            {"ID": str(i), "TITLE": f"Сделка {i}", "COMPANY_ID": str(i), "UF_CRM_INN": _deal_inn(i) if i % 2 == 0 else ""}
+            for i in range(1, MOCK_OPEN_DEALS + 1)
+        ]
+    elif method == "crm.company.list":
+        records = [
+            {"ID": str(i), "TITLE": _company(_deal_inn(i))["short_name"], "WEB": [{"VALUE": f"{site_base}/sites/{_deal_inn(i)}/"}]}
+            for i in ids
+        ]
+    else:
+        records = [{"ENTITY_ID": str(i), "RQ_INN": _deal_inn(i)} for i in ids]
+
+    start = int(params.get("start") or 0)
+    page = {"result": records[start:start + 50], "total": len(records)}
+    if start + 50 < len(records):
+        page["next"] = start + 50
+    return page
+
+
+# Маркеры типа запроса в промптах SalesAnalyzer и PerplexityService (проверяются по порядку)
+_SEARCH_MARKERS = (
+    ("ДОСЬЕ КОМПАНИИ", "dossier"),
+    ("информацию о человеке", "person"),
+    ("РОССИЙСКУЮ компанию или ИП", "identification"),
+    ("онлайн-присутствие", "online_presence"),
+    ("ключевых лиц компании", "executives"),
+    ("бизнес-информацию", "business"),
+    ("новости и мероприятия", "news"),
+)
+
+
+def _message_text(messages: List[Dict]) -> str:
+    parts = []
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            parts.extend(part.get("text", "") for part in content if isinstance(part, dict))
+        elif content:
+            parts.append(str(content))
+    return "\n".join(parts)
+
+
+def _cache_marked_text(messages: List[Dict]) -> str:
+    """Текст частей сообщений, помеченных cache_control (префикс для кэша провайдера)"""
+    return "".join(
+        part.get("text", "")
+        for message in messages if isinstance(message.get("content"), list)
+        for part in message["content"] if isinstance(part, dict) and part.get("cache_control")
+    )
+
+
+def _classify(text: str) -> str:
+    for marker, kind in _SEARCH_MARKERS:
+        if marker in text:
+            return kind
+    return "dossier"
+
+
+def _find_inn(text: str) -> Optional[str]:
+    match = re.search(r"ИНН[:\s\"]*(\d{10,12})", text) or re.search(r'"inn":\s*"(\d{10,12})"', text)
+    if match:
+        return match.group(1)
+    match = re.search(r'запросу:\s*"([^"]+)"', text) or re.search(r'компании\s+"([^"]+)"', text)
+    if match:
+        query = match.group(1).strip()
+        return query if query.isdigit() and len(query) in (10, 12) else _inn_from_name(query)
+    return None
+
+
+async def _sse_chunks(content: str, model: str, usage: Dict, pieces: int = 20):
+    """Потоковый ответ в формате OpenRouter: комментарий, фрагменты delta, usage, [DONE]"""
+    yield ": OPENROUTER PROCESSING\n\n"
+    step = max(1, len(content) // pieces)
+    for i in range(0, len(content), step):
+        chunk = {"model": model, "choices": [{"index": 0, "delta": {"content": content[i:i + step]}, "finish_reason": None}]}
+        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+        await asyncio.sleep(0.005)
+    final = {"model": model, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "usage": usage}
+    yield f"data: {json.dumps(final, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+# =================================================================
+# Приложение заглушек
+# =================================================================
+
+class MockUpstreams:
+    """Состояние заглушек: профили задержек и журнал вызовов Битрикс24"""
+
+    def __init__(self, profiles: Optional[Dict[str, UpstreamProfile]] = None):
+        self.profiles = {name: UpstreamProfile(**asdict(p)) for name, p in DEFAULT_PROFILES.items()}
+        self.profiles.update(profiles or {})
+        self.bitrix_calls = deque(maxlen=BITRIX_LOG_LIMIT)
+        self.counters = {name: 0 for name in UPSTREAMS}
+        self.cached_prefixes = set()
+        self.app = self._build_app()
+
+    async def _simulate(self, upstream: str) -> Optional[JSONResponse]:
+        """Задержка и инъекция ошибки. Возвращает ответ-ошибку или None."""
+        profile = self.profiles[upstream]
+        self.counters[upstream] += 1
+        delay = max(0.0, random.gauss(profile.latency_ms, profile.jitter_ms)) / 1000
+        if delay:
+            await asyncio.sleep(delay)
+        if profile.error_rate and random.random() < profile.error_rate:
+            return JSONResponse({"error": "injected", "error_description": "mock error"}, status_code=profile.error_status)
+        return None
+
+    def _build_app(self) -> FastAPI:
+        app = FastAPI(title="Sales Scout mock upstreams")
+
+        @app.get("/_config")
+        async def get_config():
+            return {name: asdict(profile) for name, profile in self.profiles.items()}
+
+        @app.post("/_config")
+        async def set_config(request: Request):
+            """Изменение профилей на лету: {"openrouter": {"latency_ms": 3000}}"""
+            for name, values in (await request.json()).items():
+                if name in self.profiles:
+                    self.profiles[name] = UpstreamProfile(**{**asdict(self.profiles[name]), **values})
+            return await get_config()
+
+        @app.get("/_stats")
+        async def stats():
+            return {"requests": self.counters, "bitrix_calls": len(self.bitrix_calls)}
+
+        @app.post("/dadata/findById/party")
+        async def dadata_find_by_id(request: Request):
+            if error := await self._simulate("dadata"):
+                return error
+            query = str((await request.json()).get("query", ""))
+            if not (query.isdigit() and len(query) in (10, 12)):
+                return {"suggestions": []}
+            return {"suggestions": [_dadata_party(query)]}
+
+        @app.post("/dadata/suggest/party")
+        async def dadata_suggest(request: Request):
+            if error := await self._simulate("dadata"):
+                return error
+            body = await request.json()
+            query = str(body.get("query", ""))
+            count = int(body.get("count", 5))
+            base_inn = _inn_from_name(query)
+            return {"suggestions": [_dadata_party(str(int(base_inn) + i)[:10]) for i in range(min(count, 5))]}
+
+        @app.post("/openrouter/api/v1/chat/completions")
+        async def chat_completions(request: Request):
+            if error := await self._simulate("openrouter"):
+                return error
+            payload = await request.json()
+            text = _message_text(payload.get("messages", []))
+            kind = _classify(text)
+            inn = _find_inn(text)
+            site_base = str(request.base_url).rstrip("/")
+
+            if kind == "dossier":
+                content = _dossier_text(inn)
+            else:
+                content = json.dumps(_perplexity_payload(kind, inn or "0000000000", site_base), ensure_ascii=False)
+
+            prompt_tokens = len(text) // 4
+            completion_tokens = len(content) // 4
+            # Кэш провайдера: повторный префикс с cache_control читается по цене 0.1
+            prefix = _cache_marked_text(payload.get("messages", []))
+            cached = len(prefix) // 4 if prefix and prefix in self.cached_prefixes else 0
+            if prefix:
+                self.cached_prefixes.add(prefix)
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached},
+                "cost": round(((prompt_tokens - cached * 0.9) * 3 + completion_tokens * 15) / 1_000_000, 6),
+            }
+            if payload.get("stream"):
+                return StreamingResponse(_sse_chunks(content, payload.get("model", "mock"), usage), media_type="text/event-stream")
+            return {
+                "id": f"mock-{int(time.time() * 1000)}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": payload.get("model", "mock"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop",
+                }],
+                "usage": usage,
+            }
+
+        @app.api_route("/bitrix/rest/{method}", methods=["GET", "POST"])
+        async def bitrix_method(method: str, request: Request):
+            if error := await self._simulate("bitrix"):
+                return error
+            method = method.removesuffix(".json")
+            params = dict(request.query_params)
+            if request.method == "POST":
+                if request.headers.get("content-type", "").startswith("application/json"):
+                    params.update(await request.json())
+                else:
+                    params.update(dict(await request.form()))
+
+            self.bitrix_calls.append({"ts": time.time(), "method": method, "params": _summarize(params)})
+
+            if method == "crm.deal.get":
+                deal_id = int(params.get("id") or 0)
+                return {"result": {"ID": str(deal_id), "TITLE": f"Сделка {deal_id}", "COMPANY_ID": str(deal_id),
+                                   "UF_CRM_INN": _deal_inn(deal_id) if deal_id % 2 == 0 else ""}}
+            if method in ("crm.deal.list", "crm.company.list", "crm.requisite.list"):
+                return _crm_list(method, params, str(request.base_url).rstrip("/"))
+            if method == "batch":
+                commands = {k[4:-1]: v for k, v in params.items() if k.startswith("cmd[")}
+                commands.update(params.get("cmd") or {})
+                return {"result": {"result": {key: True for key in commands}, "result_error": []}}
+            return {"result": len(self.bitrix_calls)}
+
+        @app.get("/bitrix/_calls")
+        async def bitrix_calls(since: float = 0.0):
+            """Журнал вызовов Битрикс24 (для замера end-to-end времени)"""
+            return [call for call in self.bitrix_calls if call["ts"] >= since]
+
+        @app.get("/sites/{inn}/", response_class=HTMLResponse)
+        async def company_site(inn: str):
+            if error := await self._simulate("website"):
+                return error
+            company = _company(inn)
+            return f"""<html><head><title>{company['short_name']}</title></head><body>
+<h1>{company['short_name']}</h1>
+<p>Разработка программного обеспечения для бизнеса.</p>
+<p>Телефон: <a href="tel:+74950000{inn[-3:]}">+7 (495) 000-0{inn[-3:]}</a></p>
+<p>Email: <a href="mailto:info@test{inn}.ru">info@test{inn}.ru</a></p>
+<footer>{company['full_name']}, ИНН {inn}</footer>
+</body></html>"""
+
+        return app
+
+
+def _summarize(params: Dict) -> Dict:
+    """Краткая запись параметров (без полного текста досье - только начало и длина)"""
+    summary = {}
+    for key, value in params.items():
+        if isinstance(value, dict):
+            summary[key] = _summarize(value)
+        elif isinstance(value, str) and len(value) > 120:
+            summary[key] = f"{value[:40]}... <{len(value)} chars>"
+        else:
+            summary[key] = value
+    return summary
+
+
+def start_in_thread(host: str = "127.0.0.1", port: int = 9100, profiles: Optional[Dict[str, UpstreamProfile]] = None) -> MockUpstreams:
+    """
+    Запуск заглушек в фоновом потоке (для бенчмарков в одном процессе)
+
+    Args:
+        host: Адрес
+        port: Порт
+        profiles: Профили upstream (по умолчанию DEFAULT_PROFILES)
+
+    Returns:
+        Экземпляр MockUpstreams
+    """
+    import uvicorn
+
+    mocks = MockUpstreams(profiles)
+    server = uvicorn.Server(uvicorn.Config(mocks.app, host=host, port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return mocks
+
+
+def parse_profiles(latency: List[str], jitter: List[str], errors: List[str], error_status: List[str]) -> Dict[str, UpstreamProfile]:
+    """
+    Профили из аргументов вида upstream=value
+
+    Args:
+        latency: Задержки в мс
+        jitter: Разброс в мс
+        errors: Доли ошибок 0.0-1.0
+        error_status: HTTP коды ошибок
+
+    Returns:
+        Словарь профилей
+    """
+    profiles = {name: UpstreamProfile(**asdict(p)) for name, p in DEFAULT_PROFILES.items()}
+    for values, field, cast in (
+        (latency, "latency_ms", float),
+        (jitter, "jitter_ms", float),
+        (errors, "error_rate", float),
+        (error_status, "error_status", int),
+    ):
+        for item in values or []:
+            name, _, value = item.partition("=")
+            if name not in profiles:
+                raise SystemExit(f"Неизвестный upstream: {name} (доступны: {', '.join(UPSTREAMS)})")
+            setattr(profiles[name], field, cast(value))
+    return profiles
+
+
+def add_profile_arguments(parser: argparse.ArgumentParser):
+    """Общие аргументы профилей для CLI заглушек и бенчмарков"""
+    parser.add_argument("--latency", action="append", metavar="UPSTREAM=MS", help="Средняя задержка")
+    parser.add_argument("--jitter", action="append", metavar="UPSTREAM=MS", help="Разброс задержки")
+    parser.add_argument("--errors", action="append", metavar="UPSTREAM=RATE", help="Доля ошибок 0.0-1.0")
+    parser.add_argument("--error-status", action="append", metavar="UPSTREAM=CODE", help="HTTP код ошибки")
+
+
+def main():
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Заглушки DaData, OpenRouter, Битрикс24 и сайтов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    profiles = parse_profiles(args.latency, args.jitter, args.errors, args.error_status)
+    mocks = MockUpstreams(profiles)
+
+    print(f"Заглушки: http://{args.host}:{args.port}")
+    for name, value in env_for(f"http://{args.host}:{args.port}").items():
+        print(f"  {name}={value}")
+
+    uvicorn.run(mocks.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Нагрузочный replay webhook Битрикс24 против запущенного экземпляра Sales Scout
+
+Отправляет записанные или синтетические form-data payload в формате data[PARAMS][...]
+на /webhook/bitrix и /webhook/research с заданной частотой и паттерном всплесков.
+
+Измеряет:
+- латентность подтверждения (ответа webhook)
+- рост очереди (sales_scout_research_queue_depth / in_flight из /metrics)
+- время end-to-end до финального сообщения в Битрикс24 (по журналу заглушки)
+
+Пример (без сети):
+    python -m benchmarks.mock_upstreams --port 9100 &
+    env $(python -c "from benchmarks.mock_upstreams import env_for; print(' '.join(f'{k}={v}' for k, v in env_for('http://127.0.0.1:9100').items()))") \\
+        uvicorn app.main:app --port 8000 &
+    python -m benchmarks.webhook_replay --target http://127.0.0.1:8000 --count 2000 --pattern burst --burst-size 2000
+
+Формат файла записанных payload (--payloads), JSONL:
+    {"endpoint": "/webhook/research", "form": {"inn": "7707083893", "userId": "314", "dealId": "15"}}
+    {"endpoint": "/webhook/bitrix", "form": {"event": "ONIMBOTMESSAGEADD", "data[PARAMS][MESSAGE]": "Яндекс", ...}}
+"""
+import json
+import time
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.dossier_benchmark import latency_summary, synthetic_inns
+
+# Префиксы финальных сообщений бота (досье доставлено или ошибка)
+FINAL_MESSAGE_PREFIXES = ("Оцените полезность", "😔")
+
+
+def synthetic_payloads(count: int, endpoint: str) -> List[Dict]:
+    """
+    Синтетические payload в формате, который разбирает app/main.py
+
+    Args:
+        count: Количество
+        endpoint: /webhook/research, /webhook/bitrix или mixed
+
+    Returns:
+        Список {"endpoint", "form"}
+    """
+    payloads = []
+    for i, inn in enumerate(synthetic_inns(count)):
+        target = endpoint if endpoint != "mixed" else ("/webhook/research", "/webhook/bitrix")[i % 2]
+        if target == "/webhook/research":
+            form = {"inn": inn, "userId": "1", "dealId": "1", "companyName": f"Компания {i}"}
+        else:
+            form = {
+                "event": "ONIMBOTMESSAGEADD",
+                "data[PARAMS][MESSAGE]": inn,
+                "data[PARAMS][DIALOG_ID]": "1",
+                "data[PARAMS][AUTHOR_ID]": "1",
+                "data[PARAMS][SYSTEM]": "N",
+                "auth[domain]": "mock.bitrix24.ru",
+                "auth[application_token]": "mock",
+            }
+        payloads.append({"endpoint": target, "form": form})
+    return payloads
+
+
+def load_payloads(path: str) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def assign_correlation_ids(payloads: List[Dict], base: int = 900000) -> List[str]:
+    """
+    Уникальные userId / DIALOG_ID / dealId для каждого payload
+
+    По ним финальные сообщения в журнале заглушки Битрикс24 сопоставляются с запросами.
+
+    Returns:
+        Список ID получателя для каждого payload
+    """
+    ids = []
+    for i, payload in enumerate(payloads):
+        correlation_id = str(base + i)
+        form = payload["form"]
+        if payload["endpoint"] == "/webhook/bitrix":
+            form["data[PARAMS][DIALOG_ID]"] = correlation_id
+        else:
+            form["userId"] = correlation_id
+            if "dealId" in form:
+                form["dealId"] = correlation_id
+        ids.append(correlation_id)
+    return ids
+
+
+def schedule(count: int, pattern: str, rate: float, burst_size: int, burst_interval: float) -> List[float]:
+    """
+    Смещения отправки (секунды от старта) для каждого payload
+
+    steady - равномерно с частотой rate
+    burst  - пачки по burst_size каждые burst_interval секунд
+    spike  - фон с частотой rate и одна пачка burst_size в середине
+    """
+    if pattern == "steady":
+        return [i / rate for i in range(count)]
+    if pattern == "burst":
+        return [(i // burst_size) * burst_interval for i in range(count)]
+    if pattern == "spike":
+        background = max(count - burst_size, 0)
+        offsets = [i / rate for i in range(background)]
+        middle = offsets[len(offsets) // 2] if offsets else 0.0
+        return sorted(offsets + [middle] * (count - background))
+    raise ValueError(f"Неизвестный паттерн: {pattern}")
+
+
+async def _poll_metrics(client: httpx.AsyncClient, target: str, samples: List[Dict], stop: asyncio.Event, interval: float):
+    """Снятие queue_depth / in_flight с /metrics"""
+    started = time.perf_counter()
+    while not stop.is_set():
+        try:
+            text = (await client.get(f"{target}/metrics", timeout=5)).text
+            values = {}
+            for line in text.splitlines():
+                for name in ("sales_scout_research_queue_depth", "sales_scout_research_in_flight"):
+                    if line.startswith(name + " "):
+                        values[name] = float(line.split()[1])
+            samples.append({"t": round(time.perf_counter() - started, 2), **values})
+        except httpx.HTTPError:
+            pass
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+def _final_times(calls: List[Dict]) -> Dict[str, float]:
+    """Время первого финального сообщения / комментария сделки по ID получателя"""
+    finished = {}
+    for call in calls:
+        params = call.get("params", {})
+        if call["method"] == "crm.timeline.comment.add":
+            recipient = str((params.get("fields") or {}).get("ENTITY_ID", ""))
+        elif call["method"] == "imbot.message.add" and str(params.get("MESSAGE", "")).startswith(FINAL_MESSAGE_PREFIXES):
+            recipient = str(params.get("DIALOG_ID", ""))
+        else:
+            continue
+        finished.setdefault(recipient, call["ts"])
+    return finished
+
+
+async def replay(
+    target: str,
+    payloads: List[Dict],
+    offsets: List[float],
+    mock_url: Optional[str],
+    completion_timeout: float,
+    metrics_interval: float,
+) -> Dict:
+    """
+    Отправка payload по расписанию и сбор отчета
+
+    Args:
+        target: Адрес Sales Scout
+        payloads: Payload с уникальными ID получателей
+        offsets: Смещения отправки
+        mock_url: Адрес заглушек (для end-to-end времени; None - не замерять)
+        completion_timeout: Сколько ждать завершения после последней отправки
+        metrics_interval: Период опроса /metrics
+
+    Returns:
+        Отчет
+    """
+    correlation_ids = assign_correlation_ids(payloads)
+    limits = httpx.Limits(max_connections=500, max_keepalive_connections=100)
+    acks: List[Optional[float]] = [None] * len(payloads)
+    sent_at: List[float] = [0.0] * len(payloads)
+    statuses: Dict[str, int] = {}
+    samples: List[Dict] = []
+
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        stop = asyncio.Event()
+        poller = asyncio.create_task(_poll_metrics(client, target, samples, stop, metrics_interval))
+        started_wall = time.time()
+        started = time.perf_counter()
+
+        async def send(i: int):
+            delay = offsets[i] - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            sent_at[i] = time.time()
+            t0 = time.perf_counter()
+            try:
+                response = await client.post(target + payloads[i]["endpoint"], data=payloads[i]["form"])
+                key = str(response.status_code)
+                if response.status_code == 200:
+                    acks[i] = time.perf_counter() - t0
+            except httpx.HTTPError as e:
+                key = type(e).__name__
+            statuses[key] = statuses.get(key, 0) + 1
+
+        await asyncio.gather(*(send(i) for i in range(len(payloads))))
+        send_duration = time.perf_counter() - started
+
+        completions: Dict[str, float] = {}
+        if mock_url:
+            deadline = time.perf_counter() + completion_timeout
+            while time.perf_counter() < deadline:
+                calls = (await client.get(f"{mock_url}/bitrix/_calls", params={"since": started_wall})).json()
+                completions = _final_times(calls)
+                if all(cid in completions for cid in correlation_ids):
+                    break
+                await asyncio.sleep(1.0)
+
+        stop.set()
+        await poller
+
+    ack_latencies = [a for a in acks if a is not None]
+    e2e = [completions[cid] - sent_at[i] for i, cid in enumerate(correlation_ids) if cid in completions]
+    queue_peak = max((s.get("sales_scout_research_queue_depth", 0) for s in samples), default=None)
+    in_flight_peak = max((s.get("sales_scout_research_in_flight", 0) for s in samples), default=None)
+
+    return {
+        "sent": len(payloads),
+        "send_seconds": round(send_duration, 2),
+        "statuses": statuses,
+        "ack_latency_ms": {k: (round(v * 1000, 1) if v is not None else None) for k, v in latency_summary(ack_latencies).items()},
+        "queue_depth_peak": queue_peak,
+        "in_flight_peak": in_flight_peak,
+        "queue_timeline": samples,
+        "completed": len(e2e) if mock_url else None,
+        "e2e_seconds": {k: (round(v, 2) if v is not None else None) for k, v in latency_summary(e2e).items()} if mock_url else None,
+    }
+
+
+def print_report(report: Dict):
+    print(f"Отправлено: {report['sent']} за {report['send_seconds']} с, ответы: {report['statuses']}")
+    ack = report["ack_latency_ms"]
+    print(f"Подтверждение: p50={ack['p50']} p95={ack['p95']} p99={ack['p99']} max={ack['max']} мс")
+    print(f"Очередь: пик {report['queue_depth_peak']}, в работе пик {report['in_flight_peak']}")
+    for sample in report["queue_timeline"][:: max(1, len(report["queue_timeline"]) // 20)]:
+        print(f"  t={sample['t']:>7}s queue={sample.get('sales_scout_research_queue_depth')} in_flight={sample.get('sales_scout_research_in_flight')}")
+    if report["e2e_seconds"] is not None:
+        e2e = report["e2e_seconds"]
+        print(f"Завершено: {report['completed']}/{report['sent']}")
+        print(f"End-to-end: p50={e2e['p50']} p95={e2e['p95']} p99={e2e['p99']} max={e2e['max']} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay webhook Битрикс24 против запущенного Sales Scout")
+    parser.add_argument("--target", default="http://127.0.0.1:8000", help="Адрес Sales Scout")
+    parser.add_argument("--mock-url", default="http://127.0.0.1:9100", help="Адрес заглушек ('' - без end-to-end)")
+    parser.add_argument("--payloads", help="JSONL с записанными payload")
+    parser.add_argument("--endpoint", default="/webhook/research", choices=["/webhook/research", "/webhook/bitrix", "mixed"])
+    parser.add_argument("--count", type=int, default=100, help="Количество запросов (для синтетических)")
+    parser.add_argument("--pattern", default="steady", choices=["steady", "burst", "spike"])
+    parser.add_argument("--rate", type=float, default=10.0, help="Запросов в секунду (steady/spike)")
+    parser.add_argument("--burst-size", type=int, default=100)
+    parser.add_argument("--burst-interval", type=float, default=10.0, help="Секунд между пачками")
+    parser.add_argument("--completion-timeout", type=float, default=600.0, help="Ожидание завершения, с")
+    parser.add_argument("--metrics-interval", type=float, default=0.5)
+    parser.add_argument("--json", action="store_true", help="Вывести отчет в JSON")
+    args = parser.parse_args()
+
+    payloads = load_payloads(args.payloads) if args.payloads else synthetic_payloads(args.count, args.endpoint)
+    offsets = schedule(len(payloads), args.pattern, args.rate, args.burst_size, args.burst_interval)
+
+    report = asyncio.run(replay(
+        args.target.rstrip("/"),
+        payloads,
+        offsets,
+        args.mock_url.rstrip("/") or None,
+        args.completion_timeout,
+        args.metrics_interval,
+    ))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Поиск по истории досье: совпадение основ слов запроса и досье
+"""
+import pytest
+
+from app.services.dossier_history import DossierHistory
+
+
+@pytest.fixture
+def history(tmp_path):
+    history = DossierHistory(str(tmp_path / "history.db"))
+    history.add("1655000001", "ООО Волга Логистик", None, "Компания в сфере: логистика и складское хранение, Казань.")
+    history.add("7707000002", "ООО Транс", None, "Крупная компания - оператор логистических услуг в Москве.")
+    history.add("7707000003", "ООО Софт", None, "Компания разрабатывает программное обеспечение.")
+    return history
+
+
+def _inns(results):
+    return {result["inn"] for result in results}
+
+
+def test_noun_query_finds_adjective_forms(history):
+    assert _inns(history.search("логистика")) == {"1655000001", "7707000002"}
+
+
+def test_adjective_query_finds_noun_forms(history):
+    assert _inns(history.search("что мы знаем о логистических компаниях")) == {"1655000001", "7707000002"}
+
+
+def test_all_query_words_must_match(history):
+    assert _inns(history.search("логистика Казань")) == {"1655000001"}
+    assert _inns(history.search("казанские логистические компании")) == {"1655000001"}
+
+
+def test_snippet_shows_matching_line(history):
+    result = history.search("логистических", inn="1655000001")[0]
+    assert "логистика" in result["snippet"]
+
+
+def test_unrelated_query_finds_nothing(history):
+    assert history.search("логистика Новосибирск") == []
+    assert history.search("что мы знаем о") == []